@@ -14,6 +14,7 @@ from setup.migrate_aide import migrate_aide
 from util.configDef import Config
 from modules import REGISTERED_MODULES, Database
 from constants.version import AIDE_VERSION
+from util.compression import CompressionPlugin
 
 def _verify_unique(instances, moduleClass):
         '''
@@ -92,6 +93,11 @@ if len(warnings) or len(errors):
 
 # prepare bottle
 app = Bottle()
+if config.getProperty('Server', 'compress_responses', type=bool, fallback=False):
+    app.install(CompressionPlugin(
+        minSize=config.getProperty('Server', 'compression_min_size', type=int, fallback=1024),
+        level=config.getProperty('Server', 'compression_level', type=int, fallback=6)
+    ))
 
 # parse requested instances
 instance_args = os.environ['AIDE_MODULES'].split(',')
@@ -0,0 +1,110 @@
+'''
+    Benchmark of the authorization checks performed on every request. Sim-
+    ulates a mix of requests (labeling interface routes that check project
+    access, some of them twice like "getImages", admin routes and routes
+    without a project) and runs the checks of "UserMiddleware" (session
+    token secret, demo mode, project membership, user privileges) for each
+    of them, once without and once with the authorization cache. Reports
+    latencies and the number of database queries per request.
+
+    Only reads from the database; the user's session is not modified.
+
+    Usage:
+        python benchmarks/auth_checks.py --project test --username admin
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import argparse
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+# (name, share, list of checks as (project required, admin))
+REQUEST_MIX = (
+    ('getImages', 0.4, ((True, False), (True, True))),
+    ('submitAnnotations', 0.3, ((True, False),)),
+    ('admin route', 0.2, ((True, True),)),
+    ('getAuthentication', 0.1, ((False, False),))
+)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Measure the cost of authorization checks with and without caching.')
+    parser.add_argument('--settings_filepath', type=str, default='config/settings.ini', const=1, nargs='?',
+                    help='Manual specification of the directory of the settings.ini file; only considered if environment variable unset (default: "config/settings.ini").')
+    parser.add_argument('--project', type=str,
+                    help='Shortname of the project to check access to.')
+    parser.add_argument('--username', type=str,
+                    help='Name of an existing user account.')
+    parser.add_argument('--num_threads', type=int, default=8, const=1, nargs='?',
+                    help='Number of concurrently served requests (default: 8).')
+    parser.add_argument('--num_requests', type=int, default=5000, const=1, nargs='?',
+                    help='Total number of simulated requests (default: 5000).')
+    parser.add_argument('--ttl', type=float, default=5.0, const=1, nargs='?',
+                    help='Time-to-live of cached entries in seconds (default: 5).')
+    args = parser.parse_args()
+
+    if not 'AIDE_CONFIG_PATH' in os.environ:
+        os.environ['AIDE_CONFIG_PATH'] = str(args.settings_filepath)
+    if not 'AIDE_MODULES' in os.environ:
+        os.environ['AIDE_MODULES'] = ''     # for compatibility with Celery worker import
+
+    from util.configDef import Config
+    from util.authCache import AuthorizationCache
+    from modules.UserHandling.backend.middleware import UserMiddleware
+
+    config = Config()
+    middleware = UserMiddleware(config)
+
+    # count database queries
+    numQueries = [0]
+    execute = middleware.dbConnector.execute
+    def _counting_execute(*args, **kwargs):
+        numQueries[0] += 1
+        return execute(*args, **kwargs)
+    middleware.dbConnector.execute = _counting_execute
+
+    random.seed(0)
+    names = [r[0] for r in REQUEST_MIX]
+    shares = [r[1] for r in REQUEST_MIX]
+    requests = random.choices(range(len(REQUEST_MIX)), weights=shares, k=args.num_requests)
+
+    def _serve(requestIdx):
+        t0 = time.perf_counter()
+        middleware._get_secret_token(args.username)
+        for needsProject, admin in REQUEST_MIX[requestIdx][2]:
+            project = (args.project if needsProject else None)
+            demoMode = middleware.checkDemoMode(project)
+            if demoMode:
+                continue
+            if project is not None:
+                middleware._check_authorized(project, args.username, admin)
+            middleware._check_user_privileges(args.username)
+        return requestIdx, time.perf_counter() - t0
+
+    for name, ttl in (('uncached', 0), (f'cached ({args.ttl}s)', args.ttl)):
+        middleware.authCache = AuthorizationCache(ttl)
+        numQueries[0] = 0
+        tStart = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.num_threads) as executor:
+            results = list(executor.map(_serve, requests))
+        tTotal = time.perf_counter() - tStart
+
+        print(f'{name}: {args.num_requests} requests in {tTotal:.2f}s ({args.num_requests/tTotal:.1f} requests/s), {numQueries[0]/args.num_requests:.3f} queries per request')
+        for idx, requestName in enumerate(names):
+            timings = np.array([r[1] for r in results if r[0] == idx]) * 1000
+            if not len(timings):
+                continue
+            print('\t{:<18} mean {:7.3f}, p50 {:7.3f}, p95 {:7.3f}, p99 {:7.3f} ms'.format(
+                requestName,
+                np.mean(timings),
+                np.percentile(timings, 50),
+                np.percentile(timings, 95),
+                np.percentile(timings, 99)
+            ))
+        print(f'\tcache statistics: {middleware.authCache.get_statistics()}')
@@ -0,0 +1,135 @@
+'''
+    Benchmark for image batch assignment under concurrent load. Simulates
+    a number of annotators that simultaneously request batches of images
+    through "DBMiddleware.getBatch_auto", once with the legacy assignment
+    (read first, mark images as requested afterwards) and once with atomic
+    reservation ("FOR UPDATE SKIP LOCKED"). Reports latency percentiles
+    and how many images were handed out to more than one annotator.
+
+    The "last_requested" timestamps and reservation settings of the project
+    are restored at the end, but you should still only run the benchmark
+    against a test project, since annotators of the project might otherwise
+    receive different images while the benchmark is running.
+
+    Usage:
+        python benchmarks/batch_reservation.py --project test
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import argparse
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier
+import numpy as np
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Measure batch assignment latency and duplicates under concurrent load.')
+    parser.add_argument('--settings_filepath', type=str, default='config/settings.ini', const=1, nargs='?',
+                    help='Manual specification of the directory of the settings.ini file; only considered if environment variable unset (default: "config/settings.ini").')
+    parser.add_argument('--project', type=str,
+                    help='Shortname of the (test) project to request images from.')
+    parser.add_argument('--num_users', type=int, default=50, const=1, nargs='?',
+                    help='Number of concurrently requesting annotators (default: 50).')
+    parser.add_argument('--num_requests', type=int, default=10, const=1, nargs='?',
+                    help='Number of batch requests per annotator (default: 10).')
+    parser.add_argument('--batch_size', type=int, default=12, const=1, nargs='?',
+                    help='Number of images per batch (default: 12).')
+    args = parser.parse_args()
+
+    if not 'AIDE_CONFIG_PATH' in os.environ:
+        os.environ['AIDE_CONFIG_PATH'] = str(args.settings_filepath)
+    if not 'AIDE_MODULES' in os.environ:
+        os.environ['AIDE_MODULES'] = ''     # for compatibility with Celery worker import
+
+    from psycopg2 import sql
+    from util.configDef import Config
+    from modules.LabelUI.backend.middleware import DBMiddleware
+
+    config = Config()
+    middleware = DBMiddleware(config)
+    dbConnector = middleware.dbConnector
+
+    if middleware.get_project_immutables(args.project)['demoMode']:
+        raise Exception('Batch reservation is not used in demo mode; please disable it for the benchmark project.')
+
+    # back up state that is going to be modified
+    settings = dbConnector.execute('''
+        SELECT batch_reservation, batch_reservation_window
+        FROM aide_admin.project
+        WHERE shortname = %s;
+    ''', (args.project,), 1)[0]
+    lastRequested = dbConnector.execute(sql.SQL('''
+        SELECT id, last_requested FROM {};
+    ''').format(sql.Identifier(args.project, 'image')), None, 'all')
+    lastRequested = [(l['id'], l['last_requested']) for l in lastRequested]
+    print(f'Project contains {len(lastRequested)} images.')
+
+    def _reset_last_requested():
+        dbConnector.execute(sql.SQL('UPDATE {} SET last_requested = NULL;').format(
+            sql.Identifier(args.project, 'image')), None, None)
+
+    def _run(reserve):
+        dbConnector.execute('''
+            UPDATE aide_admin.project
+            SET batch_reservation = %s
+            WHERE shortname = %s;
+        ''', (reserve, args.project,), None)
+        _reset_last_requested()
+
+        barrier = Barrier(args.num_users)
+
+        def _annotator(idx):
+            username = f'benchmark_user_{idx}'
+            latencies = []
+            imageIDs = []
+            for _ in range(args.num_requests):
+                barrier.wait()      # maximize contention
+                t0 = time.perf_counter()
+                batch = middleware.getBatch_auto(args.project, username, limit=args.batch_size)
+                latencies.append(time.perf_counter() - t0)
+                imageIDs.extend(batch['entries'].keys())
+            return latencies, imageIDs
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.num_users) as executor:
+            results = list(executor.map(_annotator, range(args.num_users)))
+        tTotal = time.perf_counter() - t0
+
+        latencies = np.array([l for r in results for l in r[0]]) * 1000
+        counts = Counter([i for r in results for i in r[1]])
+        numDuplicates = sum([1 for c in counts.values() if c > 1])
+        print('Mode: {}'.format('atomic reservation' if reserve else 'legacy'))
+        print(f'\t{len(latencies)} requests in {tTotal:.2f} s ({len(latencies)/tTotal:.1f} requests/s)')
+        print('\tLatency (ms): mean {:.1f}, p50 {:.1f}, p95 {:.1f}, p99 {:.1f}, max {:.1f}'.format(
+            np.mean(latencies),
+            np.percentile(latencies, 50),
+            np.percentile(latencies, 95),
+            np.percentile(latencies, 99),
+            np.max(latencies)
+        ))
+        print(f'\t{sum(counts.values())} images handed out; {len(counts)} distinct, {numDuplicates} to more than one annotator')
+
+    try:
+        print(f'Simulating {args.num_users} annotators with {args.num_requests} requests of {args.batch_size} images each...')
+        _run(False)
+        _run(True)
+
+    finally:
+        print('Restoring project state...')
+        dbConnector.execute('''
+            UPDATE aide_admin.project
+            SET batch_reservation = %s, batch_reservation_window = %s
+            WHERE shortname = %s;
+        ''', (settings['batch_reservation'], settings['batch_reservation_window'], args.project,), None)
+        if len(lastRequested):
+            dbConnector.insert(sql.SQL('''
+                UPDATE {} AS img
+                SET last_requested = v.last_requested::timestamptz
+                FROM (VALUES %s) AS v(id, last_requested)
+                WHERE img.id = v.id;
+            ''').format(sql.Identifier(args.project, 'image')), lastRequested)
@@ -0,0 +1,123 @@
+'''
+    Benchmark of the payload size and serialization time of LabelUI image
+    batches in the different wire formats (nested JSON, columnar JSON and,
+    if installed, columnar MessagePack), each uncompressed and compressed
+    with gzip and deflate (see "util/compression.py").
+
+    By default, a synthetic batch of images with bounding box annotations
+    and predictions is used. Alternatively, a real batch can be requested
+    from a project with "--project" (requires a running database).
+
+    Usage:
+        python benchmarks/batch_wire_format.py --num_images 32 --num_boxes 200
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import argparse
+import random
+import time
+import timeit
+import gzip
+import zlib
+from uuid import uuid4
+
+
+def _synthetic_batch(numImages, numBoxes, numLabels=20):
+    labels = [str(uuid4()) for _ in range(numLabels)]
+    now = time.time()
+    entries = {}
+    for i in range(numImages):
+        img = {
+            'fileName': f'images/image_{i}.jpg',
+            'predictions': {},
+            'annotations': {},
+            'last_checked': now - random.randint(0, 10000),
+            'viewcount': random.randint(0, 3),
+            'isGoldenQuestion': False
+        }
+        for _ in range(numBoxes):
+            annoID = str(uuid4())
+            img['annotations'][annoID] = {
+                'id': annoID, 'label': random.choice(labels), 'meta': None, 'unsure': False,
+                'x': random.random(), 'y': random.random(),
+                'width': random.random(), 'height': random.random(), 'viewcount': None
+            }
+            predID = str(uuid4())
+            img['predictions'][predID] = {
+                'id': predID, 'label': random.choice(labels),
+                'confidence': random.random(), 'priority': random.random(),
+                'x': random.random(), 'y': random.random(),
+                'width': random.random(), 'height': random.random(), 'viewcount': None
+            }
+        entries[str(uuid4())] = img
+    return { 'entries': entries }
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Measure payload size and serialization time of LabelUI batch formats.')
+    parser.add_argument('--settings_filepath', type=str, default='config/settings.ini', const=1, nargs='?',
+                    help='Manual specification of the directory of the settings.ini file; only considered if environment variable unset (default: "config/settings.ini").')
+    parser.add_argument('--project', type=str, default=None, const=1, nargs='?',
+                    help='Shortname of a project to request a real batch from (default: use a synthetic batch).')
+    parser.add_argument('--num_images', type=int, default=32, const=1, nargs='?',
+                    help='Number of images in the batch (default: 32).')
+    parser.add_argument('--num_boxes', type=int, default=200, const=1, nargs='?',
+                    help='Number of annotations and predictions each per image of the synthetic batch (default: 200).')
+    parser.add_argument('--compression_level', type=int, default=6, const=1, nargs='?',
+                    help='Compression level for gzip and deflate (default: 6).')
+    parser.add_argument('--repeats', type=int, default=10, const=1, nargs='?',
+                    help='Number of timed repetitions (default: 10).')
+    args = parser.parse_args()
+
+    if not 'AIDE_CONFIG_PATH' in os.environ:
+        os.environ['AIDE_CONFIG_PATH'] = str(args.settings_filepath)
+    if not 'AIDE_MODULES' in os.environ:
+        os.environ['AIDE_MODULES'] = ''     # for compatibility with Celery worker import
+
+    import bottle
+    from modules.LabelUI.backend import wire_format
+
+    if args.project is not None:
+        from util.configDef import Config
+        from modules.LabelUI.backend.middleware import DBMiddleware
+        middleware = DBMiddleware(Config())
+        batch = middleware.getBatch_auto(args.project, 'benchmark_user', limit=args.num_images)
+    else:
+        batch = _synthetic_batch(args.num_images, args.num_boxes)
+    numEntries = sum([len(img['annotations']) + len(img['predictions']) for img in batch['entries'].values()])
+    print(f'Batch with {len(batch["entries"])} images and {numEntries} annotations and predictions.\n')
+
+    formats = [
+        ('nested JSON', lambda: bottle.json_dumps(batch)),
+        ('columnar JSON', lambda: wire_format.encode(batch, wire_format.MIME_COLUMNAR_JSON))
+    ]
+    if wire_format.msgpack is not None:
+        formats.append(('columnar msgpack', lambda: wire_format.encode(batch, wire_format.MIME_COLUMNAR_MSGPACK)))
+    else:
+        print('"msgpack" is not installed; skipping MessagePack format.\n')
+
+    level = args.compression_level
+    compressions = [
+        ('none', None),
+        ('gzip', lambda b: gzip.compress(b, compresslevel=level)),
+        ('deflate', lambda b: zlib.compress(b, level))
+    ]
+
+    print('{:<18} {:<8} {:>12} {:>18} {:>18}'.format('Format', 'Encoding', 'Size (KB)', 'Serialize (ms)', 'Compress (ms)'))
+    for name, serialize in formats:
+        tSerialize = min(timeit.repeat(serialize, number=1, repeat=args.repeats))
+        body = serialize()
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        for encoding, compress in compressions:
+            if compress is None:
+                size, tCompress = len(body), 0.0
+            else:
+                tCompress = min(timeit.repeat(lambda: compress(body), number=1, repeat=args.repeats))
+                size = len(compress(body))
+            print('{:<18} {:<8} {:>12.1f} {:>18.2f} {:>18.2f}'.format(
+                name, encoding, size/1024, tSerialize*1000, tCompress*1000))
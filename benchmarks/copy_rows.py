@@ -0,0 +1,113 @@
+'''
+    Benchmark that compares bulk insertion of prediction-like rows through
+    "Database.insert" (i.e., psycopg2's "execute_values") with the COPY-based
+    "Database.copy_rows".
+    Creates a temporary table in the "public" schema of the configured
+    database and drops it again when done.
+
+    Usage:
+        python benchmarks/copy_rows.py --num_rows 100000
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import argparse
+import random
+import time
+import uuid
+from datetime import datetime
+import pytz
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compare execute_values with COPY for bulk insertions.')
+    parser.add_argument('--settings_filepath', type=str, default='config/settings.ini', const=1, nargs='?',
+                    help='Manual specification of the directory of the settings.ini file; only considered if environment variable unset (default: "config/settings.ini").')
+    parser.add_argument('--num_rows', type=int, default=100000, const=1, nargs='?',
+                    help='Number of rows to insert per method (default: 100000).')
+    parser.add_argument('--num_repetitions', type=int, default=3, const=1, nargs='?',
+                    help='Number of times each method is timed (default: 3).')
+    args = parser.parse_args()
+
+    if not 'AIDE_CONFIG_PATH' in os.environ:
+        os.environ['AIDE_CONFIG_PATH'] = str(args.settings_filepath)
+    if not 'AIDE_MODULES' in os.environ:
+        os.environ['AIDE_MODULES'] = ''     # for compatibility with Celery worker import
+
+    from psycopg2 import sql
+    from util.configDef import Config
+    from modules.Database.app import Database
+
+    config = Config()
+    dbConn = Database(config)
+
+    tableName = 'aide_benchmark_' + uuid.uuid4().hex
+    tableID = sql.Identifier('public', tableName)
+    columns = ('image', 'cnnstate', 'timeCreated', 'label', 'confidence', 'x', 'y', 'width', 'height', 'priority')
+
+    dbConn.execute(sql.SQL('''
+        CREATE TABLE {table} (
+            id uuid DEFAULT uuid_generate_v4(),
+            image uuid NOT NULL,
+            cnnstate uuid,
+            timeCreated TIMESTAMPTZ,
+            label uuid,
+            confidence real,
+            x real,
+            y real,
+            width real,
+            height real,
+            priority real
+        );
+    ''').format(table=tableID), None, None)
+
+    # synthetic predictions
+    now = datetime.now(tz=pytz.utc)
+    cnnstate = uuid.uuid4()
+    labels = [uuid.uuid4() for _ in range(10)]
+    images = [uuid.uuid4() for _ in range(max(1, args.num_rows // 20))]
+    rows = []
+    for _ in range(args.num_rows):
+        rows.append((
+            random.choice(images), cnnstate, now, random.choice(labels), random.random(),
+            random.random(), random.random(), random.random(), random.random(),
+            (random.random() if random.random() > 0.1 else None)
+        ))
+
+    queryStr = sql.SQL('''
+        INSERT INTO {table} ({columns})
+        VALUES %s;
+    ''').format(
+        table=tableID,
+        columns=sql.SQL(', ').join([sql.Identifier(c.lower()) for c in columns])
+    )
+
+    try:
+        timings = {
+            'execute_values': [],
+            'copy_rows': []
+        }
+        for r in range(args.num_repetitions):
+            dbConn.execute(sql.SQL('TRUNCATE {};').format(tableID), None, None)
+            t0 = time.perf_counter()
+            dbConn.insert(queryStr, rows)
+            timings['execute_values'].append(time.perf_counter() - t0)
+
+            dbConn.execute(sql.SQL('TRUNCATE {};').format(tableID), None, None)
+            t0 = time.perf_counter()
+            dbConn.copy_rows(tableID, columns, rows)
+            timings['copy_rows'].append(time.perf_counter() - t0)
+
+        count = dbConn.execute(sql.SQL('SELECT COUNT(*) AS cnt FROM {};').format(tableID), None, 1)
+        assert count[0]['cnt'] == args.num_rows, 'Number of copied rows does not match'
+
+        print(f'Inserted {args.num_rows} rows, best of {args.num_repetitions} repetitions:')
+        for key in timings.keys():
+            best = min(timings[key])
+            print(f'\t{key:<16}{best:8.3f} s\t({args.num_rows/best:12.1f} rows/s)')
+        print('\tspeedup: {:.2f}x'.format(min(timings['execute_values']) / min(timings['copy_rows'])))
+
+    finally:
+        dbConn.execute(sql.SQL('DROP TABLE IF EXISTS {};').format(tableID), None, None)
@@ -0,0 +1,106 @@
+'''
+    Benchmark of login checks under concurrent load. Simulates a number of
+    requests that check (and extend) the session of a user through
+    "UserMiddleware.isAuthenticated", once for each session store (local
+    and SQLite), and reports latency percentiles, the peak number of
+    threads of the process and the number of session extensions written to
+    the database.
+
+    WARNING: this creates a new session for the given user, which logs
+    them out of any browser session. Only use a test account.
+
+    Usage:
+        python benchmarks/login_checks.py --username benchmark_user
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import argparse
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Measure latency of login checks under concurrent load.')
+    parser.add_argument('--settings_filepath', type=str, default='config/settings.ini', const=1, nargs='?',
+                    help='Manual specification of the directory of the settings.ini file; only considered if environment variable unset (default: "config/settings.ini").')
+    parser.add_argument('--username', type=str,
+                    help='Name of an existing (test) user account.')
+    parser.add_argument('--num_threads', type=int, default=32, const=1, nargs='?',
+                    help='Number of concurrently served requests (default: 32).')
+    parser.add_argument('--num_requests', type=int, default=10000, const=1, nargs='?',
+                    help='Total number of simulated requests per session store (default: 10000).')
+    args = parser.parse_args()
+
+    if not 'AIDE_CONFIG_PATH' in os.environ:
+        os.environ['AIDE_CONFIG_PATH'] = str(args.settings_filepath)
+    if not 'AIDE_MODULES' in os.environ:
+        os.environ['AIDE_MODULES'] = ''     # for compatibility with Celery worker import
+
+    from util.configDef import Config
+    from modules.UserHandling.backend.middleware import UserMiddleware
+    from modules.UserHandling.backend.session_store import LocalSessionStore, SQLiteSessionStore, SessionWriter
+
+    config = Config()
+    middleware = UserMiddleware(config)
+
+    sqlitePath = os.path.join(tempfile.mkdtemp(), 'sessions.sqlite')
+    stores = (
+        ('local', LocalSessionStore()),
+        ('sqlite', SQLiteSessionStore(sqlitePath))
+    )
+
+    # monitor number of threads
+    peakThreads = [0]
+    monitoring = [True]
+    def _monitor():
+        while monitoring[0]:
+            peakThreads[0] = max(peakThreads[0], threading.active_count())
+            time.sleep(0.01)
+
+    def _check(sessionToken):
+        t0 = time.perf_counter()
+        loggedIn = middleware.isAuthenticated(args.username, sessionToken, extend_session=True)
+        return loggedIn, time.perf_counter() - t0
+
+    try:
+        for name, store in stores:
+            middleware.sessionStore = store
+            middleware.sessionWriter = SessionWriter(middleware.dbConnector)
+            sessionToken, _, _ = middleware._init_or_extend_session(args.username)
+
+            threadsBefore = threading.active_count()
+            peakThreads[0] = threadsBefore
+            monitoring[0] = True
+            monitor = threading.Thread(target=_monitor, daemon=True)
+            monitor.start()
+
+            tStart = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.num_threads) as executor:
+                results = list(executor.map(_check, [sessionToken] * args.num_requests))
+            tTotal = time.perf_counter() - tStart
+
+            monitoring[0] = False
+            monitor.join()
+            middleware.sessionWriter.close()
+
+            timings = np.array([r[1] for r in results]) * 1000
+            numFailed = sum([1 for r in results if not r[0]])
+            print(f'{name} session store: {args.num_requests} requests in {tTotal:.2f}s ({args.num_requests/tTotal:.1f} requests/s), {numFailed} failed')
+            print('\tlatency: mean {:7.3f}, p50 {:7.3f}, p95 {:7.3f}, p99 {:7.3f}, max {:7.3f} ms'.format(
+                np.mean(timings),
+                np.percentile(timings, 50),
+                np.percentile(timings, 95),
+                np.percentile(timings, 99),
+                np.max(timings)
+            ))
+            print(f'\tthreads: {threadsBefore} before, {peakThreads[0]} at peak (including {args.num_threads} request threads and the monitor)')
+            print(f'\tsession writer: {middleware.sessionWriter.get_statistics()}')
+
+    finally:
+        middleware._invalidate_session(args.username)
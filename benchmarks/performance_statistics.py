@@ -0,0 +1,135 @@
+'''
+    Benchmark and equivalence check of the evaluation engines for the
+    performance statistics of users and models (points and bounding boxes;
+    see "modules/ProjectStatistics/backend/geometricEvaluation.py").
+
+    1. Compares the IoU matrices computed in NumPy with the database function
+       "intersection_over_union" used by the SQL formulas on random boxes.
+    2. Evaluates the given users or model states against the target user in
+       the given project with the SQL and the NumPy engine, reports the
+       time taken by each and the differences in the per-entity statistics.
+
+    Exits with a non-zero status if the IoU differs. Differences in the
+    per-entity statistics are reported, but may be legitimate: the engines
+    differ for annotations matched to more than one target, for images
+    without overlapping annotations and for images without annotations of
+    the evaluated user (see the docstring of "geometricEvaluation.py").
+
+    Only reads from the database.
+
+    Usage:
+        python benchmarks/performance_statistics.py --project test --target admin --entities user1,user2
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import sys
+import argparse
+import time
+import numpy as np
+
+
+STATS_KEYS = ('num_pred', 'num_target', 'tp', 'fp', 'fn', 'prec', 'rec', 'f1', 'avg_iou', 'avg_dist')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compare the SQL and NumPy evaluation engines of the project statistics.')
+    parser.add_argument('--settings_filepath', type=str, default='config/settings.ini', const=1, nargs='?',
+                    help='Manual specification of the directory of the settings.ini file; only considered if environment variable unset (default: "config/settings.ini").')
+    parser.add_argument('--project', type=str,
+                    help='Shortname of the project to evaluate (points or bounding boxes).')
+    parser.add_argument('--target', type=str,
+                    help='Name of the user whose annotations serve as the reference.')
+    parser.add_argument('--entities', type=str,
+                    help='Comma-separated list of user names or model state IDs to evaluate.')
+    parser.add_argument('--entity_type', type=str, default='user', const=1, nargs='?',
+                    help='Type of the evaluated entities: "user" or "model" (default: "user").')
+    parser.add_argument('--threshold', type=float, default=0.5, const=1, nargs='?',
+                    help='Minimum IoU, resp. maximum distance for a match (default: 0.5).')
+    parser.add_argument('--golden_questions_only', type=int, default=0, const=1, nargs='?',
+                    help='Set to 1 to only evaluate golden questions (default: 0).')
+    parser.add_argument('--matching', type=str, default='greedy', const=1, nargs='?',
+                    help='Matching method of the NumPy engine: "greedy" or "hungarian" (default: "greedy").')
+    parser.add_argument('--num_repetitions', type=int, default=3, const=1, nargs='?',
+                    help='Number of times each engine is run (default: 3).')
+    parser.add_argument('--num_boxes', type=int, default=2000, const=1, nargs='?',
+                    help='Number of random box pairs for the IoU check (default: 2000).')
+    args = parser.parse_args()
+
+    if not 'AIDE_CONFIG_PATH' in os.environ:
+        os.environ['AIDE_CONFIG_PATH'] = str(args.settings_filepath)
+    if not 'AIDE_MODULES' in os.environ:
+        os.environ['AIDE_MODULES'] = ''     # for compatibility with Celery worker import
+
+    from psycopg2.extras import execute_values
+    from util.configDef import Config
+    from modules.ProjectStatistics.backend.middleware import ProjectStatisticsMiddleware
+    from modules.ProjectStatistics.backend import geometricEvaluation
+
+    config = Config()
+    middleware = ProjectStatisticsMiddleware(config)
+
+    # 1. IoU of random boxes (including non-overlapping and touching ones)
+    rng = np.random.default_rng(0)
+    boxesA = np.concatenate((rng.uniform(0, 1, (args.num_boxes, 2)), rng.uniform(0.01, 0.3, (args.num_boxes, 2))), 1).astype(np.float32)
+    boxesB = boxesA.copy()
+    boxesB[:, :2] += rng.normal(0, 0.1, (args.num_boxes, 2)).astype(np.float32)
+    boxesB[:, 2:] *= rng.uniform(0.5, 1.5, (args.num_boxes, 2)).astype(np.float32)
+    boxesB[:10] = boxesA[:10]
+
+    with middleware.dbConnector.transaction() as cursor:
+        result = execute_values(cursor, '''
+            SELECT idx, intersection_over_union(ax, ay, aw, ah, bx, by, bw, bh) AS iou
+            FROM (VALUES %s) AS v(idx, ax, ay, aw, ah, bx, by, bw, bh)
+        ''', [(i, *[float(v) for v in boxesA[i]], *[float(v) for v in boxesB[i]]) for i in range(args.num_boxes)],
+            template='(%s, %s::real, %s::real, %s::real, %s::real, %s::real, %s::real, %s::real, %s::real)',
+            page_size=args.num_boxes, fetch=True)
+    iou_sql = np.array([r['iou'] for r in sorted(result, key=lambda r: r['idx'])], dtype=np.float64)
+    iou_np = np.array([geometricEvaluation.iou_matrix(boxesA[i], boxesB[i])[0, 0] for i in range(args.num_boxes)])
+    maxDiff = np.max(np.abs(iou_sql - iou_np))
+    iouEqual = (maxDiff < 1e-5)
+    print(f'IoU of {args.num_boxes} random box pairs: max. difference to "intersection_over_union" {maxDiff:.2e} ({"OK" if iouEqual else "MISMATCH"})')
+
+    if args.project is None or args.target is None or args.entities is None:
+        print('No project, target user or entities specified; skipping comparison of engines.')
+
+    else:
+        entities = [e.strip() for e in args.entities.split(',') if len(e.strip())]
+
+        # 2. performance statistics with both engines
+        results = {}
+        for engine in ('sql', 'numpy'):
+            timings = []
+            for _ in range(args.num_repetitions):
+                t0 = time.perf_counter()
+                results[engine] = middleware.getPerformanceStatistics(args.project, entities, args.target,
+                                        args.entity_type, args.threshold, bool(args.golden_questions_only),
+                                        engine, args.matching)
+                timings.append(time.perf_counter() - t0)
+            timings = np.array(timings)
+            print(f'{engine:<6} engine: mean {np.mean(timings):8.3f}s, min {np.min(timings):8.3f}s, max {np.max(timings):8.3f}s ({args.num_repetitions} runs)')
+
+        perEntity_sql = results['sql'].get('per_entity', {})
+        perEntity_np = results['numpy'].get('per_entity', {})
+        numDifferent = 0
+        for entity in sorted(set(perEntity_sql.keys()) | set(perEntity_np.keys())):
+            if entity not in perEntity_sql or entity not in perEntity_np:
+                print(f'\t{entity}: only evaluated by the {"SQL" if entity in perEntity_sql else "NumPy"} engine')
+                numDifferent += 1
+                continue
+            diffs = []
+            for key in STATS_KEYS:
+                if key not in perEntity_sql[entity]:
+                    continue
+                vSql, vNp = float(perEntity_sql[entity][key]), float(perEntity_np[entity][key])
+                if not np.isclose(vSql, vNp, rtol=1e-4, atol=1e-6):
+                    diffs.append(f'{key} {vSql:.4f} (SQL) vs. {vNp:.4f} (NumPy)')
+            if len(diffs):
+                print(f'\t{entity}: ' + ', '.join(diffs))
+                numDifferent += 1
+        print(f'{numDifferent} of {len(set(perEntity_sql.keys()) | set(perEntity_np.keys()))} entities with differing statistics.')
+
+    if not iouEqual:
+        sys.exit(1)
@@ -0,0 +1,126 @@
+'''
+    Benchmark of drawing random images from tables of increasing size,
+    comparing a full random sort ("ORDER BY RANDOM()") with the adaptive
+    page sampling ("TABLESAMPLE SYSTEM") used for random batch order, demo
+    mode and project sample images (see "util/tableSample.py"). A fraction
+    of the images is marked as recently requested and filtered out, as in
+    the batch queries of the labeling interface; if a sampled query returns
+    too few images, it falls back to the full random sort.
+
+    Creates temporary tables in the "public" schema of the configured
+    database and drops them again when done.
+
+    Usage:
+        python benchmarks/random_sampling.py --sizes 10000 100000 1000000
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import argparse
+import time
+import uuid
+import numpy as np
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compare ORDER BY RANDOM() with TABLESAMPLE for random image selection.')
+    parser.add_argument('--settings_filepath', type=str, default='config/settings.ini', const=1, nargs='?',
+                    help='Manual specification of the directory of the settings.ini file; only considered if environment variable unset (default: "config/settings.ini").')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                    help='Numbers of images of the tables to test (default: 10000 100000 1000000).')
+    parser.add_argument('--limit', type=int, default=128, const=1, nargs='?',
+                    help='Number of images to draw per query (default: 128).')
+    parser.add_argument('--requested_fraction', type=float, default=0.5, const=1, nargs='?',
+                    help='Fraction of images marked as recently requested, i.e. filtered out (default: 0.5).')
+    parser.add_argument('--num_queries', type=int, default=50, const=1, nargs='?',
+                    help='Number of timed queries per method and size (default: 50).')
+    args = parser.parse_args()
+
+    if not 'AIDE_CONFIG_PATH' in os.environ:
+        os.environ['AIDE_CONFIG_PATH'] = str(args.settings_filepath)
+    if not 'AIDE_MODULES' in os.environ:
+        os.environ['AIDE_MODULES'] = ''     # for compatibility with Celery worker import
+
+    from psycopg2 import sql
+    from util.configDef import Config
+    from modules.Database.app import Database
+    from util.tableSample import TableSampler
+
+    config = Config()
+    dbConn = Database(config)
+    sampler = TableSampler(dbConn)
+
+    def _print_stats(name, timings, numFallbacks=None):
+        timings = np.array(timings) * 1000
+        line = '\t{:<14} mean {:8.2f}, p50 {:8.2f}, p95 {:8.2f}, p99 {:8.2f}, max {:8.2f} ms'.format(
+            name,
+            np.mean(timings),
+            np.percentile(timings, 50),
+            np.percentile(timings, 95),
+            np.percentile(timings, 99),
+            np.max(timings)
+        )
+        if numFallbacks is not None:
+            line += f' ({numFallbacks} fallbacks)'
+        print(line)
+
+    for size in args.sizes:
+        tableName = 'aide_benchmark_' + uuid.uuid4().hex
+        tableID = sql.Identifier('public', tableName)
+        try:
+            dbConn.execute(sql.SQL('''
+                CREATE TABLE {table} (
+                    id uuid DEFAULT uuid_generate_v4(),
+                    filename VARCHAR NOT NULL,
+                    last_requested TIMESTAMPTZ,
+                    PRIMARY KEY (id)
+                );
+                INSERT INTO {table} (filename, last_requested)
+                SELECT 'image_' || s || '.jpg',
+                    CASE WHEN random() < %s THEN NOW() ELSE NULL END
+                FROM generate_series(1, %s) AS s;
+                ANALYZE {table};
+            ''').format(table=tableID), (args.requested_fraction, size,), None)
+
+            queryFull = sql.SQL('''
+                SELECT id, filename FROM {table}
+                WHERE last_requested IS NULL
+                ORDER BY RANDOM()
+                LIMIT %s;
+            ''').format(table=tableID)
+            querySampled = sql.SQL('''
+                SELECT id, filename FROM {table}
+                TABLESAMPLE SYSTEM (%s)
+                WHERE last_requested IS NULL
+                ORDER BY RANDOM()
+                LIMIT %s;
+            ''').format(table=tableID)
+
+            print(f'{size} images ({sampler.estimate_rows("public", tableName)} estimated):')
+            timings = []
+            for _ in range(args.num_queries):
+                t0 = time.perf_counter()
+                dbConn.execute(queryFull, (args.limit,), 'all')
+                timings.append(time.perf_counter() - t0)
+            _print_stats('ORDER BY', timings)
+
+            timings = []
+            numFallbacks = 0
+            for _ in range(args.num_queries):
+                t0 = time.perf_counter()
+                percentage = sampler.get_percentage('public', args.limit, tableName)
+                if percentage is None:
+                    result = dbConn.execute(queryFull, (args.limit,), 'all')
+                else:
+                    result = dbConn.execute(querySampled, (percentage, args.limit,), 'all')
+                    sampler.report('public', args.limit, len(result), tableName)
+                    if len(result) < args.limit:
+                        numFallbacks += 1
+                        result = dbConn.execute(queryFull, (args.limit,), 'all')
+                timings.append(time.perf_counter() - t0)
+            _print_stats('TABLESAMPLE', timings, numFallbacks)
+
+        finally:
+            dbConn.execute(sql.SQL('DROP TABLE IF EXISTS {};').format(tableID), None, None)
@@ -0,0 +1,153 @@
+'''
+    Microbenchmark for the conversion of LabelUI batch query results into
+    the response format of the labeling interface. Compares the previous
+    per-row assembly on dict rows (column names looked up and values type-
+    checked for every row) with the "RowAssembler" on tuple rows in chunks,
+    on synthetic rows of images with many bounding boxes. Verifies that both
+    produce the same output. Does not require a database.
+
+    Usage:
+        python benchmarks/row_assembler.py --num_images 128 --num_boxes 300
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import argparse
+import random
+import time
+import timeit
+from uuid import UUID, uuid4
+from datetime import datetime
+
+
+def _assemble_legacy(sqlBuilder, annotationType, predictionType, rows, hideGoldenQuestionInfo):
+    '''
+        Previous implementation of "DBMiddleware._assemble_annotations".
+    '''
+    response = {}
+    for b in rows:
+        imgID = str(b['image'])
+        if not imgID in response:
+            response[imgID] = {
+                'fileName': b['filename'],
+                'predictions': {},
+                'annotations': {},
+                'last_checked': None
+            }
+        viewcount = b['viewcount']
+        if viewcount is not None:
+            response[imgID]['viewcount'] = viewcount
+        last_checked = b['last_checked']
+        if last_checked is not None:
+            if response[imgID]['last_checked'] is None:
+                response[imgID]['last_checked'] = last_checked
+            else:
+                response[imgID]['last_checked'] = max(response[imgID]['last_checked'], last_checked)
+
+        if not hideGoldenQuestionInfo:
+            response[imgID]['isGoldenQuestion'] = b['isgoldenquestion']
+
+        entryID = str(b['id'])
+        if b['ctype'] is not None:
+            colnames = sqlBuilder.getColnames(annotationType, predictionType, b['ctype'])
+            entry = {}
+            for c in colnames:
+                value = b[c]
+                if isinstance(value, datetime):
+                    value = value.timestamp()
+                elif isinstance(value, UUID):
+                    value = str(value)
+                entry[c] = value
+
+            if b['ctype'] == 'annotation':
+                response[imgID]['annotations'][entryID] = entry
+            elif b['ctype'] == 'prediction':
+                response[imgID]['predictions'][entryID] = entry
+
+    return response
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Microbenchmark of the LabelUI row assembly.')
+    parser.add_argument('--num_images', type=int, default=128, const=1, nargs='?',
+                    help='Number of images per batch (default: 128).')
+    parser.add_argument('--num_boxes', type=int, default=300, const=1, nargs='?',
+                    help='Number of annotations and predictions each per image (default: 300).')
+    parser.add_argument('--itersize', type=int, default=2000, const=1, nargs='?',
+                    help='Number of rows per chunk (default: 2000).')
+    parser.add_argument('--repeats', type=int, default=5, const=1, nargs='?',
+                    help='Number of timed repetitions (default: 5).')
+    args = parser.parse_args()
+
+    if not 'AIDE_MODULES' in os.environ:
+        os.environ['AIDE_MODULES'] = ''     # for compatibility with Celery worker import
+
+    from constants.dbFieldNames import FieldNames_annotation, FieldNames_prediction
+    from modules.LabelUI.backend.sql_string_builder import SQLStringBuilder
+    from modules.LabelUI.backend.row_assembler import RowAssembler
+
+    annotationType = predictionType = 'boundingBoxes'
+    sqlBuilder = SQLStringBuilder()
+    assembler = RowAssembler(sqlBuilder)
+
+    # result columns in the order of the batch queries
+    OID_UUID, OID_OTHER = 2950, 0
+    fieldsUnion = FieldNames_annotation.boundingBoxes.value.union(FieldNames_prediction.boundingBoxes.value)
+    columns = [('id', OID_UUID), ('image', OID_UUID), ('ctype', OID_OTHER), ('viewcount', OID_OTHER),
+        ('last_checked', OID_OTHER), ('filename', OID_OTHER), ('isgoldenquestion', OID_OTHER)]
+    for f in sorted(fieldsUnion):
+        columns.append((f, (OID_UUID if f == 'label' else OID_OTHER)))
+    columns = tuple(columns)
+    colnames = [c[0] for c in columns]
+
+    # synthetic rows
+    print(f'Generating {args.num_images} images with {args.num_boxes} annotations and predictions each...')
+    labels = [uuid4() for _ in range(10)]
+    now = time.time()
+    rows = []
+    for i in range(args.num_images):
+        imgID = uuid4()
+        filename = f'images/image_{i}.jpg'
+        for cType in ('annotation', 'prediction'):
+            for _ in range(args.num_boxes):
+                values = {
+                    'id': uuid4(),
+                    'image': imgID,
+                    'ctype': cType,
+                    'viewcount': random.randint(0, 3),
+                    'last_checked': now - random.randint(0, 10000),
+                    'filename': filename,
+                    'isgoldenquestion': False,
+                    'label': random.choice(labels),
+                    'x': random.random(),
+                    'y': random.random(),
+                    'width': random.random(),
+                    'height': random.random(),
+                    'unsure': False,
+                    'meta': None,
+                    'confidence': (random.random() if cType == 'prediction' else None),
+                    'priority': (random.random() if cType == 'prediction' else None)
+                }
+                rows.append(tuple(values.get(c, None) for c in colnames))
+    dictRows = [dict(zip(colnames, r)) for r in rows]
+    chunks = [(columns, rows[i:i+args.itersize]) for i in range(0, len(rows), args.itersize)]
+    print(f'{len(rows)} rows in {len(chunks)} chunks.')
+
+    # verify equivalence
+    resultLegacy = _assemble_legacy(sqlBuilder, annotationType, predictionType, dictRows, False)
+    resultNew = assembler.assemble(chunks, annotationType, predictionType, False)
+    if resultLegacy != resultNew:
+        raise Exception('Outputs of legacy and new row assembly differ.')
+    print('Outputs are identical.')
+
+    # time
+    tLegacy = min(timeit.repeat(lambda: _assemble_legacy(sqlBuilder, annotationType, predictionType, dictRows, True),
+                    number=1, repeat=args.repeats))
+    tNew = min(timeit.repeat(lambda: assembler.assemble(chunks, annotationType, predictionType, True),
+                    number=1, repeat=args.repeats))
+    print(f'Legacy (dict rows):    {tLegacy*1000:.1f} ms ({len(rows)/tLegacy:.0f} rows/s)')
+    print(f'RowAssembler (tuples): {tNew*1000:.1f} ms ({len(rows)/tNew:.0f} rows/s)')
+    print(f'Speedup: {tLegacy/tNew:.2f}x')
@@ -0,0 +1,122 @@
+'''
+    Benchmark of the segmentation mask statistics of the project statistics
+    (see "modules/ProjectStatistics/backend/segmentationEvaluation.py").
+    Generates random pairs of segmentation masks (as base64-encoded strings,
+    like they are stored in the database) and evaluates them:
+    1. with one boolean product per label class and pair (previous method)
+    2. with one confusion matrix per pair, in the current process
+    3. with one confusion matrix per pair, distributed over a process pool
+    Reports the time taken by each and verifies that all of them yield the
+    same values.
+
+    Does not access the database.
+
+    Usage:
+        python benchmarks/segmentation_statistics.py --num_pairs 2000 --num_classes 10
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import argparse
+import base64
+import time
+import numpy as np
+
+
+def _evaluate_per_class(row, classIndices):
+    '''
+        Previous method: three boolean products per label class.
+    '''
+    from util.helpers import base64ToImage
+    mask_target = np.array(base64ToImage(row['q1segmask'], row['q1width'], row['q1height']))
+    mask_source = np.array(base64ToImage(row['q2segmask'], row['q2width'], row['q2height']))
+    if mask_target.shape != mask_source.shape or not np.any(mask_target) or not np.any(mask_source):
+        return None, None
+    oa = None
+    intersection = (mask_target>0) * (mask_source>0)
+    if np.any(intersection):
+        oa = np.mean(mask_target[intersection] == mask_source[intersection])
+    counts = []
+    for idx in classIndices:
+        tp = np.sum((mask_target==idx) * (mask_source==idx))
+        fp = np.sum((mask_target!=idx) * (mask_source==idx))
+        fn = np.sum((mask_target==idx) * (mask_source!=idx))
+        counts.append((tp, fp, fn))
+    return oa, np.array(counts)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Measure the speed of segmentation mask statistics.')
+    parser.add_argument('--settings_filepath', type=str, default='config/settings.ini', const=1, nargs='?',
+                    help='Manual specification of the directory of the settings.ini file; only considered if environment variable unset (default: "config/settings.ini").')
+    parser.add_argument('--num_pairs', type=int, default=2000, const=1, nargs='?',
+                    help='Number of pairs of segmentation masks (default: 2000).')
+    parser.add_argument('--num_classes', type=int, default=10, const=1, nargs='?',
+                    help='Number of label classes (default: 10).')
+    parser.add_argument('--size', type=int, default=512, const=1, nargs='?',
+                    help='Width and height of the segmentation masks in pixels (default: 512).')
+    parser.add_argument('--num_workers', type=int, default=0, const=1, nargs='?',
+                    help='Number of processes of the pool (default: 0 = number of CPU cores, at most 4).')
+    args = parser.parse_args()
+
+    if not 'AIDE_CONFIG_PATH' in os.environ:
+        os.environ['AIDE_CONFIG_PATH'] = str(args.settings_filepath)
+    if not 'AIDE_MODULES' in os.environ:
+        os.environ['AIDE_MODULES'] = ''     # for compatibility with Celery worker import
+
+    from modules.ProjectStatistics.backend import segmentationEvaluation
+
+    # random masks: blocks of label classes with unlabeled areas; source masks
+    # are noisy copies of the target masks
+    rng = np.random.default_rng(0)
+    classIndices = list(range(1, args.num_classes + 1))
+    blockSize = max(1, args.size // 16)
+    masks = []
+    for _ in range(min(args.num_pairs, 50)):
+        blocks = rng.integers(0, args.num_classes + 1, (16, 16), dtype=np.uint8)
+        target = np.kron(blocks, np.ones((blockSize, blockSize), dtype=np.uint8))[:args.size, :args.size]
+        target = np.pad(target, ((0, args.size - target.shape[0]), (0, args.size - target.shape[1])))
+        source = target.copy()
+        noise = rng.random(target.shape) < 0.1
+        source[noise] = rng.integers(0, args.num_classes + 1, np.sum(noise), dtype=np.uint8)
+        masks.append((base64.b64encode(target.tobytes()).decode('utf-8'),
+                        base64.b64encode(source.tobytes()).decode('utf-8')))
+    rows = [{
+        'username': f'user{i % 4}',
+        'q1segmask': masks[i % len(masks)][0],
+        'q1width': args.size,
+        'q1height': args.size,
+        'q2segmask': masks[i % len(masks)][1],
+        'q2width': args.size,
+        'q2height': args.size
+    } for i in range(args.num_pairs)]
+
+    def _totals(results):
+        oa, counts = 0.0, np.zeros((len(classIndices), 3), dtype=np.int64)
+        for r in results:
+            if r[0] is not None:
+                oa += r[0]
+            if r[1] is not None:
+                counts += r[1]
+        return oa, counts
+
+    print(f'{args.num_pairs} pairs of {args.size}x{args.size} masks with {args.num_classes} label classes:')
+
+    t0 = time.perf_counter()
+    reference = _totals([_evaluate_per_class(r, classIndices) for r in rows])
+    print(f'\tper-class products:            {time.perf_counter() - t0:8.3f}s')
+
+    pool = segmentationEvaluation.create_pool(args.num_workers)
+    for name, p in (('confusion matrix, 1 process', None), ('confusion matrix, pool', pool)):
+        t0 = time.perf_counter()
+        results = list(segmentationEvaluation.evaluate(iter(rows), 'username', classIndices, p))
+        tTotal = time.perf_counter() - t0
+        totals = _totals([(r['overall_accuracy'], r['counts']) for r in results])
+        equal = np.isclose(totals[0], reference[0]) and np.array_equal(totals[1], reference[1])
+        print(f'\t{name + ":":<30} {tTotal:8.3f}s ({"equal" if equal else "MISMATCH"})')
+
+    if pool is not None:
+        pool.close()
+        pool.join()
@@ -0,0 +1,69 @@
+'''
+    Benchmark of the result cache of the project statistics. Simulates
+    repeated views of the performance statistics page (and completion
+    checks of the target user) without and with the cache and reports the
+    latency of each request.
+
+    Only reads from the database; the results are recomputed whenever the
+    project data changes in the meantime.
+
+    Usage:
+        python benchmarks/statistics_cache.py --project test --target admin --entities user1,user2
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import argparse
+import time
+import numpy as np
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Measure the latency of repeated statistics requests with and without caching.')
+    parser.add_argument('--settings_filepath', type=str, default='config/settings.ini', const=1, nargs='?',
+                    help='Manual specification of the directory of the settings.ini file; only considered if environment variable unset (default: "config/settings.ini").')
+    parser.add_argument('--project', type=str,
+                    help='Shortname of the project to evaluate.')
+    parser.add_argument('--target', type=str,
+                    help='Name of the user whose annotations serve as the reference.')
+    parser.add_argument('--entities', type=str,
+                    help='Comma-separated list of user names or model state IDs to evaluate.')
+    parser.add_argument('--entity_type', type=str, default='user', const=1, nargs='?',
+                    help='Type of the evaluated entities: "user" or "model" (default: "user").')
+    parser.add_argument('--threshold', type=float, default=0.5, const=1, nargs='?',
+                    help='Minimum IoU, resp. maximum distance for a match (default: 0.5).')
+    parser.add_argument('--num_requests', type=int, default=20, const=1, nargs='?',
+                    help='Number of simulated page views (default: 20).')
+    args = parser.parse_args()
+
+    if not 'AIDE_CONFIG_PATH' in os.environ:
+        os.environ['AIDE_CONFIG_PATH'] = str(args.settings_filepath)
+    if not 'AIDE_MODULES' in os.environ:
+        os.environ['AIDE_MODULES'] = ''     # for compatibility with Celery worker import
+
+    from util.configDef import Config
+    from modules.ProjectStatistics.backend.middleware import ProjectStatisticsMiddleware
+    from modules.ProjectStatistics.backend.resultCache import ResultCache
+
+    config = Config()
+    middleware = ProjectStatisticsMiddleware(config)
+    entities = [e.strip() for e in args.entities.split(',') if len(e.strip())]
+
+    for name, cacheSize in (('uncached', 0), ('cached', 256)):
+        middleware.resultCache = ResultCache(cacheSize)
+        timings = []
+        for _ in range(args.num_requests):
+            t0 = time.perf_counter()
+            middleware.getPerformanceStatistics(args.project, entities, args.target, args.entity_type, args.threshold, False)
+            middleware.getUserFinished(args.project, args.target)
+            timings.append(time.perf_counter() - t0)
+        timings = np.array(timings) * 1000
+        print('{:<9} first {:9.3f}, mean of others {:9.3f}, max of others {:9.3f} ms'.format(
+            name + ':',
+            timings[0],
+            np.mean(timings[1:]) if len(timings) > 1 else np.nan,
+            np.max(timings[1:]) if len(timings) > 1 else np.nan
+        ))
+        print(f'\tcache statistics: {middleware.resultCache.get_statistics()}')
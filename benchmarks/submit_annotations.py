@@ -0,0 +1,136 @@
+'''
+    Benchmark for the latency of annotation submissions under concurrent
+    load. Simulates a number of annotators that repeatedly submit batches
+    of (synthetic) annotations for random images of a project through
+    "DBMiddleware.submitAnnotations" and reports latency percentiles.
+
+    WARNING: this writes annotations into the given project. They are
+    tagged through the "meta" field and removed again at the end, but you
+    should still only run the benchmark against a test project.
+
+    Usage:
+        python benchmarks/submit_annotations.py --project test --username admin
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import argparse
+import json
+import random
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import pytz
+import numpy as np
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Measure latency of annotation submissions under concurrent load.')
+    parser.add_argument('--settings_filepath', type=str, default='config/settings.ini', const=1, nargs='?',
+                    help='Manual specification of the directory of the settings.ini file; only considered if environment variable unset (default: "config/settings.ini").')
+    parser.add_argument('--project', type=str,
+                    help='Shortname of the (test) project to submit annotations to.')
+    parser.add_argument('--username', type=str,
+                    help='Name of an existing user account under which annotations are submitted.')
+    parser.add_argument('--num_users', type=int, default=20, const=1, nargs='?',
+                    help='Number of concurrently submitting annotators (default: 20).')
+    parser.add_argument('--num_requests', type=int, default=50, const=1, nargs='?',
+                    help='Number of submissions per annotator (default: 50).')
+    parser.add_argument('--batch_size', type=int, default=4, const=1, nargs='?',
+                    help='Number of images per submission (default: 4).')
+    parser.add_argument('--num_annotations', type=int, default=10, const=1, nargs='?',
+                    help='Number of annotations per image (default: 10).')
+    args = parser.parse_args()
+
+    if not 'AIDE_CONFIG_PATH' in os.environ:
+        os.environ['AIDE_CONFIG_PATH'] = str(args.settings_filepath)
+    if not 'AIDE_MODULES' in os.environ:
+        os.environ['AIDE_MODULES'] = ''     # for compatibility with Celery worker import
+
+    from psycopg2 import sql
+    from util.configDef import Config
+    from modules.LabelUI.backend.middleware import DBMiddleware
+
+    config = Config()
+    middleware = DBMiddleware(config)
+    dbConnector = middleware.dbConnector
+
+    annoType = middleware.get_project_immutables(args.project)['annotationType']
+    if annoType == 'segmentationMasks':
+        raise Exception('Segmentation masks are not supported by this benchmark.')
+
+    images = dbConnector.execute(sql.SQL('SELECT id FROM {} LIMIT 10000;').format(
+        sql.Identifier(args.project, 'image')), None, 'all')
+    images = [str(i['id']) for i in images]
+    labels = dbConnector.execute(sql.SQL('SELECT id FROM {};').format(
+        sql.Identifier(args.project, 'labelclass')), None, 'all')
+    labels = [str(l['id']) for l in labels]
+    if not len(images) or not len(labels):
+        raise Exception(f'Project "{args.project}" needs to contain images and label classes.')
+
+    meta = {'benchmark': 'submit_annotations'}
+
+    def _make_submission():
+        entries = {}
+        for imgID in random.sample(images, min(args.batch_size, len(images))):
+            annotations = []
+            for a in range(args.num_annotations):
+                geometry = {}
+                if annoType in ('points', 'boundingBoxes'):
+                    geometry['x'] = random.random()
+                    geometry['y'] = random.random()
+                if annoType == 'boundingBoxes':
+                    geometry['width'] = random.random() * 0.2
+                    geometry['height'] = random.random() * 0.2
+                annotations.append({
+                    'id': f'new_{a}',
+                    'label': random.choice(labels),
+                    'timeCreated': datetime.now(tz=pytz.utc).isoformat(),
+                    'timeRequired': random.randint(100, 5000),
+                    'geometry': geometry
+                })
+            entries[imgID] = {
+                'timeCreated': datetime.now(tz=pytz.utc).isoformat(),
+                'timeRequired': random.randint(1000, 20000),
+                'numInteractions': args.num_annotations,
+                'annotations': annotations
+            }
+        return {'entries': entries, 'meta': meta}
+
+    def _annotator(idx):
+        latencies = []
+        for _ in range(args.num_requests):
+            submission = _make_submission()
+            t0 = time.perf_counter()
+            middleware.submitAnnotations(args.project, args.username, submission)
+            latencies.append(time.perf_counter() - t0)
+        return latencies
+
+    try:
+        print(f'Simulating {args.num_users} annotators with {args.num_requests} submissions each...')
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.num_users) as executor:
+            results = list(executor.map(_annotator, range(args.num_users)))
+        tTotal = time.perf_counter() - t0
+
+        latencies = np.array([l for r in results for l in r]) * 1000
+        print(f'{len(latencies)} submissions in {tTotal:.2f} s ({len(latencies)/tTotal:.1f} submissions/s)')
+        print('Latency (ms): mean {:.1f}, p50 {:.1f}, p95 {:.1f}, p99 {:.1f}, max {:.1f}'.format(
+            np.mean(latencies),
+            np.percentile(latencies, 50),
+            np.percentile(latencies, 95),
+            np.percentile(latencies, 99),
+            np.max(latencies)
+        ))
+
+    finally:
+        print('Removing benchmark annotations...')
+        dbConnector.execute(sql.SQL('''
+            DELETE FROM {id_anno} WHERE username = %s AND meta = %s;
+            DELETE FROM {id_iu} WHERE username = %s AND meta = %s;
+        ''').format(
+            id_anno=sql.Identifier(args.project, 'annotation'),
+            id_iu=sql.Identifier(args.project, 'image_user')
+        ), (args.username, json.dumps(meta), args.username, json.dumps(meta)), None)
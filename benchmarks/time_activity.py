@@ -0,0 +1,84 @@
+'''
+    Benchmark of the activity histograms of the project statistics. Queries
+    the number of images viewed and annotations made per day over the last
+    days of a project:
+    1. by grouping the "image_user" and "annotation" tables (previous method)
+    2. from the hourly activity rollup (see "util/activityRollup.py")
+    Reports the latency of each and verifies that both yield the same
+    counts.
+
+    Only reads from the database; the rollup must have been installed (e.g.
+    with "setup/rebuild_counters.py").
+
+    Usage:
+        python benchmarks/time_activity.py --project test --num_days 31
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import argparse
+import time
+from datetime import datetime, timedelta
+import numpy as np
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Measure the latency of activity histograms with and without the rollup.')
+    parser.add_argument('--settings_filepath', type=str, default='config/settings.ini', const=1, nargs='?',
+                    help='Manual specification of the directory of the settings.ini file; only considered if environment variable unset (default: "config/settings.ini").')
+    parser.add_argument('--project', type=str,
+                    help='Shortname of the project to query.')
+    parser.add_argument('--num_days', type=int, default=31, const=1, nargs='?',
+                    help='Number of days of the histogram (default: 31).')
+    parser.add_argument('--num_requests', type=int, default=20, const=1, nargs='?',
+                    help='Number of queries per table and method (default: 20).')
+    args = parser.parse_args()
+
+    if not 'AIDE_CONFIG_PATH' in os.environ:
+        os.environ['AIDE_CONFIG_PATH'] = str(args.settings_filepath)
+    if not 'AIDE_MODULES' in os.environ:
+        os.environ['AIDE_MODULES'] = ''     # for compatibility with Celery worker import
+
+    import pytz
+    from psycopg2 import sql
+    from util.configDef import Config
+    from modules import Database
+    from util import activityRollup
+
+    config = Config()
+    dbConn = Database(config)
+    if dbConn.connectionPool is None:
+        raise Exception('Error connecting to database.')
+
+    now = datetime.now(tz=pytz.utc)
+    start = now - timedelta(days=args.num_days-1)
+    end = now + timedelta(microseconds=1)
+
+    for table, (timeField, _, _, _) in activityRollup.SOURCES.items():
+        queryStr = sql.SQL('''
+            SELECT date_trunc('day', {timeField}) AS bucket, COUNT(*) AS cnt
+            FROM {id_table}
+            WHERE {timeField} >= date_trunc('day', %s::TIMESTAMPTZ) AND {timeField} < %s
+            GROUP BY 1
+        ''').format(
+            timeField=sql.SQL(timeField),
+            id_table=sql.Identifier(args.project, table)
+        )
+
+        results = {}
+        for name in ('table scan', 'rollup'):
+            timings = []
+            for _ in range(args.num_requests):
+                t0 = time.perf_counter()
+                if name == 'rollup':
+                    result = activityRollup.get_activity(dbConn, args.project, table, start, end, 'day')
+                else:
+                    result = dbConn.execute(queryStr, (start, end), 'all')
+                timings.append(time.perf_counter() - t0)
+            results[name] = {r['bucket']: r['cnt'] for r in result if r['cnt'] > 0}
+            timings = np.array(timings) * 1000
+            print('{:<11} {:<11} mean {:9.3f}, max {:9.3f} ms'.format(
+                table + ':', name + ':', np.mean(timings), np.max(timings)))
+        print('\t{}'.format('equal' if results['table scan'] == results['rollup'] else 'MISMATCH'))
@@ -19,7 +19,7 @@ class AIControllerWorker:
     def __init__(self, config, celery_app):
         self.config = config
         self.dbConn = Database(config)
-        self.sqlBuilder = SQLStringBuilder(config)
+        self.sqlBuilder = SQLStringBuilder(config, self.dbConn)
         self.celery_app = celery_app
 
 
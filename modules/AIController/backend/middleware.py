@@ -24,6 +24,7 @@ from modules.AIController.taskWorkflow.workflowTracker import WorkflowTracker
 from modules.Database.app import Database
 from modules.AIWorker.backend.fileserver import FileServer
 from util.helpers import array_split, parse_parameters, get_class_executable
+from util import projectCache
 
 from .sql_string_builder import SQLStringBuilder
 
@@ -33,7 +34,7 @@ class AIMiddleware():
     def __init__(self, config, passiveMode=False):
         self.config = config
         self.dbConn = Database(config)
-        self.sqlBuilder = SQLStringBuilder(config)
+        self.sqlBuilder = SQLStringBuilder(config, self.dbConn)
         self.passiveMode = passiveMode
         self.scriptPattern = re.compile(r'<script\b[^<]*(?:(?!<\/script>)<[^<]*)*<\/script\.?>')
         self._init_available_ai_models()
@@ -1100,6 +1101,8 @@ class AIMiddleware():
                 ''').format(id_lc=sql.Identifier(project, 'labelclass')),
                 (bgName,), None)
 
+        projectCache.invalidate(self.dbConn, project)
+
         response = {'status': 0}
 
         # check for and verify AI model settings
@@ -9,8 +9,20 @@ from psycopg2 import sql
 
 class SQLStringBuilder:
 
-    def __init__(self, config):
+    def __init__(self, config, dbConnector=None):
         self.config = config
+        self.dbConnector = dbConnector
+        self.queryCache = {}
+
+
+    def _get_cached(self, key, assembleFun, *args):
+        queryStr = self.queryCache.get(key, None)
+        if queryStr is None:
+            queryStr = assembleFun(*args)
+            if self.dbConnector is not None:
+                queryStr = self.dbConnector.render(queryStr)
+            self.queryCache[key] = queryStr
+        return queryStr
 
     
     # def getFixedImageIDQueryString(self, project, ids):
@@ -61,6 +73,11 @@ class SQLStringBuilder:
     
 
     def getInferenceQueryString(self, project, forceUnlabeled=True, limit=None):
+        return self._get_cached(('inference', project, forceUnlabeled, limit is None or limit == -1),
+                        self._assemble_inference_query, project, forceUnlabeled, limit)
+
+
+    def _assemble_inference_query(self, project, forceUnlabeled, limit):
 
         if forceUnlabeled:
             conditionString = sql.SQL('WHERE viewcount IS NULL AND (corrupt IS NULL OR corrupt = FALSE)')
@@ -133,6 +133,43 @@ class AIDEAdmin:
                 abort(404, 'not found')
 
 
+        @self.app.get('/getQueryStatistics')
+        def get_query_statistics():
+            try:
+                if not self.loginCheck(superuser=True):
+                    return redirect('/')
+                try:
+                    limit = int(request.query.get('limit'))
+                except:
+                    limit = None
+                orderBy = request.query.get('order_by', 'total_time')
+                return {'response': self.middleware.getQueryStatistics(limit, orderBy)}
+            except Exception as e:
+                abort(404, 'not found')
+
+
+        @self.app.post('/explainQuery')
+        def explain_query():
+            try:
+                if not self.loginCheck(superuser=True):
+                    return redirect('/')
+
+                try:
+                    data = request.json
+                    callSite = data['call_site']
+                    project = data.get('project', None)
+                    return {'response': self.middleware.explainQuery(callSite, project)}
+                except Exception as e:
+                    return {
+                        'response': {
+                            'success': False,
+                            'message': str(e)
+                        }
+                    }
+            except Exception as e:
+                abort(404, 'not found')
+
+
         @self.app.post('/setCanCreateProjects')
         def set_can_create_projects():
             try:
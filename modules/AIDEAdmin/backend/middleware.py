@@ -7,11 +7,10 @@
 
 import os
 import requests
-from psycopg2 import sql
 from celery import current_app
 from constants.version import AIDE_VERSION
 from modules.Database.app import Database
-from util import celeryWorkerCommons
+from util import celeryWorkerCommons, authCache, projectCounters
 from util.helpers import is_localhost
 
 
@@ -156,51 +155,18 @@ class AdminMiddleware:
             projects[r['shortname']] = projDef
         
         # get statistics (number of annotations, predictions, prediction models, etc.)
+        counters = projectCounters.get_counters(self.dbConnector, list(projects.keys()))
         for project in projects.keys():
-            stats = self.dbConnector.execute(sql.SQL('''
-                    SELECT COUNT(*) AS count
-                    FROM {id_img}
-                    UNION ALL
-                    SELECT COUNT(*)
-                    FROM {id_anno}
-                    UNION ALL
-                    SELECT COUNT(*)
-                    FROM {id_pred}
-                    UNION ALL
-                    SELECT SUM(viewcount)
-                    FROM {id_iu}
-                    UNION ALL
-                    SELECT COUNT(*)
-                    FROM {id_cnnstate}
-                ''').format(
-                    id_img=sql.Identifier(project, 'image'),
-                    id_anno=sql.Identifier(project, 'annotation'),
-                    id_pred=sql.Identifier(project, 'prediction'),
-                    id_iu=sql.Identifier(project, 'image_user'),
-                    id_cnnstate=sql.Identifier(project, 'cnnstate')
-                ), None, 'all')
-            projects[project]['num_img'] = stats[0]['count']
-            projects[project]['num_anno'] = stats[1]['count']
-            projects[project]['num_pred'] = stats[2]['count']
-            projects[project]['total_viewcount'] = stats[3]['count']
-            projects[project]['num_cnnstates'] = stats[4]['count']
+            projCounters = counters[project]
+            projects[project]['num_img'] = projectCounters.get_total(projCounters, 'num_images')
+            projects[project]['num_anno'] = projectCounters.get_total(projCounters, 'num_annotations')
+            projects[project]['num_pred'] = projectCounters.get_total(projCounters, 'num_predictions')
+            projects[project]['total_viewcount'] = projectCounters.get_total(projCounters, 'viewcount')
+            projects[project]['num_cnnstates'] = projectCounters.get_total(projCounters, 'num_cnnstates')
 
             # time statistics (last viewed)
-            stats = self.dbConnector.execute(sql.SQL('''
-                SELECT MIN(first_checked) AS first_checked,
-                    MAX(last_checked) AS last_checked
-                FROM {id_iu};
-            ''').format(
-                id_iu=sql.Identifier(project, 'image_user')
-            ), None, 1)
-            try:
-                projects[project]['first_checked'] = stats[0]['first_checked'].timestamp()
-            except:
-                projects[project]['first_checked'] = None
-            try:
-                projects[project]['last_checked'] = stats[0]['last_checked'].timestamp()
-            except:
-                projects[project]['last_checked'] = None
+            projects[project]['first_checked'] = projectCounters.get_total(projCounters, 'first_checked', None)
+            projects[project]['last_checked'] = projectCounters.get_total(projCounters, 'last_checked', None)
 
         return projects
 
@@ -259,8 +225,73 @@ class AdminMiddleware:
             FROM aide_admin.user
             WHERE name = %s;
         ''', (allowCreateProjects, username, username), 1)
+        authCache.invalidate(username=username)
         result = result[0]['cancreateprojects']
         return {
             'success': (result == allowCreateProjects)
         }
-        
\ No newline at end of file
+        
+
+    def getQueryStatistics(self, limit=None, orderBy='total_time'):
+        '''
+            Returns the statistics of the database queries run by this
+            process (per call site, sorted by "orderBy"), together with
+            the usage of the connection pool. Query statistics are only
+            available if "instrumentation" is enabled in the [Database]
+            section of the configuration file.
+        '''
+        queryStats = self.dbConnector.get_query_statistics(limit, orderBy)
+        if queryStats is None:
+            return {
+                'success': False,
+                'message': 'Query instrumentation is disabled. Set "instrumentation = true" in the [Database] section of the configuration file to enable it.'
+            }
+        return {
+            'success': True,
+            'queries': queryStats,
+            'pool': self.dbConnector.get_pool_statistics()
+        }
+
+
+    def explainQuery(self, callSite, project):
+        '''
+            Runs the query recorded at the given call site for the given
+            project with "EXPLAIN (ANALYZE, BUFFERS)" and returns its query
+            plan. If the call site has not (yet) been run for the project,
+            a query recorded for another project is used with its schema
+            replaced.
+        '''
+        if self.dbConnector.instrumentation is None:
+            return {
+                'success': False,
+                'message': 'Query instrumentation is disabled.'
+            }
+        if project is not None:
+            projectExists = self.dbConnector.execute('''
+                SELECT shortname FROM aide_admin.project
+                WHERE shortname = %s;
+            ''', (project,), 1)
+            if projectExists is None or not len(projectExists):
+                return {
+                    'success': False,
+                    'message': f'Project "{project}" does not exist.'
+                }
+        sample = self.dbConnector.instrumentation.get_sample(callSite, project)
+        if sample is None:
+            return {
+                'success': False,
+                'message': f'No query recorded for call site "{callSite}".'
+            }
+        queryStr, arguments = sample
+        try:
+            plan = self.dbConnector.explain(queryStr, arguments)
+        except Exception as e:
+            return {
+                'success': False,
+                'message': str(e)
+            }
+        return {
+            'success': True,
+            'query': queryStr,
+            'plan': plan
+        }
@@ -28,6 +28,7 @@ from celery import current_task, states
 import psycopg2
 from psycopg2 import sql
 from util.helpers import current_time, array_split
+from util import imageStats
 from constants.dbFieldNames import FieldNames_annotation, FieldNames_prediction
 
 
@@ -427,13 +428,10 @@ def _call_inference(project, imageIDs, epoch, numEpochs, inferenceFun, rankFun,
                 # ''').format(sql.Identifier(project, 'prediction'))
                 # dbConnector.insert(queryStr, (ids_img,))
                 
-                queryStr = sql.SQL('''
-                    INSERT INTO {id_pred} ( {fieldNames} )
-                    VALUES %s;
-                ''').format(
-                    id_pred=sql.Identifier(project, 'prediction'),
-                    fieldNames=sql.SQL(',').join([sql.SQL(f) for f in fieldNames]))
-                dbConnector.insert(queryStr, values_pred)
+                dbConnector.copy_rows(sql.Identifier(project, 'prediction'), fieldNames, values_pred)
+
+                # update per-image aggregates used for batch ranking
+                dbConnector.execute(imageStats.prediction_stats_statement(project, stateDictID, result.keys()), None, None)
 
             if len(values_img):
                 queryStr = sql.SQL('''
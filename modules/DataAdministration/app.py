@@ -13,6 +13,7 @@ import datetime
 import tempfile
 import uuid
 import json
+import html
 from bottle import static_file, request, response, abort
 import requests
 from .backend.middleware import DataAdministrationMiddleware
@@ -377,6 +378,42 @@ class DataAdministrator:
                 abort(401, str(e))
         
 
+        # bulk conversion of predictions to annotations
+        @enable_cors
+        @self.app.post('/<project>/convertPredictions')
+        def convertPredictions(project):
+            '''
+                Launches a task that converts model predictions into anno-
+                tations of the current user. Optional parameters:
+                - cnnstate: ID of the model state (default: latest one)
+                - min_confidence: minimum prediction confidence
+                - images: list of image IDs to limit the conversion to
+                Returns the task ID, whose progress can be queried through
+                "pollStatus".
+            '''
+            if not self.loginCheck(project=project, admin=True):
+                abort(401, 'forbidden')
+
+            try:
+                username = html.escape(request.get_cookie('username'))
+                params = request.json
+                if params is None:
+                    params = {}
+                cnnstate = params.get('cnnstate', None)
+                minConfidence = params.get('min_confidence', None)
+                imageList = params.get('images', None)
+
+                taskID = self.middleware.convertPredictions(project,
+                                                        username,
+                                                        cnnstate,
+                                                        minConfidence,
+                                                        imageList)
+                return {'response': taskID}
+
+            except Exception as e:
+                abort(400, str(e))
+
+
         @enable_cors
         @self.app.route('/<project>/downloadData/<filename:re:.*>')
         def downloadData(project, filename):
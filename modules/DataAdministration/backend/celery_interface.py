@@ -62,6 +62,11 @@ def prepareDataDownload(project, dataType='annotation', userList=None, dateRange
     return worker.prepareDataDownload(project, dataType, userList, dateRange, extraFields, segmaskFilenameOptions, segmaskEncoding)
 
 
+@current_app.task(name='DataAdministration.convert_predictions')
+def convertPredictions(project, username, cnnstate=None, minConfidence=None, imageList=None):
+    return worker.convertPredictions(project, username, cnnstate, minConfidence, imageList)
+
+
 @current_app.task(name='DataAdministration.watch_image_folders', rate_limit=1)
 def watchImageFolders():
     return worker.watchImageFolders()
@@ -18,14 +18,16 @@ import zlib
 from datetime import datetime
 import pytz
 from uuid import UUID
-from celery import current_app
+from celery import current_app, current_task
 from kombu import Queue
 from PIL import Image
 from psycopg2 import sql
 from modules.Database.app import Database
 from modules.LabelUI.backend.annotation_sql_tokens import QueryStrings_annotation, QueryStrings_prediction
+from modules.ProjectAdministration.backend.db_fields import Fields_annotation, Fields_prediction
 from util.helpers import valid_image_extensions, listDirectory, base64ToImage
 from util.imageSharding import split_image
+from util import imageStats, authCache
 
 
 class DataWorker:
@@ -829,44 +831,39 @@ class DataWorker:
             mainFile = open(destPath, 'w')
         metaStr = '; '.join(queryFields) + '\n'
 
-        with self.dbConnector.execute_cursor(queryStr, tuple(queryArgs)) as cursor:
-            while True:
-                b = cursor.fetchone()
-                if b is None:
-                    break
-
-                if is_segmentation:
-                    # convert and store segmentation mask separately
-                    segmask_filename = 'segmentation_masks/'
-
-                    if segmaskFilenameOptions['baseName'] == 'id':
-                        innerFilename = b['image']
-                        parent = ''
-                    else:
-                        innerFilename = b['filename']
-                        parent, innerFilename = os.path.split(innerFilename)
-                    finalFilename = os.path.join(parent, segmaskFilenameOptions['prefix'] + innerFilename + segmaskFilenameOptions['suffix'] +'.tif')
-                    segmask_filename += finalFilename
-
-                    segmask = base64ToImage(b['segmentationmask'], b['width'], b['height'])
-
-                    if indexedColors is not None and len(indexedColors)>0:
-                        # convert to indexed color and add color palette from label classes
-                        segmask = segmask.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=3)
-                        segmask.putpalette(indexedColors)
-
-                    # save
-                    bio = io.BytesIO()
-                    segmask.save(bio, 'TIFF')
-                    mainFile.writestr(segmask_filename, bio.getvalue())
-
-                # store metadata
-                metaLine = ''
-                for field in queryFields:
-                    if field.lower() == 'segmentationmask':
-                        continue
-                    metaLine += '{}; '.format(b[field.lower()])
-                metaStr += metaLine + '\n'
+        for b in self.dbConnector.execute_cursor(queryStr, tuple(queryArgs), stream=True):
+            if is_segmentation:
+                # convert and store segmentation mask separately
+                segmask_filename = 'segmentation_masks/'
+
+                if segmaskFilenameOptions['baseName'] == 'id':
+                    innerFilename = b['image']
+                    parent = ''
+                else:
+                    innerFilename = b['filename']
+                    parent, innerFilename = os.path.split(innerFilename)
+                finalFilename = os.path.join(parent, segmaskFilenameOptions['prefix'] + innerFilename + segmaskFilenameOptions['suffix'] +'.tif')
+                segmask_filename += finalFilename
+
+                segmask = base64ToImage(b['segmentationmask'], b['width'], b['height'])
+
+                if indexedColors is not None and len(indexedColors)>0:
+                    # convert to indexed color and add color palette from label classes
+                    segmask = segmask.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=3)
+                    segmask.putpalette(indexedColors)
+
+                # save
+                bio = io.BytesIO()
+                segmask.save(bio, 'TIFF')
+                mainFile.writestr(segmask_filename, bio.getvalue())
+
+            # store metadata
+            metaLine = ''
+            for field in queryFields:
+                if field.lower() == 'segmentationmask':
+                    continue
+                metaLine += '{}; '.format(b[field.lower()])
+            metaStr += metaLine + '\n'
         
         if is_segmentation:
             mainFile.writestr('query.txt', metaStr)
@@ -899,6 +896,164 @@ class DataWorker:
 
 
 
+    def convertPredictions(self, project, username, cnnstate=None, minConfidence=None, imageList=None, chunkSize=1000):
+        '''
+            Converts model predictions into annotations of user "username"
+            directly in the database (flagged as "autoConverted"), instead
+            of having the labeling interface submit them image by image:
+            - cnnstate: ID of the model state whose predictions are to be
+                        converted, or None for the latest model state
+            - minConfidence: minimum confidence of the predictions to be
+                             converted, or None for all predictions
+            - imageList: iterable of image IDs to limit the conversion to,
+                         or None for all images
+
+            Images the user has already annotated are skipped. For projects
+            with image label annotations, only the most confident prediction
+            per image is converted. Images are processed in chunks of
+            "chunkSize", each with a single INSERT ... SELECT statement;
+            progress is reported to the Celery task after every chunk.
+
+            Returns a dict with the number of images and annotations created.
+        '''
+
+        # check compatibility of prediction and annotation types
+        projTypes = self.dbConnector.execute('''
+            SELECT annotationType, predictionType
+            FROM aide_admin.project
+            WHERE shortname = %s;
+        ''', (project,), 1)
+        if projTypes is None or not len(projTypes):
+            raise Exception('Project "{}" not found.'.format(project))
+        annoType = projTypes[0]['annotationtype']
+        predType = projTypes[0]['predictiontype']
+        annoFields = [f.split(' ')[0] for f in getattr(Fields_annotation, annoType).value]
+        predFields = set([f.split(' ')[0] for f in getattr(Fields_prediction, predType).value])
+        if any([f not in predFields for f in annoFields]):
+            raise Exception('Predictions of type "{}" cannot be converted to annotations of type "{}".'.format(predType, annoType))
+
+        # determine model state
+        if cnnstate is None:
+            result = self.dbConnector.execute(sql.SQL('''
+                SELECT id FROM {id_cnnstate}
+                ORDER BY timeCreated DESC NULLS LAST
+                LIMIT 1;
+            ''').format(
+                id_cnnstate=sql.Identifier(project, 'cnnstate')
+            ), None, 1)
+            if result is None or not len(result):
+                raise Exception('Project "{}" has no model state.'.format(project))
+            cnnstate = result[0]['id']
+        else:
+            cnnstate = UUID(str(cnnstate))
+
+        # optional conditions, shared between the queries below
+        conditions = []
+        conditionArgs = []
+        if minConfidence is not None:
+            conditions.append(sql.SQL('AND pred.confidence >= %s'))
+            conditionArgs.append(float(minConfidence))
+        if imageList is not None:
+            conditions.append(sql.SQL('AND pred.image = ANY(%s::uuid[])'))
+            conditionArgs.append([UUID(str(i)) for i in imageList])
+        conditions = sql.SQL(' ').join(conditions)
+
+        notAnnotated = sql.SQL('''
+            AND NOT EXISTS (
+                SELECT 1 FROM {id_anno} AS anno
+                WHERE anno.image = pred.image
+                AND anno.username = %s
+            )
+        ''').format(
+            id_anno=sql.Identifier(project, 'annotation')
+        )
+
+        # find images to convert
+        result = self.dbConnector.execute(sql.SQL('''
+            SELECT DISTINCT pred.image
+            FROM {id_pred} AS pred
+            WHERE pred.cnnstate = %s
+            {conditions}
+            {notAnnotated}
+            ORDER BY pred.image;
+        ''').format(
+            id_pred=sql.Identifier(project, 'prediction'),
+            conditions=conditions,
+            notAnnotated=notAnnotated
+        ), tuple([cnnstate] + conditionArgs + [username]), 'all')
+        imageIDs = [r['image'] for r in result] if result is not None else []
+        numImages = len(imageIDs)
+
+        if annoType == 'labels':
+            # one label per image
+            distinct = sql.SQL('DISTINCT ON (pred.image)')
+            orderBy = sql.SQL('ORDER BY pred.image, pred.confidence DESC NULLS LAST')
+        else:
+            distinct = sql.SQL('')
+            orderBy = sql.SQL('')
+        queryStr = sql.SQL('''
+            WITH inserted AS (
+                INSERT INTO {id_anno} (username, image, autoConverted, timeCreated, timeRequired, unsure, {fields})
+                SELECT {distinct} %s, pred.image, TRUE, NOW(), 0, FALSE, {predFields}
+                FROM {id_pred} AS pred
+                WHERE pred.cnnstate = %s
+                AND pred.image = ANY(%s::uuid[])
+                {conditions}
+                {notAnnotated}
+                {orderBy}
+                RETURNING image
+            ),
+            viewed AS (
+                INSERT INTO {id_iu} (username, image, first_checked, last_checked, num_interactions)
+                SELECT DISTINCT %s, image, NOW(), NOW(), 0
+                FROM inserted
+                ON CONFLICT (username, image) DO UPDATE SET
+                    last_checked = EXCLUDED.last_checked
+            )
+            SELECT COUNT(*) AS num_anno, COUNT(DISTINCT image) AS num_img
+            FROM inserted;
+        ''').format(
+            id_anno=sql.Identifier(project, 'annotation'),
+            id_pred=sql.Identifier(project, 'prediction'),
+            id_iu=sql.Identifier(project, 'image_user'),
+            fields=sql.SQL(', ').join([sql.SQL(f) for f in annoFields]),
+            predFields=sql.SQL(', ').join([sql.SQL('pred.' + f) for f in annoFields]),
+            distinct=distinct,
+            conditions=conditions,
+            notAnnotated=notAnnotated,
+            orderBy=orderBy
+        )
+
+        def _update_progress(done):
+            if current_task:
+                current_task.update_state(state='PROGRESS', meta={
+                    'done': done,
+                    'total': numImages,
+                    'message': 'converted predictions of {}/{} images'.format(done, numImages)
+                })
+
+        numAnnoCreated = 0
+        numImgCreated = 0
+        _update_progress(0)
+        for idx in range(0, numImages, chunkSize):
+            chunk = imageIDs[idx:idx+chunkSize]
+            with self.dbConnector.transaction() as cursor:
+                cursor.execute(queryStr,
+                    tuple([username, cnnstate, chunk] + conditionArgs + [username, username]))
+                counts = cursor.fetchone()
+                cursor.execute(imageStats.annotation_stats_statement(project, chunk))
+            numAnnoCreated += counts['num_anno']
+            numImgCreated += counts['num_img']
+            _update_progress(min(idx+chunkSize, numImages))
+
+        return {
+            'cnnstate': str(cnnstate),
+            'num_images': numImgCreated,
+            'num_annotations': numAnnoCreated
+        }
+
+
+
     def watchImageFolders(self):
         '''
             Queries all projects that have the image folder watch functionality
@@ -945,6 +1100,7 @@ class DataWorker:
             DELETE FROM aide_admin.project
             WHERE shortname = %s;
         ''', (project, project,), None)     # already done by DataAdministration.middleware, but we do it again to be sure
+        authCache.invalidate(project)
 
         self.dbConnector.execute('''
             DROP SCHEMA IF EXISTS {} CASCADE;
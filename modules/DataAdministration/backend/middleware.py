@@ -282,4 +282,26 @@ class DataAdministrationMiddleware:
                                                     segmaskEncoding)
 
         task_id = self._submit_job(project, process)
-        return task_id
\ No newline at end of file
+        return task_id
+
+
+
+    def convertPredictions(self, project, username, cnnstate=None, minConfidence=None, imageList=None):
+        '''
+            Converts the predictions of a model state ("cnnstate"; None for
+            the latest one) into annotations of the given user in bulk,
+            optionally limited to predictions of a minimum confidence and
+            to a list of images. See "DataWorker.convertPredictions" for
+            details.
+            Returns the ID of the Celery task, which reports the number of
+            images processed so far.
+        '''
+        # submit job
+        process = celery_interface.convertPredictions.si(project,
+                                                    username,
+                                                    cnnstate,
+                                                    minConfidence,
+                                                    imageList)
+
+        task_id = self._submit_job(project, process)
+        return task_id
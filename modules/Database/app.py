@@ -4,18 +4,107 @@
     2019 Benjamin Kellenberger
 '''
 
+import re
+import hashlib
+import inspect
 from contextlib import contextmanager
+from time import perf_counter
+from uuid import UUID, uuid4
+from datetime import date, datetime, time
+import json
 import psycopg2
-from psycopg2.pool import ThreadedConnectionPool
+from psycopg2 import sql, errors
 from psycopg2.extras import RealDictCursor, execute_values
+from .connectionPool import get_pool
+from .instrumentation import QueryStatistics, get_query_statistics
 psycopg2.extras.register_uuid()
 
 
 
+class _CopyStream:
+    '''
+        File-like object that lazily encodes an iterable of row tuples
+        into Postgres' COPY text format, so that it can be consumed by
+        "cursor.copy_expert" without materializing the whole payload.
+    '''
+
+    # characters that need to be escaped in COPY text format
+    ESCAPES = str.maketrans({
+        '\\': '\\\\',
+        '\t': '\\t',
+        '\n': '\\n',
+        '\r': '\\r'
+    })
+
+    def __init__(self, rows, rowsPerChunk=1000):
+        self.rows = iter(rows)
+        self.rowsPerChunk = rowsPerChunk
+        self.buffer = ''
+        self.numRows = 0
+
+
+    @classmethod
+    def encode_value(cls, value):
+        if value is None:
+            return '\\N'
+        elif isinstance(value, bool):
+            return 't' if value else 'f'
+        elif isinstance(value, (datetime, date, time)):
+            return value.isoformat()
+        elif isinstance(value, UUID):
+            return str(value)
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            # bytea in hex format; the backslash needs to be escaped itself
+            return '\\\\x' + bytes(value).hex()
+        elif isinstance(value, psycopg2.Binary):
+            return '\\\\x' + bytes(value.adapted).hex()
+        elif isinstance(value, (dict, list)):
+            value = json.dumps(value)
+        return str(value).translate(cls.ESCAPES)
+
+
+    def _next_chunk(self):
+        lines = []
+        for row in self.rows:
+            lines.append('\t'.join(self.encode_value(v) for v in row))
+            if len(lines) >= self.rowsPerChunk:
+                break
+        self.numRows += len(lines)
+        if not len(lines):
+            return ''
+        return '\n'.join(lines) + '\n'
+
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = self._next_chunk()
+            if not len(chunk):
+                break
+            self.buffer += chunk
+        if size < 0:
+            result, self.buffer = self.buffer, ''
+        else:
+            result, self.buffer = self.buffer[:size], self.buffer[size:]
+        return result
+
+    readline = read
+
+
+
 class Database():
 
-    def __init__(self, config):
+    def __init__(self, config, owner=None):
+        '''
+            All Database instances of a process share one connection pool
+            (per database server and user). "owner" is a name under which
+            this instance's checkouts are recorded in the pool statistics;
+            defaults to the name of the module creating the instance.
+        '''
         self.config = config
+        if owner is None:
+            frame = inspect.currentframe().f_back
+            owner = frame.f_globals.get('__name__', None) if frame is not None else None
+        self.owner = owner
 
         # get DB parameters
         self.database = config.getProperty('Database', 'name').lower()
@@ -24,13 +113,27 @@ class Database():
         self.user = config.getProperty('Database', 'user').lower()
         self.password = config.getProperty('Database', 'password')
 
+        # number of rows fetched per network round trip by server-side cursors
+        self.itersize = config.getProperty('Database', 'cursor_itersize', type=int, fallback=2000)
+
+        # optional query instrumentation (process-wide)
+        if config.getProperty('Database', 'instrumentation', type=bool, fallback=False):
+            self.instrumentation = get_query_statistics(
+                config.getProperty('Database', 'slow_query_threshold', type=float, fallback=500.0)
+            )
+        else:
+            self.instrumentation = None
+
         self._createConnectionPool()
 
 
     def _createConnectionPool(self):
-        self.connectionPool = ThreadedConnectionPool(
+        self.connectionPool = get_pool(
             1,
             self.config.getProperty('Database', 'max_num_connections', type=int, fallback=20),
+            timeout=self.config.getProperty('Database', 'pool_timeout', type=float, fallback=10.0),
+            maxLifetime=self.config.getProperty('Database', 'max_connection_lifetime', type=float, fallback=3600.0),
+            validationInterval=self.config.getProperty('Database', 'pool_validation_interval', type=float, fallback=30.0),
             host=self.host,
             database=self.database,
             port=self.port,
@@ -48,7 +151,7 @@ class Database():
 
     @contextmanager
     def _get_connection(self):
-        conn = self.connectionPool.getconn()
+        conn = self.connectionPool.getconn(owner=self.owner)
         conn.autocommit = True
         try:
             yield conn
@@ -56,97 +159,452 @@ class Database():
             self.connectionPool.putconn(conn, close=False)
 
 
-    def execute(self, query, arguments, numReturn=None):
+    def get_pool_statistics(self):
+        '''
+            Returns counters of the connection pool: number of checkouts,
+            waits for a free connection (and total time spent waiting),
+            timeouts, reconnects, as well as active and idle connections.
+            The pool is shared by all modules of the process; "owners" lists
+            checkouts and active connections per module.
+        '''
+        return self.connectionPool.get_statistics()
+
+
+    def get_query_statistics(self, limit=None, orderBy='total_time'):
+        '''
+            Returns the statistics of the queries run in this process per
+            call site, or None if instrumentation is disabled.
+        '''
+        if self.instrumentation is None:
+            return None
+        return self.instrumentation.get_statistics(limit, orderBy)
+
+
+    def _record_query(self, conn, query, arguments, start, result=None, numRows=None, numBytes=0, callSite=None):
+        '''
+            Records a finished query with the instrumentation. "start" is
+            the value of "perf_counter" at the time the query was issued.
+        '''
+        duration = perf_counter() - start
+        try:
+            queryStr = query.as_string(conn) if isinstance(query, sql.Composable) else query
+            if isinstance(queryStr, bytes):
+                queryStr = queryStr.decode('utf-8')
+            if numRows is None:
+                numRows = 0
+                if isinstance(result, list):
+                    numRows = len(result)
+                    numBytes = QueryStatistics.estimate_size(result)
+                elif hasattr(result, 'rowcount'):
+                    numRows = max(0, result.rowcount)
+            if callSite is None:
+                callSite = QueryStatistics.get_call_site()
+            self.instrumentation.record(callSite, queryStr, arguments, duration, numRows, numBytes)
+        except Exception as e:
+            print(f'WARNING: could not record query statistics (message: "{str(e)}").')
+
+
+    def explain(self, query, arguments=None):
+        '''
+            Runs the query with "EXPLAIN (ANALYZE, BUFFERS)" and returns the
+            plan as a list of lines. The query is executed in a transaction
+            that is rolled back afterwards, so that data-modifying state-
+            ments leave no trace.
+        '''
         with self._get_connection() as conn:
+            queryStr = query.as_string(conn) if isinstance(query, sql.Composable) else query
+            conn.autocommit = False
+            cursor = conn.cursor()
+            try:
+                cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + queryStr, arguments)
+                return [r[0] for r in cursor.fetchall()]
+            finally:
+                cursor.close()
+                if not conn.closed:
+                    conn.rollback()
+                    conn.autocommit = True
+
+
+    @staticmethod
+    def _is_connection_error(error, conn):
+        '''
+            Returns True if an error is due to a broken connection (as op-
+            posed to e.g. a faulty query), in which case the statement may
+            be retried on a fresh connection. Other operational errors
+            (cancelled statements, deadlocks, unavailable locks, etc.) leave
+            the connection usable and are not retried.
+        '''
+        return bool(conn.closed) or isinstance(error, psycopg2.InterfaceError)
+
+
+    def _run(self, runFun, query=None, arguments=None, numRows=None, numAttempts=2):
+        '''
+            Runs "runFun(conn)" on a pooled connection in autocommit mode.
+            If this fails due to a broken connection, the connection is
+            discarded and the call is retried once on a fresh one. Other
+            errors (and failures of the last attempt) are printed and None
+            is returned, as before.
+            "query", "arguments" and "numRows" are only used for the
+            instrumentation, if enabled.
+        '''
+        for attempt in range(numAttempts):
+            conn = self.connectionPool.getconn(owner=self.owner)
+            conn.autocommit = True
+            broken = False
+            try:
+                if self.instrumentation is None:
+                    return runFun(conn)
+                start = perf_counter()
+                result = runFun(conn)
+                self._record_query(conn, query, arguments, start, result, numRows)
+                return result
+            except Exception as e:
+                broken = self._is_connection_error(e, conn)
+                if not conn.closed and not conn.autocommit:
+                    conn.rollback()
+                if not broken or attempt == numAttempts-1:
+                    print(e)
+                    return None
+            finally:
+                self.connectionPool.putconn(conn, close=broken)
+
+
+    def execute(self, query, arguments, numReturn=None):
+        def _execute(conn):
             cursor = conn.cursor(cursor_factory=RealDictCursor)
+            cursor.execute(query, arguments)
+
+            # get results
+            if numReturn is None:
+                return
+            elif numReturn == 'all':
+                return cursor.fetchall()
+            else:
+                return cursor.fetchmany(numReturn)
 
-            # execute statement
+        return self._run(_execute, query, arguments)
+    
+
+    def _stream_cursor(self, query, arguments, itersize, callSite=None):
+        '''
+            Generator that runs the query through a named (server-side)
+            cursor and yields the rows one by one, fetching them in chunks
+            of "itersize" from the database. The connection is kept out of
+            the pool while iterating and returned once the generator has
+            been exhausted or closed.
+        '''
+        conn = self.connectionPool.getconn(owner=self.owner)
+        try:
+            # named cursors only live within a transaction
+            conn.autocommit = False
+            cursor = conn.cursor(name='aide_stream_' + uuid4().hex, cursor_factory=RealDictCursor)
+            cursor.itersize = itersize
             try:
-                cursor.execute(query, arguments)
+                if self.instrumentation is None:
+                    cursor.execute(query, arguments)
+                    for row in cursor:
+                        yield row
+                else:
+                    start = perf_counter()
+                    numRows, numBytes = 0, 0
+                    cursor.execute(query, arguments)
+                    for row in cursor:
+                        numRows += 1
+                        numBytes += QueryStatistics.estimate_size((row,))
+                        yield row
+                    self._record_query(conn, query, arguments, start, numRows=numRows, numBytes=numBytes, callSite=callSite)
+                cursor.close()
                 conn.commit()
-            except Exception as e:
+            except:
                 if not conn.closed:
                     conn.rollback()
-                # self.connectionPool.putconn(conn, close=False)    #TODO: this still causes connection to close
-                conn = self.connectionPool.getconn()
+                raise
+        finally:
+            if not conn.closed:
+                conn.autocommit = True
+            self.connectionPool.putconn(conn, close=False)
 
-                # retry execution
-                try:
-                    cursor = conn.cursor(cursor_factory=RealDictCursor)
-                    cursor.execute(query, arguments)
-                    conn.commit()
-                except:
-                    if not conn.closed:
-                        conn.rollback()
-                    print(e)
 
-            # get results
+    def execute_cursor(self, query, arguments, stream=False, itersize=None):
+        '''
+            Executes a query and returns a cursor to retrieve the results from.
+            If "stream" is True, a server-side cursor is used instead and a
+            generator is returned that yields the rows in chunks of "itersize"
+            (defaults to the "cursor_itersize" setting), so that large result
+            sets never have to be held in memory at once.
+        '''
+        if stream:
+            if itersize is None:
+                itersize = self.itersize
+            callSite = (QueryStatistics.get_call_site() if self.instrumentation is not None else None)
+            return self._stream_cursor(query, arguments, itersize, callSite)
+
+        def _execute(conn):
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            cursor.execute(query, arguments)
+            return cursor
+
+        return self._run(_execute, query, arguments)
+
+
+    @contextmanager
+    def transaction(self):
+        '''
+            Pins a single pooled connection for a block of statements. Yields
+            a cursor; everything executed through it is committed together at
+            the end of the block, or rolled back altogether if an exception
+            occurs (which is then re-raised).
+        '''
+        with self._get_connection() as conn:
+            conn.autocommit = False
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            try:
+                yield cursor
+                conn.commit()
+            except:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                cursor.close()
+                if not conn.closed:
+                    conn.autocommit = True
+
+
+    @staticmethod
+    def values_list(values):
+        '''
+            Renders an iterable of tuples into the body of a VALUES list
+            ("(a, b), (c, d), ..."), with all values embedded as literals.
+            This allows combining multiple data-modifying statements into
+            a single query string, and thus a single round trip.
+        '''
+        return sql.SQL(', ').join([
+            sql.SQL('({})').format(sql.SQL(', ').join([sql.Literal(v) for v in row]))
+            for row in values
+        ])
+
+
+    def render(self, query):
+        '''
+            Renders a psycopg2 "sql.Composable" object into a plain query
+            string. Useful to cache query strings that are used repeatedly,
+            since psycopg2 otherwise re-assembles the composed object on
+            every call to "execute".
+        '''
+        if not isinstance(query, sql.Composable):
+            return query
+        with self._get_connection() as conn:
+            return query.as_string(conn)
+
+
+    @staticmethod
+    def _to_prepared_syntax(queryStr):
+        '''
+            Converts psycopg2's placeholder syntax ("%s", "%%") into the
+            positional parameter syntax ("$1", "$2", "%") of PREPARE.
+        '''
+        counter = [0]
+        def _replace(match):
+            if match.group(0) == '%%':
+                return '%'
+            counter[0] += 1
+            return '${}'.format(counter[0])
+        return re.sub(r'%%|%s', _replace, queryStr)
+
+
+    def execute_prepared(self, query, arguments, numReturn=None):
+        '''
+            Executes a query as a server-side prepared statement. The state-
+            ment is PREPAREd the first time it is run on a pooled connection
+            and subsequently only EXECUTEd, so that Postgres does not need to
+            parse and plan it again. Arguments must be scalars or lists
+            (i.e., no tuples for "IN %s" expressions; use "= ANY(%s)" in-
+            stead). Returns results the same way as "execute".
+        '''
+        queryStr = self.render(query)
+        if arguments is None:
+            arguments = ()
+
+        with self._get_connection() as conn:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
             try:
-                returnValues = []
+                start = perf_counter()
+                self._execute_prepared_statement(conn, cursor, queryStr, arguments)
+
                 if numReturn is None:
-                    # cursor.close()
-                    return
-                
+                    result = None
                 elif numReturn == 'all':
-                    returnValues = cursor.fetchall()
-                    # cursor.close()
-                    return returnValues
-
+                    result = cursor.fetchall()
                 else:
-                    for _ in range(numReturn):
-                        rv = cursor.fetchone()
-                        if rv is None:
-                            return returnValues
-                        returnValues.append(rv)
-        
-                    # cursor.close()
-                    return returnValues
+                    result = cursor.fetchmany(numReturn)
+                if self.instrumentation is not None:
+                    self._record_query(conn, queryStr, arguments, start, result)
+                return result
             except Exception as e:
                 print(e)
-    
+            finally:
+                cursor.close()
 
-    def execute_cursor(self, query, arguments):
-        with self._get_connection() as conn:
-            cursor = conn.cursor(cursor_factory=RealDictCursor)
+
+    def _execute_prepared_statement(self, conn, cursor, queryStr, arguments):
+        '''
+            PREPAREs the query string on the connection if needed, and
+            EXECUTEs it through the given cursor.
+        '''
+        stmtName = 'aide_' + hashlib.md5(queryStr.encode('utf-8')).hexdigest()
+        prepared = conn.preparedStatements      # see connectionPool.PooledConnection
+
+        if len(arguments):
+            execStr = 'EXECUTE {} ({});'.format(stmtName, ', '.join(['%s']*len(arguments)))
+        else:
+            execStr = 'EXECUTE {};'.format(stmtName)
+        try:
+            if stmtName not in prepared:
+                stmtStr = self._to_prepared_syntax(queryStr)
+                try:
+                    cursor.execute('PREPARE {} AS {}'.format(stmtName, stmtStr.strip().rstrip(';')))
+                except errors.DuplicatePreparedStatement:
+                    pass
+                prepared.add(stmtName)
+            try:
+                cursor.execute(execStr, tuple(arguments))
+            except errors.InvalidSqlStatementName:
+                # connection got reset in the meantime; prepare again
+                stmtStr = self._to_prepared_syntax(queryStr)
+                cursor.execute('PREPARE {} AS {}'.format(stmtName, stmtStr.strip().rstrip(';')))
+                cursor.execute(execStr, tuple(arguments))
+        except:
+            prepared.discard(stmtName)
+            raise
+
+
+    def execute_chunks(self, query, arguments, itersize=None, prepared=False, stream=True):
+        '''
+            Generator that runs a query and yields its results in chunks of
+            up to "itersize" rows (defaults to the "cursor_itersize" setting)
+            as tuples (columns, rows):
+            - columns: tuple of (name, type OID) of the result columns
+            - rows: list of plain tuples, with values in the order of the
+                    columns
+            This avoids creating a dict for every row and lets the caller
+            resolve column positions once per query instead of once per
+            row. If "prepared" is True, the query is run as a prepared
+            statement (see "execute_prepared"), otherwise through a server-
+            side cursor (see "execute_cursor" with "stream=True"), unless
+            "stream" is False (required for data-modifying queries).
+            Errors are raised, not printed.
+        '''
+        if itersize is None:
+            itersize = self.itersize
+        if arguments is None:
+            arguments = ()
+        callSite = (QueryStatistics.get_call_site() if self.instrumentation is not None else None)
+
+        if prepared or not stream:
+            queryStr = self.render(query)
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    start = perf_counter()
+                    if prepared:
+                        self._execute_prepared_statement(conn, cursor, queryStr, arguments)
+                    else:
+                        cursor.execute(queryStr, arguments)
+                    columns = tuple((c.name, c.type_code) for c in cursor.description)
+                    numRows = 0
+                    while True:
+                        rows = cursor.fetchmany(itersize)
+                        if not len(rows):
+                            break
+                        numRows += len(rows)
+                        yield columns, rows
+                    if self.instrumentation is not None:
+                        self._record_query(conn, queryStr, arguments, start, numRows=numRows, callSite=callSite)
+                finally:
+                    cursor.close()
+            return
+
+        conn = self.connectionPool.getconn(owner=self.owner)
+        try:
+            # named cursors only live within a transaction
+            conn.autocommit = False
+            cursor = conn.cursor(name='aide_stream_' + uuid4().hex)
             try:
+                start = perf_counter()
                 cursor.execute(query, arguments)
+                numRows = 0
+                columns = None
+                while True:
+                    rows = cursor.fetchmany(itersize)
+                    if columns is None:
+                        # only available after the first fetch for named cursors
+                        columns = tuple((c.name, c.type_code) for c in cursor.description)
+                    if not len(rows):
+                        break
+                    numRows += len(rows)
+                    yield columns, rows
+                if self.instrumentation is not None:
+                    self._record_query(conn, query, arguments, start, numRows=numRows, callSite=callSite)
+                cursor.close()
                 conn.commit()
-                return cursor
             except:
                 if not conn.closed:
                     conn.rollback()
-                # cursor.close()
-
-                # retry execution
-                conn = self.connectionPool.getconn()
-                try:
-                    cursor = conn.cursor(cursor_factory=RealDictCursor)
-                    cursor.execute(query, arguments)
-                    conn.commit()
-                except Exception as e:
-                    if not conn.closed:
-                        conn.rollback()
-                    print(e)
+                raise
+        finally:
+            if not conn.closed:
+                conn.autocommit = True
+            self.connectionPool.putconn(conn, close=False)
 
 
     def insert(self, query, values):
+        def _insert(conn):
+            cursor = conn.cursor()
+            execute_values(cursor, query, values)
+
+        return self._run(_insert, query, numRows=(len(values) if hasattr(values, '__len__') else None))
+
+
+
+    def copy_rows(self, table, columns, rows):
+        '''
+            Bulk-inserts an iterable of row tuples into the given table by
+            streaming them through "COPY ... FROM STDIN", which is consider-
+            ably faster than "insert" (i.e., "execute_values") for large
+            numbers of rows.
+            Inputs:
+            - table: psycopg2 "sql.Identifier" (e.g. sql.Identifier(project,
+                     'prediction')) or string of the form "schema.table"
+            - columns: list of column names, in the order of the row values
+            - rows: iterable of tuples; values may be None (NULL), UUIDs,
+                    datetimes, booleans, bytes, dicts/lists (JSON), or any
+                    other object with a Postgres-compatible string repre-
+                    sentation
+
+            Returns the number of rows inserted. Unlike "insert", errors are
+            not retried (the rows may come from a one-shot iterator), but
+            raised after the transaction has been rolled back.
+        '''
+        if isinstance(table, str):
+            table = sql.Identifier(*table.split('.'))
+        queryStr = sql.SQL('COPY {table} ({columns}) FROM STDIN').format(
+            table=table,
+            columns=sql.SQL(', ').join([sql.Identifier(c.lower()) for c in columns])
+        )
+        stream = _CopyStream(rows)
         with self._get_connection() as conn:
             cursor = conn.cursor()
             try:
-                execute_values(cursor, query, values)
+                start = perf_counter()
+                cursor.copy_expert(queryStr, stream)
                 conn.commit()
-            except Exception as e:
+                if self.instrumentation is not None:
+                    self._record_query(conn, queryStr, None, start, numRows=stream.numRows)
+            except:
                 if not conn.closed:
                     conn.rollback()
-                # cursor.close()
-
-                # retry execution
-                conn = self.connectionPool.getconn()
-                try:
-                    cursor = conn.cursor(cursor_factory=RealDictCursor)
-                    execute_values(cursor, query, values)
-                    conn.commit()
-                except Exception as e:
-                    if not conn.closed:
-                        conn.rollback()
-                    print(e)
\ No newline at end of file
+                raise
+            finally:
+                cursor.close()
+        return stream.numRows
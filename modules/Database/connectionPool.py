@@ -0,0 +1,312 @@
+'''
+    Thread-safe pool of database connections.
+
+    Unlike psycopg2's ThreadedConnectionPool, which raises a PoolError as
+    soon as all connections are in use, requests for a connection are
+    queued for up to a configurable time span. Connections are validated
+    upon checkout and recycled after a maximum lifetime. The pool also keeps
+    counters of its usage for diagnostics, attributed to the modules that
+    borrowed the connections.
+
+    Pools are shared process-wide: "get_pool" returns the same instance for
+    all Database objects that connect to the same server, database and user,
+    so that the number of connections per process is capped globally rather
+    than per module.
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import time
+import threading
+from collections import deque
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+
+class PooledConnection(extensions.connection):
+    '''
+        Connection handed out by the pool. Keeps the names of the statements
+        that have been PREPAREd on it, so that they are forgotten together
+        with the connection once the pool closes it.
+    '''
+    def __init__(self, *args, **kwargs):
+        super(PooledConnection, self).__init__(*args, **kwargs)
+        self.preparedStatements = set()
+
+
+class ConnectionPool:
+
+    def __init__(self, minconn, maxconn, timeout=10.0, maxLifetime=3600.0, validationInterval=30.0, **connectionArgs):
+        '''
+            Inputs:
+            - minconn: number of connections to open right away
+            - maxconn: maximum number of connections open at a time
+            - timeout: maximum time (in seconds) to wait for a connection to
+                       become available before a PoolError is raised
+            - maxLifetime: connections older than this (in seconds) are closed
+                           and replaced upon their next checkout or return.
+                           Set to 0 or a negative value to disable.
+            - validationInterval: connections that have been idle for longer
+                                  than this (in seconds) are tested with a
+                                  round trip before they are handed out
+            - connectionArgs: keyword arguments for "psycopg2.connect"; the
+                              connections are instances of PooledConnection
+        '''
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.maxLifetime = maxLifetime
+        self.validationInterval = validationInterval
+        self.connectionArgs = connectionArgs
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._idle = deque()        # (connection, time of last return)
+        self._created = {}          # id(connection) -> time of creation
+        self._inUse = {}            # id(connection) -> owner
+        self._numOpen = 0           # open connections plus those being opened
+        self.closed = False
+
+        self.stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+            'reconnects': 0
+        }
+        self.checkoutsByOwner = {}
+
+        for _ in range(minconn):
+            self._numOpen += 1
+            conn = self._connect()
+            self._idle.append((conn, time.time()))
+
+
+    def _connect(self):
+        try:
+            conn = psycopg2.connect(connection_factory=PooledConnection, **self.connectionArgs)
+        except:
+            with self._lock:
+                self._numOpen -= 1
+                self._available.notify()
+            raise
+        self._created[id(conn)] = time.time()
+        return conn
+
+
+    def _discard(self, conn):
+        '''
+            Closes a connection and frees its slot. Must be called with the
+            lock held.
+        '''
+        self._created.pop(id(conn), None)
+        self._inUse.pop(id(conn), None)
+        self._numOpen -= 1
+        try:
+            conn.close()
+        except:
+            pass
+        self._available.notify()
+
+
+    def _expired(self, conn, now):
+        if self.maxLifetime is None or self.maxLifetime <= 0:
+            return False
+        return now - self._created.get(id(conn), now) > self.maxLifetime
+
+
+    def _is_usable(self, conn):
+        # checks that do not require a round trip to the server
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        return True
+
+
+    def _needs_validation(self, lastUsed, now):
+        return self.validationInterval is not None and now - lastUsed > self.validationInterval
+
+
+    def _validate(self, conn):
+        '''
+            Tests a connection with a round trip to the server. Must be
+            called without holding the lock, so that a slow or dead
+            connection does not stall other checkouts and returns.
+        '''
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1;')
+            cursor.close()
+            if not conn.autocommit:
+                conn.rollback()
+            return True
+        except:
+            return False
+
+
+    def getconn(self, timeout=None, owner=None):
+        '''
+            Returns a connection from the pool. If none is available and the
+            maximum number of connections has been reached, waits for up to
+            "timeout" seconds (defaults to the pool's timeout) for one to be
+            returned; raises a PoolError if that does not happen.
+            "owner" is an optional name (e.g. of the calling module) under
+            which the checkout is recorded in the statistics.
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+
+        with self._lock:
+            if self.closed:
+                raise PoolError('connection pool is closed')
+            self.stats['checkouts'] += 1
+            self.checkoutsByOwner[owner] = self.checkoutsByOwner.get(owner, 0) + 1
+
+        while True:
+            conn, validate = self._acquire(timeout, deadline, owner)
+            if conn is None:
+                # slot reserved; open new connection outside of the lock
+                conn = self._connect()
+                with self._lock:
+                    self._inUse[id(conn)] = owner
+                return conn
+
+            # idle connection has been checked out already; validate it outside of the lock
+            if not validate or self._validate(conn):
+                return conn
+            with self._lock:
+                self._discard(conn)
+                self.stats['reconnects'] += 1
+
+
+    def _acquire(self, timeout, deadline, owner):
+        '''
+            Checks out an idle connection, or reserves a slot for a new one
+            (returned as None), waiting until "deadline" if the pool is
+            exhausted. Also returns whether the connection needs to be
+            validated before use.
+        '''
+        waitStart = None
+        with self._lock:
+            try:
+                while True:
+                    if self.closed:
+                        raise PoolError('connection pool is closed')
+                    now = time.time()
+                    if len(self._idle):
+                        conn, lastUsed = self._idle.pop()
+                        if self._expired(conn, now) or not self._is_usable(conn):
+                            # broken or outdated connection; replace
+                            self._discard(conn)
+                            self.stats['reconnects'] += 1
+                            continue
+                        self._inUse[id(conn)] = owner
+                        return conn, self._needs_validation(lastUsed, now)
+
+                    elif self._numOpen < self.maxconn:
+                        # reserve slot
+                        self._numOpen += 1
+                        return None, False
+
+                    else:
+                        # pool exhausted; wait for a connection to be returned
+                        if waitStart is None:
+                            waitStart = now
+                            self.stats['waits'] += 1
+                        remaining = deadline - now
+                        if remaining <= 0:
+                            self.stats['timeouts'] += 1
+                            raise PoolError(f'connection pool exhausted (no connection available after {timeout} seconds)')
+                        self._available.wait(remaining)
+            finally:
+                if waitStart is not None:
+                    self.stats['wait_time'] += time.time() - waitStart
+
+
+    def putconn(self, conn, close=False):
+        '''
+            Returns a connection to the pool. Connections that are closed,
+            outdated, or left in an unclean state are discarded.
+        '''
+        if not close and not conn.closed:
+            status = conn.get_transaction_status()
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                # left in a transaction by the borrower; roll back
+                try:
+                    conn.rollback()
+                except:
+                    close = True
+
+        with self._lock:
+            if id(conn) not in self._inUse:
+                # not (or no longer) from this pool
+                return
+            now = time.time()
+            if close or conn.closed or self.closed or self._expired(conn, now):
+                self._discard(conn)
+            else:
+                self._inUse.pop(id(conn), None)
+                self._idle.append((conn, now))
+                self._available.notify()
+
+
+    def closeall(self):
+        with self._lock:
+            self.closed = True
+            while len(self._idle):
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+            self._available.notify_all()
+
+
+    def get_statistics(self):
+        '''
+            Returns a dict with the current usage counters of the pool.
+        '''
+        with self._lock:
+            stats = self.stats.copy()
+            stats['active'] = len(self._inUse)
+            stats['idle'] = len(self._idle)
+            stats['max_connections'] = self.maxconn
+            activeByOwner = {}
+            for owner in self._inUse.values():
+                activeByOwner[owner] = activeByOwner.get(owner, 0) + 1
+            stats['owners'] = dict([
+                (str(owner), {
+                    'checkouts': self.checkoutsByOwner[owner],
+                    'active': activeByOwner.get(owner, 0)
+                }) for owner in self.checkoutsByOwner
+            ])
+            return stats
+
+
+
+# process-wide registry of shared pools
+_pools = {}
+_poolsLock = threading.Lock()
+
+
+def get_pool(minconn, maxconn, **kwargs):
+    '''
+        Returns the connection pool shared by all callers in the current
+        process that connect with the same host, port, database and user,
+        creating it with the given arguments (see "ConnectionPool") upon
+        first request. The size of the pool is fixed by its creator, so
+        "maxconn" is a cap on the connections of the entire process.
+        Pools are keyed by process ID as well, so that children forked
+        after a pool has been created (e.g. Gunicorn or Celery workers)
+        open their own connections instead of sharing the parent's.
+    '''
+    key = (os.getpid(),) + tuple([str(kwargs.get(k)) for k in ('host', 'port', 'database', 'user')])
+    with _poolsLock:
+        pool = _pools.get(key, None)
+        if pool is None or pool.closed:
+            pool = ConnectionPool(minconn, maxconn, **kwargs)
+            _pools[key] = pool
+        return pool
@@ -0,0 +1,206 @@
+'''
+    Optional instrumentation of the queries run through the Database
+    connector. Records latency histograms, numbers of rows and (estimated)
+    bytes fetched per call site (i.e., the line of code outside of this
+    module that issued the query), logs slow queries and keeps samples of
+    the queries per project, so that they can be analyzed with EXPLAIN.
+
+    The statistics are process-wide and shared by all Database instances,
+    just like the connection pool.
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import re
+import sys
+import threading
+from collections import deque
+from datetime import datetime
+
+
+# upper bounds (in milliseconds) of the latency histogram buckets
+HISTOGRAM_BOUNDS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+
+# directory of the Database module; frames in here are skipped when looking for the call site
+_MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# matches quoted schema names (e.g. '"myproject".'), used to tell projects apart
+_SCHEMA_PATTERN = re.compile(r'"([^"]+)"\s*\.')
+
+
+class QueryStatistics:
+
+    def __init__(self, slowQueryThreshold=500.0, maxSlowQueries=100, maxSamples=20):
+        '''
+            Inputs:
+            - slowQueryThreshold: queries taking longer than this (in milli-
+                                  seconds) are printed and kept in the slow
+                                  query log
+            - maxSlowQueries: number of most recent slow queries to keep
+            - maxSamples: max. number of projects per call site for which a
+                          sample query is kept
+        '''
+        self.slowQueryThreshold = slowQueryThreshold
+        self.maxSamples = maxSamples
+        self.callSites = {}
+        self.slowQueries = deque(maxlen=maxSlowQueries)
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def get_call_site():
+        '''
+            Returns "<file>:<line> (<function>)" of the innermost frame in
+            the call stack that is not part of the Database module.
+        '''
+        frame = sys._getframe(1)
+        while frame is not None and os.path.dirname(os.path.abspath(frame.f_code.co_filename)) == _MODULE_DIR:
+            frame = frame.f_back
+        if frame is None:
+            return None
+        filename = os.path.relpath(frame.f_code.co_filename)
+        return f'{filename}:{frame.f_lineno} ({frame.f_code.co_name})'
+
+
+    @staticmethod
+    def _get_project(queryStr):
+        for schema in _SCHEMA_PATTERN.findall(queryStr):
+            if schema != 'aide_admin':
+                return schema
+        return None
+
+
+    @staticmethod
+    def estimate_size(rows):
+        '''
+            Rough estimate of the number of bytes of a list of result rows.
+        '''
+        size = 0
+        for row in rows:
+            values = row.values() if isinstance(row, dict) else row
+            for v in values:
+                if isinstance(v, (str, bytes, bytearray, memoryview)):
+                    size += len(v)
+                else:
+                    size += 8
+        return size
+
+
+    def record(self, callSite, queryStr, arguments, duration, numRows=0, numBytes=0):
+        '''
+            Records the execution of a query. "duration" is in seconds.
+        '''
+        duration *= 1000
+        project = self._get_project(queryStr)
+        with self._lock:
+            if callSite not in self.callSites:
+                self.callSites[callSite] = {
+                    'count': 0,
+                    'total_time': 0.0,
+                    'max_time': 0.0,
+                    'rows': 0,
+                    'bytes': 0,
+                    'histogram': [0]*len(HISTOGRAM_BOUNDS),
+                    'samples': {}
+                }
+            stats = self.callSites[callSite]
+            stats['count'] += 1
+            stats['total_time'] += duration
+            stats['max_time'] = max(stats['max_time'], duration)
+            stats['rows'] += numRows
+            stats['bytes'] += numBytes
+            for idx, bound in enumerate(HISTOGRAM_BOUNDS):
+                if duration <= bound:
+                    stats['histogram'][idx] += 1
+                    break
+            if project in stats['samples'] or len(stats['samples']) < self.maxSamples:
+                stats['samples'][project] = (queryStr, arguments)
+
+            if duration > self.slowQueryThreshold:
+                self.slowQueries.append({
+                    'time': datetime.now().isoformat(),
+                    'call_site': callSite,
+                    'duration': duration,
+                    'rows': numRows,
+                    'query': queryStr
+                })
+        if duration > self.slowQueryThreshold:
+            print(f'[slow query] {duration:.1f} ms, {numRows} rows at {callSite}:\n{queryStr.strip()[:1000]}')
+
+
+    def get_statistics(self, limit=None, orderBy='total_time'):
+        '''
+            Returns the recorded statistics per call site, sorted in des-
+            cending order by the given key ("total_time", "count",
+            "max_time", "mean_time", "rows" or "bytes"), as well as the most
+            recent slow queries.
+        '''
+        with self._lock:
+            result = []
+            for callSite, stats in self.callSites.items():
+                result.append({
+                    'call_site': callSite,
+                    'count': stats['count'],
+                    'total_time': stats['total_time'],
+                    'mean_time': stats['total_time'] / max(1, stats['count']),
+                    'max_time': stats['max_time'],
+                    'rows': stats['rows'],
+                    'bytes': stats['bytes'],
+                    'histogram': dict(zip([str(b) for b in HISTOGRAM_BOUNDS], stats['histogram'])),
+                    'projects': [p for p in stats['samples'].keys() if p is not None]
+                })
+            slowQueries = list(self.slowQueries)
+        if len(result) and orderBy not in result[0]:
+            orderBy = 'total_time'
+        result.sort(key=lambda x: x[orderBy], reverse=True)
+        if limit is not None:
+            result = result[:limit]
+        return {
+            'histogram_bounds_ms': [str(b) for b in HISTOGRAM_BOUNDS],
+            'call_sites': result,
+            'slow_queries': slowQueries
+        }
+
+
+    def get_sample(self, callSite, project):
+        '''
+            Returns a sample query string and arguments recorded at the
+            given call site for the given project. If there is none for
+            the project, a sample of another project is adapted by
+            replacing its schema name. Returns None if the call site is
+            unknown.
+        '''
+        with self._lock:
+            if callSite not in self.callSites:
+                return None
+            samples = self.callSites[callSite]['samples']
+            if project in samples:
+                return samples[project]
+            for otherProject, (queryStr, arguments) in samples.items():
+                if otherProject is not None and project is not None:
+                    queryStr = queryStr.replace(f'"{otherProject}".', f'"{project}".')
+                return (queryStr, arguments)
+        return None
+
+
+    def reset(self):
+        with self._lock:
+            self.callSites = {}
+            self.slowQueries.clear()
+
+
+
+_statistics = None
+_statisticsLock = threading.Lock()
+
+
+def get_query_statistics(slowQueryThreshold=500.0):
+    '''
+        Returns the process-wide query statistics object.
+    '''
+    global _statistics
+    with _statisticsLock:
+        if _statistics is None:
+            _statistics = QueryStatistics(slowQueryThreshold)
+        return _statistics
@@ -11,7 +11,9 @@ import bottle
 from bottle import request, response, static_file, redirect, abort, SimpleTemplate
 from constants.version import AIDE_VERSION
 from .backend.middleware import DBMiddleware
+from .backend import wire_format
 from util.helpers import parse_boolean
+from util.compression import parse_accept_header
 
 
 #TODO
@@ -54,6 +56,38 @@ class LabelUI():
         return response
 
 
+    def _respond_cached(self, body, etag):
+        '''
+            Sets the ETag of a cached response and answers with "304 Not
+            Modified" if the client already has the current version.
+        '''
+        if etag is None:
+            return body
+        headers = {
+            'ETag': etag,
+            'Cache-Control': 'private, no-cache'
+        }
+        ifNoneMatch = request.get_header('If-None-Match', None)
+        if ifNoneMatch is not None and etag in [t.strip() for t in ifNoneMatch.split(',')]:
+            return bottle.HTTPResponse(status=304, headers=headers)
+        for key, value in headers.items():
+            bottle.response.set_header(key, value)
+        return body
+
+
+    def _encode_batch(self, batch):
+        '''
+            Returns the image batch in the compact format requested by the
+            client through the "Accept" header, or as-is (nested JSON).
+        '''
+        bottle.response.add_header('Vary', 'Accept')
+        mimeType = wire_format.negotiate(parse_accept_header(request.get_header('Accept', '')))
+        if mimeType is None:
+            return batch
+        bottle.response.content_type = mimeType
+        return wire_format.encode(batch, mimeType)
+
+
     def _initBottle(self):
 
         ''' static routings '''
@@ -105,16 +139,15 @@ class LabelUI():
         @self.app.get('/<project>/getProjectInfo')
         def get_project_info(project):
             # minimum info (name, description) that can be viewed without logging in
-            return {'info': self.middleware.getProjectInfo(project)}
+            info, etag = self.middleware.getProjectInfo(project, returnETag=True)
+            return self._respond_cached({'info': info}, etag)
 
 
         @self.app.get('/<project>/getProjectSettings')
         def get_project_settings(project):
             if self.loginCheck(project=project):
-                settings = {
-                    'settings': self.middleware.getProjectSettings(project)
-                }
-                return settings
+                settings, etag = self.middleware.getProjectSettings(project, returnETag=True)
+                return self._respond_cached({'settings': settings}, etag)
             else:
                 abort(401, 'not logged in')
 
@@ -126,10 +159,8 @@ class LabelUI():
                     showHidden = parse_boolean(request.params['show_hidden'])
                 except:
                     showHidden = False
-                classDefs = {
-                    'classes': self.middleware.getClassDefinitions(project, showHidden)
-                }
-                return classDefs
+                classDefs, etag = self.middleware.getClassDefinitions(project, showHidden, returnETag=True)
+                return self._respond_cached({'classes': classDefs}, etag)
             else:
                 abort(401, 'not logged in')
 
@@ -147,7 +178,7 @@ class LabelUI():
                     username = ''
                 dataIDs = request.json['imageIDs']
                 json = self.middleware.getBatch_fixed(project, username, dataIDs, hideGoldenQuestionInfo)
-                return json
+                return self._encode_batch(json)
             else:
                 abort(401, 'not logged in')
 
@@ -177,7 +208,7 @@ class LabelUI():
                     subset = 'default'  
                 json = self.middleware.getBatch_auto(project=project, username=username, order=order, subset=subset, limit=limit, hideGoldenQuestionInfo=hideGoldenQuestionInfo)
 
-                return json
+                return self._encode_batch(json)
             else:
                 abort(401, 'not logged in')
 
@@ -230,10 +261,17 @@ class LabelUI():
                 goldenQuestionsOnly = request.json['goldenQuestionsOnly']
             except:
                 goldenQuestionsOnly = False
+            try:
+                continuationToken = request.json['continuation_token']
+            except:
+                continuationToken = None
 
             # query and return
-            json = self.middleware.getBatch_timeRange(project, minTimestamp, maxTimestamp, users, skipEmpty, limit, goldenQuestionsOnly, hideGoldenQuestionInfo)
-            return json
+            try:
+                json = self.middleware.getBatch_timeRange(project, minTimestamp, maxTimestamp, users, skipEmpty, limit, goldenQuestionsOnly, hideGoldenQuestionInfo, continuationToken)
+            except ValueError as e:
+                abort(400, str(e))
+            return self._encode_batch(json)
 
 
         @self.app.post('/<project>/getTimeRange')
@@ -274,8 +312,8 @@ class LabelUI():
         def get_sample_data(project):
             if self.loginCheck(project=project):
                 
-                json = self.middleware.get_sampleData(project)
-                return json
+                json, etag = self.middleware.get_sampleData(project, returnETag=True)
+                return self._respond_cached(json, etag)
             else:
                 abort(401, 'not logged in')
 
@@ -321,4 +359,19 @@ class LabelUI():
                 return { 'status': status }
 
             else:
-                abort(403, 'forbidden')
\ No newline at end of file
+                abort(403, 'forbidden')
+
+        @self.app.get('/getWriteBufferStatistics')
+        def get_write_buffer_statistics():
+            if self.loginCheck(superuser=True):
+                return { 'statistics': self.middleware.get_write_buffer_statistics() }
+            else:
+                abort(403, 'forbidden')
+
+
+        @self.app.get('/getPrefetchStatistics')
+        def get_prefetch_statistics():
+            if self.loginCheck(superuser=True):
+                return { 'statistics': self.middleware.get_prefetch_statistics() }
+            else:
+                abort(403, 'forbidden')
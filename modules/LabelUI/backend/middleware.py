@@ -11,24 +11,57 @@ from datetime import datetime
 import pytz
 import dateutil.parser
 import json
+import base64
 from PIL import Image
 from psycopg2 import sql
 from modules.Database.app import Database
 from .sql_string_builder import SQLStringBuilder
 from .annotation_sql_tokens import QueryStrings_annotation, AnnotationParser
-from util import helpers
+from .write_behind import WriteBehindBuffer
+from .row_assembler import RowAssembler
+from .prefetch import BatchPrefetcher
+from util import helpers, imageStats
+from util.projectCache import get_project_cache
+from util.tableSample import TableSampler
 
 
 class DBMiddleware():
 
+    # time (in seconds) for which the sample data of a project are cached
+    SAMPLE_DATA_MAX_AGE = 600
+
     def __init__(self, config):
         self.config = config
         self.dbConnector = Database(config)
 
-        self.project_immutables = {}       # project settings that cannot be changed (project shorthand -> {settings})
+        # versioned cache of project settings and class definitions
+        self.projectCache = get_project_cache(self.dbConnector,
+            self.config.getProperty('LabelUI', 'project_cache_validation_interval', type=float, fallback=5.0))
+
+        # run the batch queries as server-side prepared statements if enabled
+        self.usePreparedStatements = self.config.getProperty('Database', 'prepared_statements', type=bool, fallback=False)
+
+        # buffer "last_requested" and view count writes in memory if enabled
+        if self.config.getProperty('LabelUI', 'write_behind', type=bool, fallback=False):
+            self.writeBuffer = WriteBehindBuffer(self.dbConnector,
+                self.config.getProperty('LabelUI', 'write_behind_interval', type=float, fallback=1.0),
+                self.config.getProperty('LabelUI', 'write_behind_max_size', type=int, fallback=1000))
+        else:
+            self.writeBuffer = None
+
+        # query the next batch of each annotator in the background if enabled
+        if self.config.getProperty('LabelUI', 'batch_prefetch', type=bool, fallback=False):
+            self.prefetcher = BatchPrefetcher(
+                self.config.getProperty('LabelUI', 'batch_prefetch_max_size', type=int, fallback=1000),
+                self.config.getProperty('LabelUI', 'batch_prefetch_num_workers', type=int, fallback=4),
+                releaseFun=self._release_images)
+        else:
+            self.prefetcher = None
 
         self._fetchProjectSettings()
-        self.sqlBuilder = SQLStringBuilder()
+        self.sqlBuilder = SQLStringBuilder(self.dbConnector)
+        self.rowAssembler = RowAssembler(self.sqlBuilder)
+        self.tableSampler = TableSampler(self.dbConnector)
         self.annoParser = AnnotationParser()
 
 
@@ -55,71 +88,49 @@ class DBMiddleware():
             self.defaultStyles = json.load(open('modules/ProjectAdministration/static/json/default_ui_settings.json', 'r'))
 
 
-    def _assemble_annotations(self, project, cursor, hideGoldenQuestionInfo):
-        response = {}
-        while True:
-            b = cursor.fetchone()
-            if b is None:
-                break
-
-            imgID = str(b['image'])
-            if not imgID in response:
-                response[imgID] = {
-                    'fileName': b['filename'],
-                    'predictions': {},
-                    'annotations': {},
-                    'last_checked': None
-                }
-            viewcount = b['viewcount']
-            if viewcount is not None:
-                response[imgID]['viewcount'] = viewcount
-            last_checked = b['last_checked']
-            if last_checked is not None:
-                if response[imgID]['last_checked'] is None:
-                    response[imgID]['last_checked'] = last_checked
-                else:
-                    response[imgID]['last_checked'] = max(response[imgID]['last_checked'], last_checked)
-
-            if not hideGoldenQuestionInfo:
-                response[imgID]['isGoldenQuestion'] = b['isgoldenquestion']
-
-            # parse annotations and predictions
-            entryID = str(b['id'])
-            if b['ctype'] is not None:
-                colnames = self.sqlBuilder.getColnames(
-                    self.project_immutables[project]['annotationType'],
-                    self.project_immutables[project]['predictionType'],
-                    b['ctype'])
-                entry = {}
-                for c in colnames:
-                    value = b[c]
-                    if isinstance(value, datetime):
-                        value = value.timestamp()
-                    elif isinstance(value, UUID):
-                        value = str(value)
-                    entry[c] = value
-                
-                if b['ctype'] == 'annotation':
-                    response[imgID]['annotations'][entryID] = entry
-                elif b['ctype'] == 'prediction':
-                    response[imgID]['predictions'][entryID] = entry
-
-        return response
-
-
-    def _set_images_requested(self, project, imageIDs):
+    def _assemble_annotations(self, project, chunks, hideGoldenQuestionInfo):
+        projImmutables = self.get_project_immutables(project)
+        return self.rowAssembler.assemble(chunks,
+            projImmutables['annotationType'],
+            projImmutables['predictionType'],
+            hideGoldenQuestionInfo)
+
+
+    def _get_cached(self, project, key, loadFun, returnETag, maxAge=None):
+        value, etag = self.projectCache.get(project, key, loadFun, maxAge)
+        if returnETag:
+            return value, etag
+        return value
+
+
+    def _query_rows(self, queryStr, queryVals, stream=True):
+        '''
+            Runs one of the (hot) batch queries and returns an iterable of
+            chunks of result rows (see "Database.execute_chunks"), either
+            through a prepared statement or a streaming server-side cursor.
+            Set "stream" to False for data-modifying queries, which cannot
+            be run through server-side cursors.
+        '''
+        return self.dbConnector.execute_chunks(queryStr, queryVals,
+                    prepared=self.usePreparedStatements, stream=stream)
+
+
+    def _set_images_requested(self, project, imageIDs, synchronous=False):
         '''
             Sets column "last_requested" of relation "image"
             to the current date. This is done during image
             querying to signal that an image has been requested,
-            but not (yet) viewed.
+            but not (yet) viewed. If "synchronous" is True, the
+            write-behind buffer is bypassed.
         '''
         # prepare insertion values
         now = datetime.now(tz=pytz.utc)
         vals = []
         for key in imageIDs:
             vals.append(key)
-        if len(vals):
+        if len(vals) and self.writeBuffer is not None and not synchronous:
+            self.writeBuffer.set_images_requested(project, vals, now)
+        elif len(vals):
             queryStr = sql.SQL('''
                 UPDATE {id_img}
                 SET last_requested = %s
@@ -128,6 +139,24 @@ class DBMiddleware():
             self.dbConnector.execute(queryStr, (now, tuple(vals),), None)
 
 
+    def _release_images(self, project, batch):
+        '''
+            Clears column "last_requested" of the images of a
+            batch that has been discarded without being served,
+            so that they can be handed out to other annotators
+            right away.
+        '''
+        imageIDs = [UUID(key) for key in batch.get('entries', {}).keys()]
+        if not len(imageIDs):
+            return
+        queryStr = sql.SQL('''
+            UPDATE {id_img}
+            SET last_requested = NULL
+            WHERE id = ANY(%s);
+        ''').format(id_img=sql.Identifier(project, 'image'))
+        self.dbConnector.execute(queryStr, (imageIDs,), None)
+
+
     def _get_sample_metadata(self, metaType):
         '''
             Returns a dummy annotation or prediction for the sample
@@ -171,166 +200,201 @@ class DBMiddleware():
             return {}
 
     def get_project_immutables(self, project):
-        if project not in self.project_immutables:
+        def _load():
             queryStr = 'SELECT annotationType, predictionType, demoMode FROM aide_admin.project WHERE shortname = %s;'
             result = self.dbConnector.execute(queryStr, (project,), 1)
             if result and len(result):
-                self.project_immutables[project] = {
+                return {
                     'annotationType': result[0]['annotationtype'],
                     'predictionType': result[0]['predictiontype'],
                     'demoMode': helpers.checkDemoMode(project, self.dbConnector)
                 }
-            else:
-                return None
-        return self.project_immutables[project]
+            return None
+        return self._get_cached(project, 'immutables', _load, False)
 
     
-    def get_dynamic_project_settings(self, project):
-        queryStr = 'SELECT ui_settings FROM aide_admin.project WHERE shortname = %s;'
-        result = self.dbConnector.execute(queryStr, (project,), 1)
-        result = json.loads(result[0]['ui_settings'])
+    def get_batch_reservation_settings(self, project):
+        '''
+            Returns whether the project reserves images atomically upon batch
+            requests, and the time span (in seconds) for which images are
+            withheld from other annotators after they have been requested.
+        '''
+        def _load():
+            queryStr = 'SELECT batch_reservation, batch_reservation_window FROM aide_admin.project WHERE shortname = %s;'
+            result = self.dbConnector.execute(queryStr, (project,), 1)
+            if result is None or not len(result):
+                return None
+            reservationWindow = result[0]['batch_reservation_window']
+            if reservationWindow is None:
+                reservationWindow = 900
+            return (bool(result[0]['batch_reservation']), max(0, reservationWindow))
+        result = self._get_cached(project, 'batchReservation', _load, False)
+        if result is None:
+            return False, 900
+        return result
 
-        # complete styles with defaults where necessary (may be required for project that got upgraded from v1)
-        result = helpers.check_args(result, self.defaultStyles)
 
-        return result
+    def get_dynamic_project_settings(self, project, returnETag=False):
+        def _load():
+            queryStr = 'SELECT ui_settings FROM aide_admin.project WHERE shortname = %s;'
+            result = self.dbConnector.execute(queryStr, (project,), 1)
+            result = json.loads(result[0]['ui_settings'])
+
+            # complete styles with defaults where necessary (may be required for project that got upgraded from v1)
+            return helpers.check_args(result, self.defaultStyles)
+        return self._get_cached(project, 'dynamicSettings', _load, returnETag)
 
 
-    def getProjectSettings(self, project):
+    def getProjectSettings(self, project, returnETag=False):
         '''
             Queries the database for general project-specific metadata, such as:
             - Classes: names, indices, default colors
             - Annotation type: one of {class labels, positions, bboxes}
         '''
-        # publicly available info from DB
-        projSettings = self.getProjectInfo(project)
+        def _load():
+            # publicly available info from DB
+            projSettings = dict(self.getProjectInfo(project))
 
-        # label classes
-        projSettings['classes'] = self.getClassDefinitions(project)
+            # label classes
+            projSettings['classes'] = self.getClassDefinitions(project)
 
-        # static and dynamic project settings and properties from configuration file
-        projSettings = { **projSettings, **self.get_project_immutables(project), **self.get_dynamic_project_settings(project), **self.globalSettings }
+            # static and dynamic project settings and properties from configuration file
+            projSettings = { **projSettings, **self.get_project_immutables(project), **self.get_dynamic_project_settings(project), **self.globalSettings }
 
-        # append project shorthand to AIController URI 
-        if 'aiControllerURI' in projSettings and projSettings['aiControllerURI'] is not None and len(projSettings['aiControllerURI']):
-            projSettings['aiControllerURI'] = os.path.join(projSettings['aiControllerURI'], project) + '/'
+            # append project shorthand to AIController URI 
+            if 'aiControllerURI' in projSettings and projSettings['aiControllerURI'] is not None and len(projSettings['aiControllerURI']):
+                projSettings['aiControllerURI'] = os.path.join(projSettings['aiControllerURI'], project) + '/'
 
-        return projSettings
+            return projSettings
+        return self._get_cached(project, 'settings', _load, returnETag)
 
 
-    def getProjectInfo(self, project):
+    def get_write_buffer_statistics(self):
         '''
-            Returns safe, shareable information about the project
-            (i.e., users don't need to be part of the project to see these data).
+            Returns the queue depth and flush counters of the write-behind
+            buffer, or None if it is disabled.
         '''
-        queryStr = '''
-            SELECT shortname, name, description, demoMode,
-            interface_enabled, archived, ai_model_enabled,
-            ai_model_library, ai_alcriterion_library,
-            segmentation_ignore_unlabeled
-            FROM aide_admin.project
-            WHERE shortname = %s
+        if self.writeBuffer is None:
+            return None
+        return self.writeBuffer.get_statistics()
+
+
+    def get_prefetch_statistics(self):
         '''
-        result = self.dbConnector.execute(queryStr, (project,), 1)[0]
+            Returns the hit and miss counters of the batch prefetcher, or
+            None if it is disabled.
+        '''
+        if self.prefetcher is None:
+            return None
+        return self.prefetcher.get_statistics()
 
-        # provide flag if AI model is available
-        aiModelAvailable = all([
-            result['ai_model_enabled'],
-            result['ai_model_library'] is not None and len(result['ai_model_library']),
-            result['ai_alcriterion_library'] is not None and len(result['ai_alcriterion_library'])
-        ])
 
-        return {
-            'projectShortname': result['shortname'],
-            'projectName': result['name'],
-            'projectDescription': result['description'],
-            'demoMode': result['demomode'],
-            'interface_enabled': result['interface_enabled'] and not result['archived'],
-            'ai_model_available': aiModelAvailable,
-            'segmentation_ignore_unlabeled': result['segmentation_ignore_unlabeled']
-        }
+    def _get_latest_model_state(self, project):
+        result = self.dbConnector.execute(sql.SQL('''
+            SELECT id FROM {id_cnnstate}
+            ORDER BY timeCreated DESC
+            LIMIT 1;
+        ''').format(id_cnnstate=sql.Identifier(project, 'cnnstate')), None, 1)
+        if result is None or not len(result):
+            return None
+        return str(result[0]['id'])
 
 
-    def getClassDefinitions(self, project, showHidden=False):
+    def getProjectInfo(self, project, returnETag=False):
         '''
-            Returns a dictionary with entries for all classes in the project.
+            Returns safe, shareable information about the project
+            (i.e., users don't need to be part of the project to see these data).
         '''
+        def _load():
+            queryStr = '''
+                SELECT shortname, name, description, demoMode,
+                interface_enabled, archived, ai_model_enabled,
+                ai_model_library, ai_alcriterion_library,
+                segmentation_ignore_unlabeled
+                FROM aide_admin.project
+                WHERE shortname = %s
+            '''
+            result = self.dbConnector.execute(queryStr, (project,), 1)[0]
+
+            # provide flag if AI model is available
+            aiModelAvailable = all([
+                result['ai_model_enabled'],
+                result['ai_model_library'] is not None and len(result['ai_model_library']),
+                result['ai_alcriterion_library'] is not None and len(result['ai_alcriterion_library'])
+            ])
 
-        # query data
-        if showHidden:
-            hiddenSpec = ''
-        else:
-            hiddenSpec = 'WHERE hidden IS false'
-        queryStr = sql.SQL('''
-            SELECT 'group' AS type, id, NULL as idx, name, color, parent, NULL AS keystroke, NULL AS hidden FROM {}
-            UNION ALL
-            SELECT 'class' AS type, id, idx, name, color, labelclassgroup, keystroke, hidden FROM {}
-            {};
-            ''').format(
-                sql.Identifier(project, 'labelclassgroup'),
-                sql.Identifier(project, 'labelclass'),
-                sql.SQL(hiddenSpec)
-            )
-
-        classData = self.dbConnector.execute(queryStr, None, 'all')
-
-        # assemble entries first
-        allEntries = {}
-        numClasses = 0
-        for cl in classData:
-            id = str(cl['id'])
-            entry = {
-                'id': id,
-                'name': cl['name'],
-                'color': cl['color'],
-                'parent': str(cl['parent']) if cl['parent'] is not None else None,
-                'hidden': cl['hidden']
+            return {
+                'projectShortname': result['shortname'],
+                'projectName': result['name'],
+                'projectDescription': result['description'],
+                'demoMode': result['demomode'],
+                'interface_enabled': result['interface_enabled'] and not result['archived'],
+                'ai_model_available': aiModelAvailable,
+                'segmentation_ignore_unlabeled': result['segmentation_ignore_unlabeled']
             }
-            if cl['type'] == 'group':
-                entry['entries'] = {}
-            else:
-                entry['index'] = cl['idx']
-                entry['keystroke'] = cl['keystroke']
-                numClasses += 1
-            allEntries[id] = entry
-        
-
-        # transform into tree
-        def _find_parent(tree, parentID):
-            if parentID is None:
-                return None
-            elif 'id' in tree and tree['id'] == parentID:
-                return tree
-            elif 'entries' in tree:
-                for ek in tree['entries'].keys():
-                    rv = _find_parent(tree['entries'][ek], parentID)
-                    if rv is not None:
-                        return rv
-                return None
-            else:
-                return None
+        return self._get_cached(project, 'info', _load, returnETag)
 
 
-        allEntries = {
-            'entries': allEntries
-        }
-        for key in list(allEntries['entries'].keys()):
-            entry = allEntries['entries'][key]
-            parentID = entry['parent']
-            del entry['parent']
-
-            if parentID is None:
-                # entry or group with no parent: append to root directly
-                allEntries['entries'][key] = entry
-            
+    def getClassDefinitions(self, project, showHidden=False, returnETag=False):
+        '''
+            Returns a dictionary with entries for all classes in the project.
+        '''
+        def _load():
+            # query data
+            if showHidden:
+                hiddenSpec = ''
             else:
-                # move item
-                parent = _find_parent(allEntries, parentID)
-                parent['entries'][key] = entry
-                del allEntries['entries'][key]
+                hiddenSpec = 'WHERE hidden IS false'
+            queryStr = sql.SQL('''
+                SELECT 'group' AS type, id, NULL as idx, name, color, parent, NULL AS keystroke, NULL AS hidden FROM {}
+                UNION ALL
+                SELECT 'class' AS type, id, idx, name, color, labelclassgroup, keystroke, hidden FROM {}
+                {};
+                ''').format(
+                    sql.Identifier(project, 'labelclassgroup'),
+                    sql.Identifier(project, 'labelclass'),
+                    sql.SQL(hiddenSpec)
+                )
+
+            classData = self.dbConnector.execute(queryStr, None, 'all')
+
+            # assemble entries first
+            allEntries = {}
+            parents = {}
+            numClasses = 0
+            for cl in classData:
+                id = str(cl['id'])
+                entry = {
+                    'id': id,
+                    'name': cl['name'],
+                    'color': cl['color'],
+                    'hidden': cl['hidden']
+                }
+                if cl['type'] == 'group':
+                    entry['entries'] = {}
+                else:
+                    entry['index'] = cl['idx']
+                    entry['keystroke'] = cl['keystroke']
+                    numClasses += 1
+                allEntries[id] = entry
+                parents[id] = str(cl['parent']) if cl['parent'] is not None else None
+
+            # transform into tree: look up parents by ID; entries are moved by reference,
+            # so groups can be attached to their parents in any order
+            tree = {}
+            for key, entry in allEntries.items():
+                parent = allEntries.get(parents[key], None)
+                if parent is None or 'entries' not in parent:
+                    # entry or group with no (valid) parent: append to root directly
+                    tree[key] = entry
+                else:
+                    parent['entries'][key] = entry
 
-        allEntries['numClasses'] = numClasses
-        return allEntries
+            return {
+                'entries': tree,
+                'numClasses': numClasses
+            }
+        return self._get_cached(project, ('classes', showHidden), _load, returnETag)
 
 
     def getBatch_fixed(self, project, username, data, hideGoldenQuestionInfo=True):
@@ -346,20 +410,17 @@ class DBMiddleware():
         queryStr = self.sqlBuilder.getFixedImagesQueryString(project, projImmutables['annotationType'], projImmutables['predictionType'], projImmutables['demoMode'])
 
         # parse results
-        queryVals = (tuple(UUID(d) for d in data), username, username,)
+        queryVals = ([UUID(d) for d in data], username, username,)
         if projImmutables['demoMode']:
-            queryVals = (tuple(UUID(d) for d in data),)
+            queryVals = ([UUID(d) for d in data],)
 
-        with self.dbConnector.execute_cursor(queryStr, queryVals) as cursor:
-            try:
-                response = self._assemble_annotations(project, cursor, hideGoldenQuestionInfo)
-                # self.dbConnector.conn.commit()
-            except Exception as e:
-                print(e)
-                # self.dbConnector.conn.rollback()
-            finally:
-                pass
-                # cursor.close()
+        try:
+            response = self._assemble_annotations(project,
+                self._query_rows(queryStr, queryVals),
+                hideGoldenQuestionInfo)
+        except Exception as e:
+            print(e)
+            response = {}
 
         # mark images as requested
         self._set_images_requested(project, response)
@@ -371,50 +432,170 @@ class DBMiddleware():
         '''
             TODO: description
         '''
-        # query
-        projImmutables = self.get_project_immutables(project)
-        queryStr = self.sqlBuilder.getNextBatchQueryString(project, projImmutables['annotationType'], projImmutables['predictionType'], order, subset, projImmutables['demoMode'])
-
         # limit (TODO: make 128 a hyperparameter)
         if limit is None:
             limit = 128
         else:
             limit = min(int(limit), 128)
 
-        # parse results
-        queryVals = (username,username,limit,username,)
-        if projImmutables['demoMode']:      #TODO: demoMode can now change dynamically
-            queryVals = (limit,)
-
-        with self.dbConnector.execute_cursor(queryStr, queryVals) as cursor:
-            response = self._assemble_annotations(project, cursor, hideGoldenQuestionInfo)
+        if self.prefetcher is None:
+            return self._query_batch_auto(project, username, order, subset, limit, hideGoldenQuestionInfo)
+
+        # serve prefetched batch if available and still valid, then prefetch the following one;
+        # images are stamped synchronously so that the prefetch query sees them
+        key = (project, username, order, subset, limit, hideGoldenQuestionInfo)
+        modelStateFun = lambda: self._get_latest_model_state(project)
+        batch = self.prefetcher.take(key, modelStateFun)
+        if batch is None:
+            batch = self._query_batch_auto(project, username, order, subset, limit, hideGoldenQuestionInfo,
+                        synchronous=True)
+
+        # the served batch has not been submitted yet (e.g. its golden questions are not
+        # recorded as viewed), so it needs to be excluded from the next one explicitly
+        excludeIDs = [UUID(i) for i in batch['entries'].keys()]
+        _, reservationWindow = self.get_batch_reservation_settings(project)
+        self.prefetcher.schedule(key,
+            lambda: self._query_batch_auto(project, username, order, subset, limit, hideGoldenQuestionInfo,
+                        excludeIDs, synchronous=True),
+            reservationWindow, modelStateFun)
+        return batch
+
+
+    def _query_batch_auto(self, project, username, order, subset, limit, hideGoldenQuestionInfo, excludeIDs=None, synchronous=False):
+        projImmutables = self.get_project_immutables(project)
+        reserve, reservationWindow = self.get_batch_reservation_settings(project)
+        reserve = reserve and not projImmutables['demoMode']
+
+        # random order: draw images from a random sample of the image table if it is large
+        samplePercentage = None
+        if order == 'random' or projImmutables['demoMode']:
+            samplePercentage = self.tableSampler.get_percentage(project, limit)
+
+        response = self._query_batch_candidates(project, projImmutables, username, order, subset, limit,
+                        reserve, reservationWindow, samplePercentage, hideGoldenQuestionInfo, excludeIDs)
+
+        if samplePercentage is not None:
+            self.tableSampler.report(project, limit, len(response))
+            if len(response) < limit:
+                # too few images left in the sample after filtering: shuffle the entire table instead
+                if reserve:
+                    # images from the sample have been reserved already; only add the remainder
+                    response.update(self._query_batch_candidates(project, projImmutables, username, order, subset, limit - len(response),
+                        reserve, reservationWindow, None, hideGoldenQuestionInfo, excludeIDs))
+                else:
+                    response = self._query_batch_candidates(project, projImmutables, username, order, subset, limit,
+                        reserve, reservationWindow, None, hideGoldenQuestionInfo, excludeIDs)
 
-        # mark images as requested
-        self._set_images_requested(project, response)
+        if not reserve:
+            # mark images as requested (reserving queries stamp them themselves)
+            self._set_images_requested(project, response, synchronous)
 
         return { 'entries': response }
 
 
-    def getBatch_timeRange(self, project, minTimestamp, maxTimestamp, userList, skipEmptyImages=False, limit=None, goldenQuestionsOnly=False, hideGoldenQuestionInfo=True):
+    def _query_batch_candidates(self, project, projImmutables, username, order, subset, limit, reserve, reservationWindow, samplePercentage, hideGoldenQuestionInfo, excludeIDs=None):
+        sample = (samplePercentage is not None)
+        exclude = (excludeIDs is not None and len(excludeIDs) > 0)
+        excl = ((excludeIDs,) if exclude else ())
+        if reserve:
+            # claim and stamp images in one statement; no need to mark them as requested afterwards
+            queryStr = self.sqlBuilder.getReservedBatchQueryString(project, projImmutables['annotationType'], projImmutables['predictionType'], order, subset, sample, exclude)
+            queryVals = (username,reservationWindow,) + excl + (username,) + excl + (limit,username,)
+            if sample:
+                queryVals = (samplePercentage,) + queryVals
+        else:
+            queryStr = self.sqlBuilder.getNextBatchQueryString(project, projImmutables['annotationType'], projImmutables['predictionType'], order, subset, projImmutables['demoMode'], sample, exclude)
+            if projImmutables['demoMode']:
+                queryVals = (reservationWindow,) + excl + (limit,)
+                if sample:
+                    queryVals = (samplePercentage,) + queryVals
+                queryVals = excl + queryVals
+            elif sample:
+                queryVals = (username,) + excl + (samplePercentage,username,reservationWindow,) + excl + (limit,username,)
+            else:
+                queryVals = (username,) + excl + (username,reservationWindow,) + excl + (limit,username,)
+
+        try:
+            return self._assemble_annotations(project,
+                self._query_rows(queryStr, queryVals, stream=not reserve),
+                hideGoldenQuestionInfo)
+        except Exception as e:
+            print(e)
+            return {}
+
+
+    @staticmethod
+    def encode_continuation_token(pageKey):
+        '''
+            Encodes the key (last_checked, image, username) of the last view
+            of a review page into an opaque string for the client.
+        '''
+        lastChecked, imageID, username = pageKey
+        token = json.dumps([lastChecked.isoformat(), str(imageID), username])
+        return base64.urlsafe_b64encode(token.encode('utf-8')).decode('ascii')
+
+
+    @staticmethod
+    def decode_continuation_token(token):
+        '''
+            Inverse of "encode_continuation_token"; raises a ValueError if
+            the token is invalid.
+        '''
+        try:
+            lastChecked, imageID, username = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+            return (dateutil.parser.isoparse(lastChecked), UUID(imageID), str(username))
+        except Exception:
+            raise ValueError('Invalid continuation token.')
+
+
+    @staticmethod
+    def _track_page_end(chunks, pageEnd):
+        '''
+            Passes through chunks of review query rows and records the key
+            of the view ranked last on the page in dict "pageEnd".
+        '''
+        for columns, rows in chunks:
+            names = [c[0] for c in columns]
+            iRank, iTime, iImage, iUser = names.index('page_rank'), names.index('page_time'), \
+                                            names.index('image'), names.index('username')
+            for row in rows:
+                if row[iRank] > pageEnd['rank']:
+                    pageEnd['rank'] = row[iRank]
+                    pageEnd['key'] = (row[iTime], row[iImage], row[iUser])
+            yield columns, rows
+
+
+    def getBatch_timeRange(self, project, minTimestamp, maxTimestamp, userList, skipEmptyImages=False, limit=None, goldenQuestionsOnly=False, hideGoldenQuestionInfo=True, continuationToken=None):
         '''
             Returns images that have been annotated within the given time range and/or
             by the given user(s). All arguments are optional.
             Useful for reviewing existing annotations.
+            Results are paged: if there are more views than "limit," the response
+            contains a "continuation_token" that can be provided to obtain the next
+            page (with the same filters), starting right after the current one.
+            Raises a ValueError if the continuation token is invalid.
         '''
+        pageStart = None
+        if continuationToken is not None:
+            pageStart = self.decode_continuation_token(continuationToken)
+
         # query string
         projImmutables = self.get_project_immutables(project)
-        queryStr = self.sqlBuilder.getDateQueryString(project, projImmutables['annotationType'], minTimestamp, maxTimestamp, userList, skipEmptyImages, goldenQuestionsOnly)
+        queryStr = self.sqlBuilder.getDateQueryString(project, projImmutables['annotationType'], minTimestamp, maxTimestamp, userList, skipEmptyImages, goldenQuestionsOnly,
+                        pageStart is not None)
 
         # check validity and provide arguments
         queryVals = []
         if userList is not None:
-            queryVals.append(tuple(userList))
+            queryVals.append(list(userList))
         if minTimestamp is not None:
             queryVals.append(minTimestamp)
         if maxTimestamp is not None:
             queryVals.append(maxTimestamp)
+        if pageStart is not None:
+            queryVals.extend(pageStart)
         if skipEmptyImages and userList is not None:
-            queryVals.append(tuple(userList))
+            queryVals.append(list(userList))
 
         # limit (TODO: make 128 a hyperparameter)
         if limit is None:
@@ -424,25 +605,30 @@ class DBMiddleware():
         queryVals.append(limit)
 
         if userList is not None:
-            queryVals.append(tuple(userList))
+            queryVals.append(list(userList))
 
         # query and parse results
-        with self.dbConnector.execute_cursor(queryStr, tuple(queryVals)) as cursor:
-            try:
-                response = self._assemble_annotations(project, cursor, hideGoldenQuestionInfo)
-                # self.dbConnector.conn.commit()
-            except Exception as e:
-                print(e)
-                # self.dbConnector.conn.rollback()
-            finally:
-                pass
-                # cursor.close()
+        pageEnd = {'rank': 0, 'key': None}
+        try:
+            response = self._assemble_annotations(project,
+                self._track_page_end(self._query_rows(queryStr, tuple(queryVals)), pageEnd),
+                hideGoldenQuestionInfo)
+        except Exception as e:
+            print(e)
+            response = {}
 
         # # mark images as requested
         # self._set_images_requested(project, response)
 
+        # full page: more views may follow
+        nextToken = None
+        if pageEnd['rank'] >= limit and pageEnd['key'] is not None and pageEnd['key'][0] is not None:
+            nextToken = self.encode_continuation_token(pageEnd['key'])
 
-        return { 'entries': response }
+        return {
+            'entries': response,
+            'continuation_token': nextToken
+        }
 
     
     def get_timeRange(self, project, userList, skipEmptyImages=False, goldenQuestionsOnly=False):
@@ -475,41 +661,46 @@ class DBMiddleware():
             }
 
 
-    def get_sampleData(self, project):
+    def get_sampleData(self, project, returnETag=False):
         '''
             Returns a sample image from the project, with annotations
             (from one of the admins) and predictions.
             If no image, no annotations, and/or no predictions are
             available, a built-in default is returned instead.
         '''
-        projImmutables = self.get_project_immutables(project)
-        queryStr = self.sqlBuilder.getSampleDataQueryString(project, projImmutables['annotationType'], projImmutables['predictionType'])
+        def _load():
+            projImmutables = self.get_project_immutables(project)
+            queryStr = self.sqlBuilder.getSampleDataQueryString(project, projImmutables['annotationType'], projImmutables['predictionType'])
 
-        # query and parse results
-        response = None
-        with self.dbConnector.execute_cursor(queryStr, None) as cursor:
+            # query and parse results
+            response = None
             try:
-                response = self._assemble_annotations(project, cursor, True)
+                response = self._assemble_annotations(project,
+                    self.dbConnector.execute_chunks(queryStr, None),
+                    True)
             except:
                 pass
-        
-        if response is None or not len(response):
-            # no valid data found for project; fall back to sample data
-            response = {
-                '00000000-0000-0000-0000-000000000000': {
-                    'fileName': '/static/interface/exampleData/sample_image.jpg',
-                    'viewcount': 1,
-                    'annotations': {
-                        '00000000-0000-0000-0000-000000000000': self._get_sample_metadata(projImmutables['annotationType'])
-                    },
-                    'predictions': {
-                        '00000000-0000-0000-0000-000000000000': self._get_sample_metadata(projImmutables['predictionType'])
-                    },
-                    'last_checked': None,
-                    'isGoldenQuestion': True
+            
+            if response is None or not len(response):
+                # no valid data found for project; fall back to sample data
+                response = {
+                    '00000000-0000-0000-0000-000000000000': {
+                        'fileName': '/static/interface/exampleData/sample_image.jpg',
+                        'viewcount': 1,
+                        'annotations': {
+                            '00000000-0000-0000-0000-000000000000': self._get_sample_metadata(projImmutables['annotationType'])
+                        },
+                        'predictions': {
+                            '00000000-0000-0000-0000-000000000000': self._get_sample_metadata(projImmutables['predictionType'])
+                        },
+                        'last_checked': None,
+                        'isGoldenQuestion': True
+                    }
                 }
-            }
-        return response
+            return response
+
+        # sample annotations and predictions may change without a settings update
+        return self._get_cached(project, 'sampleData', _load, returnETag, maxAge=self.SAMPLE_DATA_MAX_AGE)
 
 
 
@@ -595,39 +786,48 @@ class DBMiddleware():
             viewcountValues.append((username, imageKey, 1, lastChecked, lastChecked, lastTimeRequired, lastTimeRequired, numInteractions, meta))
 
 
+        # assemble all statements; they are sent to the database in one go and run in a single transaction
+        statements = []
+
         # delete all annotations that are not in submitted batch
         imageKeys = list(UUID(k) for k in submissions['entries'])
         if len(imageKeys):
             if len(ids):
-                queryStr = sql.SQL('''
-                    DELETE FROM {id_anno} WHERE username = %s AND id IN (
-                        SELECT idQuery.id FROM (
-                            SELECT * FROM {id_anno} WHERE id NOT IN %s
-                        ) AS idQuery
-                        JOIN (
-                            SELECT * FROM {id_anno} WHERE image IN %s
-                        ) AS imageQuery ON idQuery.id = imageQuery.id);
+                # anti-join against the IDs of the submitted (existing) annotations
+                statements.append(sql.SQL('''
+                    DELETE FROM {id_anno} AS a
+                    WHERE a.username = {username}
+                    AND a.image = ANY({imageKeys})
+                    AND NOT EXISTS (
+                        SELECT 1 FROM (VALUES {ids}) AS keep(id)
+                        WHERE keep.id = a.id
+                    )
                 ''').format(
-                    id_anno=sql.Identifier(project, 'annotation'))
-                self.dbConnector.execute(queryStr, (username, tuple(ids), tuple(imageKeys),))
+                    id_anno=sql.Identifier(project, 'annotation'),
+                    username=sql.Literal(username),
+                    imageKeys=sql.Literal(imageKeys),
+                    ids=self.dbConnector.values_list([(i,) for i in ids])
+                ))
             else:
                 # no annotations submitted; delete all annotations submitted before
-                queryStr = sql.SQL('''
-                    DELETE FROM {id_anno} WHERE username = %s AND image IN %s;
+                statements.append(sql.SQL('''
+                    DELETE FROM {id_anno} WHERE username = {username} AND image = ANY({imageKeys})
                 ''').format(
-                    id_anno=sql.Identifier(project, 'annotation'))
-                self.dbConnector.execute(queryStr, (username, tuple(imageKeys),))
+                    id_anno=sql.Identifier(project, 'annotation'),
+                    username=sql.Literal(username),
+                    imageKeys=sql.Literal(imageKeys)
+                ))
 
         # insert new annotations
         if len(values_insert):
-            queryStr = sql.SQL('''
+            statements.append(sql.SQL('''
                 INSERT INTO {id_anno} ({cols})
-                VALUES %s ;
+                VALUES {values}
             ''').format(
                 id_anno=sql.Identifier(project, 'annotation'),
-                cols=sql.SQL(', ').join([sql.SQL(c) for c in colnames[1:]])     # skip 'id' column
-            )
-            self.dbConnector.insert(queryStr, values_insert)
+                cols=sql.SQL(', ').join([sql.SQL(c) for c in colnames[1:]]),     # skip 'id' column
+                values=self.dbConnector.values_list(values_insert)
+            ))
 
         # update existing annotations
         if len(values_update):
@@ -642,34 +842,44 @@ class DBMiddleware():
                 else:
                     updateCols.append(sql.SQL('{col} = e.{col}').format(col=sql.SQL(col)))
 
-            queryStr = sql.SQL('''
+            statements.append(sql.SQL('''
                 UPDATE {id_anno} AS a
                 SET {updateCols}
-                FROM (VALUES %s) AS e({colnames})
+                FROM (VALUES {values}) AS e({colnames})
                 WHERE e.id = a.id
             ''').format(
                 id_anno=sql.Identifier(project, 'annotation'),
                 updateCols=sql.SQL(', ').join(updateCols),
-                colnames=sql.SQL(', ').join([sql.SQL(c) for c in colnames])
-            )
+                colnames=sql.SQL(', ').join([sql.SQL(c) for c in colnames]),
+                values=self.dbConnector.values_list(values_update)
+            ))
+
+        # viewcount table (deferred to write-behind buffer if enabled)
+        if len(viewcountValues) and self.writeBuffer is None:
+            statements.append(sql.SQL('''
+                INSERT INTO {id_iu} (username, image, viewcount, first_checked, last_checked, last_time_required, total_time_required, num_interactions, meta)
+                VALUES {values}
+                ON CONFLICT (username, image) DO UPDATE SET viewcount = image_user.viewcount + 1,
+                    last_checked = EXCLUDED.last_checked,
+                    last_time_required = EXCLUDED.last_time_required,
+                    total_time_required = EXCLUDED.total_time_required + image_user.total_time_required,
+                    num_interactions = EXCLUDED.num_interactions + image_user.num_interactions,
+                    meta = EXCLUDED.meta
+            ''').format(
+                id_iu=sql.Identifier(project, 'image_user'),
+                values=self.dbConnector.values_list(viewcountValues)
+            ))
 
-            self.dbConnector.insert(queryStr, values_update)
+        # per-image annotation counts
+        if len(imageKeys):
+            statements.append(imageStats.annotation_stats_statement(project, imageKeys))
 
+        if len(statements):
+            with self.dbConnector.transaction() as cursor:
+                cursor.execute(sql.SQL(';').join(statements))
 
-        # viewcount table
-        queryStr = sql.SQL('''
-            INSERT INTO {id_iu} (username, image, viewcount, first_checked, last_checked, last_time_required, total_time_required, num_interactions, meta)
-            VALUES %s 
-            ON CONFLICT (username, image) DO UPDATE SET viewcount = image_user.viewcount + 1,
-                last_checked = EXCLUDED.last_checked,
-                last_time_required = EXCLUDED.last_time_required,
-                total_time_required = EXCLUDED.total_time_required + image_user.total_time_required,
-                num_interactions = EXCLUDED.num_interactions + image_user.num_interactions,
-                meta = EXCLUDED.meta;
-        ''').format(
-            id_iu=sql.Identifier(project, 'image_user')
-        )
-        self.dbConnector.insert(queryStr, viewcountValues)
+        if len(viewcountValues) and self.writeBuffer is not None:
+            self.writeBuffer.add_viewcounts(project, viewcountValues)
 
         return 0
 
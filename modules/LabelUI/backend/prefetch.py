@@ -0,0 +1,186 @@
+'''
+    Double-buffered prefetching of image batches for the labeling interface.
+    Whenever a batch is served to an annotator, the following batch for the
+    same user (and the same request parameters) is queried by a background
+    thread and kept in memory, so that the next request can be answered
+    without waiting for the database. Since querying a batch marks its
+    images as requested, prefetched images are withheld from other
+    annotators like any other batch that has been handed out. The batch
+    being served has not been submitted yet at that point, so its images
+    need to be excluded from the prefetch query explicitly.
+
+    Prefetched batches expire with the reservation window of the project
+    (after which their images may be handed out to others), and all batches
+    of a project are dropped as soon as a new model state is available, as
+    it changes the priorities of the images. The number of buffered batches
+    is bounded; the least recently stored ones are evicted first. Batches
+    that are dropped or evicted before their expiry are passed to a release
+    function, which clears the reservation of their images.
+
+    2020 Benjamin Kellenberger
+'''
+
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BatchPrefetcher:
+
+    def __init__(self, maxEntries=1000, numWorkers=4, waitTimeout=10.0, releaseFun=None):
+        '''
+            Inputs:
+            - maxEntries: maximum number of batches kept in memory
+            - numWorkers: number of background threads querying batches
+            - waitTimeout: maximum time (in seconds) a request waits for a
+                           prefetch that is still running, before it queries
+                           the batch itself
+            - releaseFun: function called with the project shortname and
+                          a batch whenever an unexpired batch is discarded
+        '''
+        self.maxEntries = maxEntries
+        self.waitTimeout = waitTimeout
+        self.releaseFun = releaseFun
+
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=numWorkers)
+
+        # key -> (batch, expiry time, model state)
+        self.entries = OrderedDict()
+
+        # key -> Future of running prefetch
+        self.pending = {}
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'dropped': 0,
+            'evicted': 0,
+            'prefetches': 0,
+            'errors': 0
+        }
+
+
+    def take(self, key, modelStateFun):
+        '''
+            Returns and removes the prefetched batch for the given key (whose
+            first element is the project shortname), or None if there is none
+            or if it is outdated. Waits for a prefetch that is still running.
+            "modelStateFun" returns the current model state of the project;
+            it is only called if there is a batch to validate.
+        '''
+        with self._lock:
+            future = self.pending.get(key, None)
+        if future is not None:
+            try:
+                future.result(self.waitTimeout)
+            except:
+                pass
+
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            batch, expires, state = entry
+            if time.time() >= expires:
+                # reservation has lapsed already; nothing to release
+                self.stats['expired'] += 1
+                return None
+
+        # queried outside the lock; the entry has been taken out already
+        if state != modelStateFun():
+            # new model state: priorities of all buffered batches of the project are outdated
+            with self._lock:
+                dropped = [batch] + self._drop(key[0])
+                self.stats['dropped'] += 1
+            self._release(key[0], dropped)
+            return None
+
+        with self._lock:
+            self.stats['hits'] += 1
+        return batch
+
+
+    def schedule(self, key, fetchFun, ttl, modelStateFun):
+        '''
+            Queries the next batch for the given key in the background by
+            calling "fetchFun" (without arguments). The batch is kept for
+            "ttl" seconds from the start of the query, together with the
+            model state at that time (as returned by "modelStateFun").
+        '''
+        if ttl <= 0:
+            return
+        with self._lock:
+            if key in self.pending:
+                return
+            self.pending[key] = self._executor.submit(self._prefetch, key, fetchFun, ttl, modelStateFun)
+
+
+    def _prefetch(self, key, fetchFun, ttl, modelStateFun):
+        evicted = []
+        try:
+            expires = time.time() + ttl
+            modelState = modelStateFun()
+            batch = fetchFun()
+            with self._lock:
+                self.stats['prefetches'] += 1
+                if batch is not None and len(batch.get('entries', {})):
+                    self.entries[key] = (batch, expires, modelState)
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.maxEntries:
+                        evictedKey, entry = self.entries.popitem(last=False)
+                        if time.time() < entry[1]:
+                            evicted.append((evictedKey[0], entry[0]))
+                        self.stats['evicted'] += 1
+        except Exception as e:
+            print(f'[{key[0]}] Error prefetching image batch (message: "{str(e)}").')
+            with self._lock:
+                self.stats['errors'] += 1
+        finally:
+            with self._lock:
+                self.pending.pop(key, None)
+        for project, batch in evicted:
+            self._release(project, [batch])
+
+
+    def _drop(self, project):
+        # must be called with the lock held; returns the unexpired batches
+        now = time.time()
+        keys = [k for k in self.entries.keys() if k[0] == project]
+        batches = []
+        for k in keys:
+            batch, expires, _ = self.entries.pop(k)
+            if now < expires:
+                batches.append(batch)
+        self.stats['dropped'] += len(keys)
+        return batches
+
+
+    def _release(self, project, batches):
+        if self.releaseFun is None:
+            return
+        for batch in batches:
+            try:
+                self.releaseFun(project, batch)
+            except Exception as e:
+                print(f'[{project}] Error releasing prefetched image batch (message: "{str(e)}").')
+
+
+    def drop(self, project):
+        '''
+            Discards all prefetched batches of a project.
+        '''
+        with self._lock:
+            batches = self._drop(project)
+        self._release(project, batches)
+
+
+    def get_statistics(self):
+        with self._lock:
+            stats = self.stats.copy()
+            stats['buffered'] = len(self.entries)
+            stats['pending'] = len(self.pending)
+            return stats
@@ -0,0 +1,142 @@
+'''
+    Converts the result rows of the LabelUI batch queries into the response
+    format sent to the labeling interface (one entry per image, with its
+    annotations and predictions).
+
+    Rows are received as plain tuples in chunks (see
+    "Database.execute_chunks"). The positions of the columns, the fields to
+    extract for annotations and predictions, and the value conversions
+    needed for JSON serialization are resolved once per result layout and
+    cached, instead of being looked up for every row and value.
+
+    2020 Benjamin Kellenberger
+'''
+
+# type OIDs of Postgres columns whose values need to be converted
+_OID_UUID = 2950
+_OID_TIMESTAMP = 1114
+_OID_TIMESTAMPTZ = 1184
+
+
+def _uuid_to_str(value):
+    return None if value is None else str(value)
+
+
+def _datetime_to_timestamp(value):
+    return None if value is None else value.timestamp()
+
+
+_CONVERTERS = {
+    _OID_UUID: _uuid_to_str,
+    _OID_TIMESTAMP: _datetime_to_timestamp,
+    _OID_TIMESTAMPTZ: _datetime_to_timestamp
+}
+
+
+class _RowLayout:
+    '''
+        Precomputed column positions for a given set of result columns and
+        project annotation and prediction types.
+    '''
+
+    def __init__(self, columns, fieldNames):
+        '''
+            Inputs:
+            - columns: tuple of (name, type OID) of the result columns
+            - fieldNames: dict of row type ('annotation', 'prediction') to
+                          the list of field names to extract for it
+        '''
+        positions = dict([(name, idx) for idx, (name, _) in enumerate(columns)])
+        self.image = positions['image']
+        self.filename = positions['filename']
+        self.viewcount = positions['viewcount']
+        self.last_checked = positions['last_checked']
+        self.isGoldenQuestion = positions.get('isgoldenquestion', None)
+        self.id = positions['id']
+        self.cType = positions['ctype']
+
+        # per row type: list of (field name, column index, converter or None)
+        self.fields = {}
+        for cType, names in fieldNames.items():
+            if names is None:
+                continue
+            fields = []
+            for name in names:
+                idx = positions[name.lower()]
+                fields.append((name, idx, _CONVERTERS.get(columns[idx][1], None)))
+            self.fields[cType] = fields
+
+
+
+class RowAssembler:
+
+    def __init__(self, sqlBuilder):
+        self.sqlBuilder = sqlBuilder
+        self.layouts = {}       # (columns, annotationType, predictionType) -> _RowLayout
+
+
+    def _get_layout(self, columns, annotationType, predictionType):
+        key = (columns, annotationType, predictionType)
+        layout = self.layouts.get(key, None)
+        if layout is None:
+            fieldNames = {}
+            for cType in ('annotation', 'prediction'):
+                try:
+                    fieldNames[cType] = self.sqlBuilder.getColnames(annotationType, predictionType, cType)
+                except:
+                    # annotation or prediction type not set
+                    fieldNames[cType] = None
+            layout = _RowLayout(columns, fieldNames)
+            self.layouts[key] = layout
+        return layout
+
+
+    def assemble(self, chunks, annotationType, predictionType, hideGoldenQuestionInfo):
+        '''
+            Receives an iterable of (columns, rows) chunks as returned by
+            "Database.execute_chunks" and returns a dict of image ID to image
+            metadata, annotations and predictions.
+        '''
+        response = {}
+        for columns, rows in chunks:
+            layout = self._get_layout(columns, annotationType, predictionType)
+            iImage, iFilename, iViewcount, iLastChecked, iGQ, iID, iCType = \
+                layout.image, layout.filename, layout.viewcount, layout.last_checked, \
+                layout.isGoldenQuestion, layout.id, layout.cType
+            fieldsPerType = layout.fields
+
+            for row in rows:
+                imgID = str(row[iImage])
+                img = response.get(imgID, None)
+                if img is None:
+                    img = {
+                        'fileName': row[iFilename],
+                        'predictions': {},
+                        'annotations': {},
+                        'last_checked': None
+                    }
+                    response[imgID] = img
+                viewcount = row[iViewcount]
+                if viewcount is not None:
+                    img['viewcount'] = viewcount
+                last_checked = row[iLastChecked]
+                if last_checked is not None:
+                    if img['last_checked'] is None or last_checked > img['last_checked']:
+                        img['last_checked'] = last_checked
+
+                if not hideGoldenQuestionInfo:
+                    img['isGoldenQuestion'] = row[iGQ]
+
+                # parse annotations and predictions
+                cType = row[iCType]
+                if cType is None:
+                    continue
+                entry = {}
+                for name, idx, converter in fieldsPerType[cType]:
+                    value = row[idx]
+                    if converter is not None:
+                        value = converter(value)
+                    entry[name] = value
+                img[cType + 's'][str(row[iID])] = entry
+
+        return response
@@ -11,6 +11,27 @@ from constants.dbFieldNames import FieldNames_annotation, FieldNames_prediction
 
 class SQLStringBuilder:
 
+    def __init__(self, dbConnector=None):
+        '''
+            Query strings are cached by their arguments. If a "dbConnector"
+            is provided, they are additionally rendered into plain strings
+            before caching, so that they do not need to be re-composed upon
+            every request.
+        '''
+        self.dbConnector = dbConnector
+        self.queryCache = {}
+
+
+    def _get_cached(self, key, assembleFun, *args):
+        queryStr = self.queryCache.get(key, None)
+        if queryStr is None:
+            queryStr = assembleFun(*args)
+            if self.dbConnector is not None:
+                queryStr = self.dbConnector.render(queryStr)
+            self.queryCache[key] = queryStr
+        return queryStr
+
+
     def _assemble_colnames(self, annotationType, predictionType):
 
         if annotationType is None:
@@ -66,6 +87,11 @@ class SQLStringBuilder:
 
 
     def getFixedImagesQueryString(self, project, annotationType, predictionType, demoMode=False):
+        return self._get_cached(('fixed', project, annotationType, predictionType, demoMode),
+                        self._assemble_fixed_images_query, project, annotationType, predictionType, demoMode)
+
+
+    def _assemble_fixed_images_query(self, project, annotationType, predictionType, demoMode):
 
         fields_anno, fields_pred, fields_union = self._assemble_colnames(annotationType, predictionType)
 
@@ -76,7 +102,7 @@ class SQLStringBuilder:
         queryStr = sql.SQL('''
             SELECT id, image, cType, viewcount, EXTRACT(epoch FROM last_checked) as last_checked, filename, isGoldenQuestion, {allCols} FROM (
                 SELECT id AS image, filename, isGoldenQuestion FROM {id_img}
-                WHERE id IN %s
+                WHERE id = ANY(%s)
             ) AS img
             LEFT OUTER JOIN (
                 SELECT id, image AS imID, 'annotation' AS cType, {annoCols} FROM {id_anno} AS anno
@@ -100,14 +126,20 @@ class SQLStringBuilder:
         return queryStr
 
     
-    def getNextBatchQueryString(self, project, annotationType, predictionType, order='unlabeled', subset='default', demoMode=False):
+    def getNextBatchQueryString(self, project, annotationType, predictionType, order='unlabeled', subset='default', demoMode=False, sample=False, exclude=False):
+        return self._get_cached(('nextBatch', project, annotationType, predictionType, order, subset, demoMode, sample, exclude),
+                        self._assemble_next_batch_query, project, annotationType, predictionType, order, subset, demoMode, sample, exclude)
+
+    
+    def _assemble_next_batch_query(self, project, annotationType, predictionType, order, subset, demoMode, sample, exclude):
         '''
             Assembles a DB query string according to the AL and viewcount ranking criterion.
             Inputs:
             - order: specifies sorting criterion for request:
                 - 'unlabeled': prioritize images that have not (yet) been viewed
-                    by the current user (i.e., last_requested timestamp is None or older than 15 minutes
-                    (TODO: make project-specific parameter?))
+                    by the current user (i.e., last_requested timestamp is None or older than the
+                    project's batch reservation window, which is provided as a query argument
+                    in seconds)
                 - 'labeled': put images first in order that have a high user viewcount
             - subset: hard constraint on the label status of the images:
                 - 'default': do not constrain query set
@@ -115,6 +147,13 @@ class SQLStringBuilder:
                 - 'forceUnlabeled': images must not have been viewed by the current user
             - demoMode: set to True to disable sorting criterion and return images in random
                         order instead.
+            - sample: if True, images (apart from golden questions) are drawn from a random
+                      sample of the image table ("TABLESAMPLE SYSTEM"), whose percentage is
+                      provided as a query argument (after the first username). Only useful
+                      for random order and demo mode (see "util.tableSample").
+            - exclude: if True, images whose IDs are provided as a query argument (array of
+                       UUIDs) are not returned. The argument is required twice: after the
+                       first username (golden questions) and after the reservation window.
             
             Note: images market with "isGoldenQuestion" = True will be prioritized if their view-
                   count by the current user is 0.
@@ -136,9 +175,13 @@ class SQLStringBuilder:
             subsetFragment_b = 'WHERE (viewcount IS NULL OR viewcount = 0)'
 
         if len(subsetFragment):
-            subsetFragment += ' AND (NOW() - COALESCE(img.last_requested, to_timestamp(0))) > interval \'900 second\''
+            subsetFragment += ' AND (NOW() - COALESCE(img.last_requested, to_timestamp(0))) > %s * interval \'1 second\''
         else:
-            subsetFragment = 'WHERE (NOW() - COALESCE(img.last_requested, to_timestamp(0))) > interval \'900 second\''
+            subsetFragment = 'WHERE (NOW() - COALESCE(img.last_requested, to_timestamp(0))) > %s * interval \'1 second\''
+        excludeFragment = ''
+        if exclude:
+            excludeFragment = 'AND NOT (img.id = ANY(%s::uuid[]))'
+            subsetFragment += ' ' + excludeFragment
 
         if order == 'unlabeled':
             orderSpec_a = 'ORDER BY isgoldenquestion DESC NULLS LAST, viewcount ASC NULLS FIRST, annoCount ASC NULLS FIRST, score DESC NULLS LAST'
@@ -155,7 +198,7 @@ class SQLStringBuilder:
         usernameString = 'WHERE username = %s'
         if demoMode:
             usernameString = ''
-            orderSpec_a = ''
+            orderSpec_a = 'ORDER BY RANDOM()'
             orderSpec_b = 'ORDER BY RANDOM()'
             gq_user = sql.SQL('')
         else:
@@ -166,32 +209,51 @@ class SQLStringBuilder:
                 id_iu=sql.Identifier(project, 'image_user')
             )
 
+        # number of annotations per image: over all users from the aggregates table in demo mode,
+        # otherwise of the current user only
+        if demoMode:
+            annoCount = sql.SQL('''
+                LEFT OUTER JOIN (
+                    SELECT image, num_anno AS annoCount
+                    FROM {id_stats}
+                ) AS anno_score ON img.id = anno_score.image
+            ''').format(
+                id_stats=sql.Identifier(project, 'image_stats')
+            )
+        else:
+            annoCount = sql.SQL('''
+                LEFT OUTER JOIN (
+                    SELECT image, COUNT(*) AS annoCount
+                    FROM {id_anno}
+                    WHERE username = %s
+                    GROUP BY image
+                ) AS anno_score ON img.id = anno_score.image
+            ''').format(
+                id_anno=sql.Identifier(project, 'annotation')
+            )
+
         queryStr = sql.SQL('''
             SELECT id, image, cType, viewcount, EXTRACT(epoch FROM last_checked) as last_checked, filename, isGoldenQuestion, {allCols} FROM (
             SELECT id AS image, filename, 0 AS viewcount, 0 AS annoCount, NULL AS last_checked, 1E9 AS score, NULL AS timeCreated, isGoldenQuestion FROM {id_img} AS img
             WHERE isGoldenQuestion = TRUE
             {gq_user}
+            {exclude}
             UNION ALL
             SELECT id AS image, filename, viewcount, annoCount, last_checked, score, timeCreated, isGoldenQuestion FROM {id_img} AS img
+            {sample}
             LEFT OUTER JOIN (
                 SELECT * FROM {id_iu}
             ) AS iu ON img.id = iu.image
             LEFT OUTER JOIN (
-                SELECT image, SUM(confidence)/COUNT(confidence) AS score, timeCreated
-                FROM {id_pred}
+                SELECT image, score, pred_time AS timeCreated
+                FROM {id_stats}
                 WHERE cnnstate = (
                     SELECT id FROM {id_cnnstate}
                     ORDER BY timeCreated DESC
                     LIMIT 1
                 )
-                GROUP BY image, timeCreated
             ) AS img_score ON img.id = img_score.image
-            LEFT OUTER JOIN (
-				SELECT image, COUNT(*) AS annoCount
-				FROM {id_anno}
-				{usernameString}
-				GROUP BY image
-			) AS anno_score ON img.id = anno_score.image
+            {annoCount}
             {subset}
             {order_a}
             LIMIT %s
@@ -215,7 +277,11 @@ class SQLStringBuilder:
             id_pred=sql.Identifier(project, 'prediction'),
             id_iu=sql.Identifier(project, 'image_user'),
             id_cnnstate=sql.Identifier(project, 'cnnstate'),
+            id_stats=sql.Identifier(project, 'image_stats'),
+            annoCount=annoCount,
             gq_user=gq_user,
+            exclude=sql.SQL(excludeFragment),
+            sample=sql.SQL('TABLESAMPLE SYSTEM (%s)' if sample else ''),
             allCols=sql.SQL(', ').join(fields_union),
             annoCols=sql.SQL(', ').join(fields_anno),
             predCols=sql.SQL(', ').join(fields_pred),
@@ -229,7 +295,150 @@ class SQLStringBuilder:
         return queryStr
 
 
+    def getReservedBatchQueryString(self, project, annotationType, predictionType, order='unlabeled', subset='default', sample=False, exclude=False):
+        return self._get_cached(('reservedBatch', project, annotationType, predictionType, order, subset, sample, exclude),
+                        self._assemble_reserved_batch_query, project, annotationType, predictionType, order, subset, sample, exclude)
+
+
+    def _assemble_reserved_batch_query(self, project, annotationType, predictionType, order, subset, sample, exclude):
+        '''
+            Variant of the next batch query that atomically reserves the
+            images it returns: candidate images are locked with "FOR UPDATE
+            SKIP LOCKED" and stamped with the current time in the same
+            statement, so that concurrent requests never receive the same
+            images (rows locked by a concurrent request are skipped and
+            rows stamped by a request that committed in the meantime are
+            filtered out by the reservation window).
+            Ranking criteria ("order" and "subset") are the same as for the
+            next batch query, except that view counts are summed over all
+            users. Not meant for demo mode.
+
+            Query arguments are: username, reservation window (in seconds),
+            username, limit, username. If "sample" is True, candidates are
+            drawn from a random sample of the image table, whose percentage
+            is provided as an additional first argument. If "exclude" is
+            True, images whose IDs are provided as an array of UUIDs are not
+            returned; the array is required after the reservation window and
+            after the second username.
+
+            Note: since the statement modifies data, it cannot be run
+                  through a streaming (server-side) cursor.
+        '''
+        fields_anno, fields_pred, fields_union = self._assemble_colnames(annotationType, predictionType)
+
+        subsetFragment = ''
+        if subset == 'forceLabeled':
+            subsetFragment = 'AND iu.viewcount > 0'
+        elif subset == 'forceUnlabeled':
+            subsetFragment = 'AND (iu.viewcount IS NULL OR iu.viewcount = 0)'
+
+        if order == 'unlabeled':
+            orderSpec = 'ORDER BY isgoldenquestion DESC NULLS LAST, viewcount ASC NULLS FIRST, annoCount ASC NULLS FIRST, score DESC NULLS LAST'
+        elif order == 'labeled':
+            orderSpec = 'ORDER BY viewcount DESC NULLS LAST, isgoldenquestion DESC NULLS LAST, score DESC NULLS LAST'
+        elif order == 'random':
+            orderSpec = 'ORDER BY RANDOM()'
+        else:
+            orderSpec = 'ORDER BY isgoldenquestion DESC NULLS LAST'
+        orderSpec += ', timeCreated DESC'
+
+        queryStr = sql.SQL('''
+            WITH candidates AS (
+                SELECT img.id,
+                    img.isGoldenQuestion AS isGoldenQuestion,
+                    CASE WHEN img.isGoldenQuestion THEN 0 ELSE iu.viewcount END AS viewcount,
+                    CASE WHEN img.isGoldenQuestion THEN 0 ELSE anno_score.annoCount END AS annoCount,
+                    CASE WHEN img.isGoldenQuestion THEN 1E9 ELSE img_score.score END AS score,
+                    CASE WHEN img.isGoldenQuestion THEN NULL ELSE img_score.timeCreated END AS timeCreated,
+                    iu.last_checked
+                FROM {id_img} AS img
+                {sample}
+                LEFT OUTER JOIN (
+                    SELECT image, SUM(viewcount) AS viewcount, MAX(last_checked) AS last_checked
+                    FROM {id_iu}
+                    GROUP BY image
+                ) AS iu ON img.id = iu.image
+                LEFT OUTER JOIN (
+                    SELECT image, score, pred_time AS timeCreated
+                    FROM {id_stats}
+                    WHERE cnnstate = (
+                        SELECT id FROM {id_cnnstate}
+                        ORDER BY timeCreated DESC
+                        LIMIT 1
+                    )
+                ) AS img_score ON img.id = img_score.image
+                LEFT OUTER JOIN (
+                    SELECT image, COUNT(*) AS annoCount
+                    FROM {id_anno}
+                    WHERE username = %s
+                    GROUP BY image
+                ) AS anno_score ON img.id = anno_score.image
+                WHERE (
+                    img.isGoldenQuestion = FALSE
+                    {subset}
+                    AND (img.last_requested IS NULL OR img.last_requested < NOW() - %s * interval '1 second')
+                    {exclude}
+                ) OR (
+                    img.isGoldenQuestion = TRUE
+                    AND NOT EXISTS (
+                        SELECT 1 FROM {id_iu} AS iu_user
+                        WHERE iu_user.username = %s
+                        AND iu_user.image = img.id
+                    )
+                    {exclude}
+                )
+                {order}
+                LIMIT %s
+                FOR UPDATE OF img SKIP LOCKED
+            ),
+            reserved AS (
+                UPDATE {id_img} AS img
+                SET last_requested = NOW()
+                FROM candidates
+                WHERE img.id = candidates.id
+                RETURNING img.id AS image, img.filename, candidates.isGoldenQuestion,
+                    candidates.viewcount, candidates.annoCount, candidates.score,
+                    candidates.timeCreated, candidates.last_checked
+            )
+            SELECT id, image, cType, viewcount, EXTRACT(epoch FROM last_checked) AS last_checked, filename, isGoldenQuestion, {allCols}
+            FROM reserved
+            LEFT OUTER JOIN (
+                SELECT id, image AS imID, 'annotation' AS cType, {annoCols} FROM {id_anno} AS anno
+                WHERE username = %s
+                UNION ALL
+                SELECT id, image AS imID, 'prediction' AS cType, {predCols} FROM {id_pred} AS pred
+                WHERE cnnstate = (
+                    SELECT id FROM {id_cnnstate}
+                    ORDER BY timeCreated DESC
+                    LIMIT 1
+                )
+            ) AS contents ON reserved.image = contents.imID
+            {order};
+        ''').format(
+            id_img=sql.Identifier(project, 'image'),
+            id_anno=sql.Identifier(project, 'annotation'),
+            id_pred=sql.Identifier(project, 'prediction'),
+            id_iu=sql.Identifier(project, 'image_user'),
+            id_cnnstate=sql.Identifier(project, 'cnnstate'),
+            id_stats=sql.Identifier(project, 'image_stats'),
+            allCols=sql.SQL(', ').join(fields_union),
+            annoCols=sql.SQL(', ').join(fields_anno),
+            predCols=sql.SQL(', ').join(fields_pred),
+            subset=sql.SQL(subsetFragment),
+            exclude=sql.SQL('AND NOT (img.id = ANY(%s::uuid[]))' if exclude else ''),
+            order=sql.SQL(orderSpec),
+            sample=sql.SQL('TABLESAMPLE SYSTEM (%s)' if sample else '')
+        )
+
+        return queryStr
+
+
     def getSampleDataQueryString(self, project, annotationType, predictionType):
+        return self._get_cached(('sampleData', project, annotationType, predictionType),
+                        self._assemble_sample_data_query, project, annotationType, predictionType)
+
+
+    def _assemble_sample_data_query(self, project, annotationType, predictionType):
 
         fields_anno, fields_pred, fields_union = self._assemble_colnames(annotationType, predictionType)
 
@@ -263,10 +472,23 @@ class SQLStringBuilder:
         return queryStr
 
 
-    def getDateQueryString(self, project, annotationType, minAge, maxAge, userNames, skipEmptyImages, goldenQuestionsOnly):
+    def getDateQueryString(self, project, annotationType, minAge, maxAge, userNames, skipEmptyImages, goldenQuestionsOnly, continuation=False):
+        # the query only depends on which of the filters are set, not on their values
+        userNamesType = (type(userNames).__name__ if userNames is not None else None)
+        return self._get_cached(('date', project, annotationType, minAge is None, maxAge is None, userNamesType, skipEmptyImages, goldenQuestionsOnly, continuation),
+                        self._assemble_date_query, project, annotationType, minAge, maxAge, userNames, skipEmptyImages, goldenQuestionsOnly, continuation)
+
+
+    def _assemble_date_query(self, project, annotationType, minAge, maxAge, userNames, skipEmptyImages, goldenQuestionsOnly, continuation):
         '''
             Assembles a DB query string that returns images between a time range.
             Useful for reviewing existing annotations.
+            Views of images by users (relation "image_user") are paged through
+            in order of (last_checked, image, username), so that subsequent
+            pages can continue after the last row of the previous one (keyset
+            pagination) instead of skipping rows. Each result row carries the
+            key of its view ("page_time", "image", "username") and its rank
+            within the page ("page_rank").
             Inputs:
             - minAge: earliest timestamp on which the image(s) have been viewed.
                       Set to None to leave unrestricted.
@@ -278,6 +500,9 @@ class SQLStringBuilder:
             - skipEmptyImages: if True, images without an annotation will be ignored.
             - goldenQuestionsOnly: if True, images without flag isGoldenQuestion =
                                    True will be ignored.
+            - continuation: if True, only views with a key greater than the one
+                            provided as (last_checked, image, username) arguments
+                            (after the date range and before the limit) are returned.
         '''
 
         # column names
@@ -285,52 +510,66 @@ class SQLStringBuilder:
 
         # user names
         usernameString = ''
+        userCondition = None
         if userNames is not None:
             if isinstance(userNames, str):
-                usernameString = 'WHERE username = %s'
+                userCondition = 'username = %s'
             elif isinstance(userNames, list):
-                usernameString = 'WHERE username IN %s'
+                userCondition = 'username = ANY(%s)'
             else:
                 raise Exception('Invalid property for user names')
+            usernameString = 'WHERE ' + userCondition
+
+        # filters on the views (in order of the query arguments); all of them are
+        # applied before the limit, so that every page is full unless it is the last
+        viewConditions = []
+        if userCondition is not None:
+            viewConditions.append(sql.SQL(userCondition))
 
         # date range
-        timestampString = None
         if minAge is not None:
-            prefix = ('WHERE' if usernameString == '' else 'AND')
-            timestampString = '{} last_checked::TIMESTAMP > TO_TIMESTAMP(%s)'.format(prefix)
+            viewConditions.append(sql.SQL('last_checked::TIMESTAMP > TO_TIMESTAMP(%s)'))
         if maxAge is not None:
-            prefix = ('WHERE' if (usernameString == '' and timestampString == '') else 'AND')
-            timestampString += ' {} last_checked::TIMESTAMP <= TO_TIMESTAMP(%s)'.format(prefix)
+            viewConditions.append(sql.SQL('last_checked::TIMESTAMP <= TO_TIMESTAMP(%s)'))
+
+        # continuation after the last view of the previous page
+        if continuation:
+            viewConditions.append(sql.SQL('(last_checked, image, username) > (%s::TIMESTAMPTZ, %s::UUID, %s)'))
 
         # empty images
         if skipEmptyImages:
-            skipEmptyString = sql.SQL('''
-            AND image IN (
+            viewConditions.append(sql.SQL('''image IN (
                 SELECT image FROM {id_anno}
                 {usernameString}
-            )
-            ''').format(id_anno=sql.Identifier(project, 'annotation'),
-                usernameString=sql.SQL(usernameString))
-        else:
-            skipEmptyString = sql.SQL('')
+            )''').format(id_anno=sql.Identifier(project, 'annotation'),
+                usernameString=sql.SQL(usernameString)))
 
         # golden questions
         if goldenQuestionsOnly:
-            goldenQuestionsString = sql.SQL('WHERE isGoldenQuestion = TRUE')
+            viewConditions.append(sql.SQL('''image IN (
+                SELECT id FROM {id_image}
+                WHERE isGoldenQuestion = TRUE
+            )''').format(id_image=sql.Identifier(project, 'image')))
+
+        if len(viewConditions):
+            viewFilter = sql.SQL('WHERE ') + sql.SQL(' AND ').join(viewConditions)
         else:
-            goldenQuestionsString = sql.SQL('')
+            viewFilter = sql.SQL('')
 
         queryStr = sql.SQL('''
-            SELECT id, image, cType, username, viewcount, EXTRACT(epoch FROM last_checked) as last_checked, filename, isGoldenQuestion, {annoCols} FROM (
+            SELECT id, image, cType, username, viewcount, EXTRACT(epoch FROM last_checked) as last_checked, filename, isGoldenQuestion,
+                last_checked AS page_time, page_rank, {annoCols} FROM (
                 SELECT id AS image, filename, isGoldenQuestion FROM {id_image}
-                {goldenQuestionsString}
             ) AS img
-            JOIN (SELECT image AS iu_image, viewcount, last_checked, username FROM {id_iu}
-            {usernameString}
-            {timestampString}
-            {skipEmptyString}
-            ORDER BY last_checked ASC
-            LIMIT %s) AS iu ON img.image = iu.iu_image
+            JOIN (
+                SELECT *, ROW_NUMBER() OVER (ORDER BY last_checked ASC, iu_image ASC, username ASC) AS page_rank
+                FROM (
+                    SELECT image AS iu_image, viewcount, last_checked, username FROM {id_iu}
+                    {viewFilter}
+                    ORDER BY last_checked ASC, image ASC, username ASC
+                    LIMIT %s
+                ) AS iu_page
+            ) AS iu ON img.image = iu.iu_image
             LEFT OUTER JOIN (
                 SELECT id, image AS imID, 'annotation' AS cType, {annoCols} FROM {id_anno} AS anno
                 {usernameString}
@@ -341,15 +580,19 @@ class SQLStringBuilder:
             id_iu=sql.Identifier(project, 'image_user'),
             id_anno=sql.Identifier(project, 'annotation'),
             usernameString=sql.SQL(usernameString),
-            timestampString=sql.SQL(timestampString),
-            skipEmptyString=skipEmptyString,
-            goldenQuestionsString=goldenQuestionsString
+            viewFilter=viewFilter
         )
 
         return queryStr
 
 
     def getTimeRangeQueryString(self, project, userNames, skipEmptyImages, goldenQuestionsOnly):
+        userNamesType = (type(userNames).__name__ if userNames is not None else None)
+        return self._get_cached(('timeRange', project, userNamesType, skipEmptyImages, goldenQuestionsOnly),
+                        self._assemble_time_range_query, project, userNames, skipEmptyImages, goldenQuestionsOnly)
+
+
+    def _assemble_time_range_query(self, project, userNames, skipEmptyImages, goldenQuestionsOnly):
         '''
             Assembles a DB query string that returns a minimum and maximum timestamp
             between which the image(s) have been annotated.
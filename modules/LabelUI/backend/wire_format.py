@@ -0,0 +1,135 @@
+'''
+    Compact encodings of the image batches sent to the labeling interface,
+    selected by the client through the "Accept" request header:
+
+    - "application/json" (default): nested dicts as assembled by the
+      middleware, with one dict per annotation and prediction.
+    - "application/vnd.aide.columnar+json": the annotations and predictions
+      of each image are stored as columns (one list per field, plus one of
+      the IDs), so that field names are not repeated for every entry. Label
+      class IDs are replaced by indices into a "labels" list at the top
+      level of the response.
+    - "application/vnd.aide.columnar+msgpack": the same as above, serialized
+      with MessagePack. Only available if the "msgpack" package is installed.
+
+    Example of a columnar batch:
+        {
+            "format": "columnar",
+            "labels": ["<label class ID>", ...],
+            "entries": {
+                "<image ID>": {
+                    "fileName": "...", "last_checked": ..., ...,
+                    "annotations": {
+                        "id": ["<annotation ID>", ...],
+                        "label": [0, ...],
+                        "x": [0.4, ...], ...
+                    },
+                    "predictions": { ... }
+                }
+            }
+        }
+
+    2020 Benjamin Kellenberger
+'''
+
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+MIME_JSON = 'application/json'
+MIME_COLUMNAR_JSON = 'application/vnd.aide.columnar+json'
+MIME_COLUMNAR_MSGPACK = 'application/vnd.aide.columnar+msgpack'
+
+
+def supported_types():
+    types = [MIME_COLUMNAR_JSON]
+    if msgpack is not None:
+        types.append(MIME_COLUMNAR_MSGPACK)
+    return types
+
+
+def negotiate(accepted):
+    '''
+        Receives a dict of accepted content type to quality value (see
+        "util.compression.parse_accept_header") and returns the compact
+        content type to encode the batch with, or None if the default
+        (nested JSON) is to be used.
+    '''
+    best, bestQuality = None, accepted.get(MIME_JSON, 0.0)
+    for mimeType in supported_types():
+        quality = accepted.get(mimeType, 0.0)
+        if quality > bestQuality:
+            best, bestQuality = mimeType, quality
+    return best
+
+
+def _to_columns(entries, labels, labelIndex):
+    '''
+        Converts a dict of entry ID to entry dict into a dict of field name
+        to list of values; the label class IDs are interned in "labels".
+    '''
+    columns = {'id': list(entries.keys())}
+    if not len(entries):
+        return columns
+    fieldNames = []
+    for entry in entries.values():
+        for key in entry.keys():
+            if key not in columns:
+                columns[key] = None
+                fieldNames.append(key)
+    values = list(entries.values())
+    for key in fieldNames:
+        columns[key] = [e.get(key, None) for e in values]
+    if 'label' in columns:
+        indices = []
+        for label in columns['label']:
+            if label is None:
+                indices.append(None)
+                continue
+            idx = labelIndex.get(label, None)
+            if idx is None:
+                idx = len(labels)
+                labelIndex[label] = idx
+                labels.append(label)
+            indices.append(idx)
+        columns['label'] = indices
+    return columns
+
+
+def to_columnar(batch):
+    '''
+        Converts a batch as returned by the "getBatch_*" functions of the
+        middleware into the columnar layout.
+    '''
+    labels = []
+    labelIndex = {}
+    entries = {}
+    for imgID, img in batch.get('entries', {}).items():
+        entry = {}
+        for key, value in img.items():
+            if key == 'annotations' or key == 'predictions':
+                entry[key] = _to_columns(value, labels, labelIndex)
+            else:
+                entry[key] = value
+        entries[imgID] = entry
+
+    result = dict([(key, value) for key, value in batch.items() if key != 'entries'])
+    result['format'] = 'columnar'
+    result['labels'] = labels
+    result['entries'] = entries
+    return result
+
+
+def encode(batch, mimeType):
+    '''
+        Returns the batch encoded in the given (compact) content type as
+        str or bytes.
+    '''
+    columnar = to_columnar(batch)
+    if mimeType == MIME_COLUMNAR_MSGPACK:
+        return msgpack.packb(columnar, use_bin_type=True)
+    return json.dumps(columnar, separators=(',', ':'))
@@ -0,0 +1,231 @@
+'''
+    Write-behind buffer for the frequent, small bookkeeping writes of the
+    labeling interface: "last_requested" timestamps of images handed out to
+    annotators, and view counts (relation "image_user") of submitted images.
+    Instead of writing them to the database upon every request, they are
+    coalesced in memory (one entry per image, resp. per user and image) and
+    flushed in bulk by a background thread, either after a fixed interval or
+    as soon as a size threshold is reached. Pending entries are flushed upon
+    shutdown of the process.
+
+    2020 Benjamin Kellenberger
+'''
+
+import time
+import atexit
+import threading
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+
+class WriteBehindBuffer:
+
+    def __init__(self, dbConnector, interval=1.0, maxSize=1000):
+        '''
+            Inputs:
+            - dbConnector: Database instance to flush the entries through
+            - interval: maximum time (in seconds) entries are kept in memory
+            - maxSize: number of pending entries above which a flush is
+                       triggered immediately
+        '''
+        self.dbConnector = dbConnector
+        self.interval = interval
+        self.maxSize = maxSize
+
+        # entries lost if the database is unreachable for too long
+        self.maxPending = 10 * maxSize
+
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+        # project -> {image ID: timestamp}
+        self.lastRequested = {}
+
+        # project -> {(username, image ID): [viewcount, first_checked, last_checked,
+        #                                    last_time_required, total_time_required,
+        #                                    num_interactions, meta]}
+        self.viewcounts = {}
+        self.numPending = 0
+
+        self.stats = {
+            'flushes': 0,
+            'flush_errors': 0,
+            'entries_flushed': 0,
+            'entries_dropped': 0,
+            'last_flush_time': 0.0,
+            'max_flush_time': 0.0,
+            'total_flush_time': 0.0
+        }
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+
+    @staticmethod
+    def _merge_viewcount(older, newer):
+        '''
+            Combines two view count entries of the same user and image, with
+            "older" having been submitted before "newer".
+        '''
+        return [
+            older[0] + newer[0],            # viewcount
+            older[1],                       # first_checked
+            newer[2],                       # last_checked
+            newer[3],                       # last_time_required
+            older[4] + newer[4],            # total_time_required
+            older[5] + newer[5],            # num_interactions
+            newer[6]                        # meta
+        ]
+
+
+    def _add_requested(self, project, entries):
+        # must be called with the lock held
+        if project not in self.lastRequested:
+            self.lastRequested[project] = {}
+        pending = self.lastRequested[project]
+        for imageID, timestamp in entries:
+            if imageID not in pending:
+                self.numPending += 1
+            pending[imageID] = timestamp
+
+
+    def _add_viewcounts(self, project, entries, older=False):
+        # must be called with the lock held
+        if project not in self.viewcounts:
+            self.viewcounts[project] = {}
+        pending = self.viewcounts[project]
+        for key, values in entries:
+            if key not in pending:
+                pending[key] = values
+                self.numPending += 1
+            elif older:
+                pending[key] = self._merge_viewcount(values, pending[key])
+            else:
+                pending[key] = self._merge_viewcount(pending[key], values)
+
+
+    def set_images_requested(self, project, imageIDs, timestamp):
+        '''
+            Marks the given images as requested at "timestamp".
+        '''
+        with self._lock:
+            self._add_requested(project, [(imageID, timestamp) for imageID in imageIDs])
+            full = self.numPending >= self.maxSize
+        if full:
+            self._wakeup.set()
+
+
+    def add_viewcounts(self, project, values):
+        '''
+            Registers views of images by users. "values" is an iterable of
+            tuples (username, image ID, viewcount, first_checked, last_checked,
+            last_time_required, total_time_required, num_interactions, meta),
+            i.e., rows of relation "image_user".
+        '''
+        with self._lock:
+            self._add_viewcounts(project, [((v[0], str(v[1])), list(v[2:])) for v in values])
+            full = self.numPending >= self.maxSize
+        if full:
+            self._wakeup.set()
+
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+    def _write(self, project, lastRequested, viewcounts):
+        with self.dbConnector.transaction() as cursor:
+            if len(lastRequested):
+                # sorted to lock rows in the same order across processes
+                execute_values(cursor, sql.SQL('''
+                    UPDATE {id_img} AS img
+                    SET last_requested = GREATEST(img.last_requested, v.last_requested)
+                    FROM (VALUES %s) AS v(id, last_requested)
+                    WHERE img.id = v.id::uuid;
+                ''').format(id_img=sql.Identifier(project, 'image')).as_string(cursor),
+                sorted(lastRequested.items()))
+            if len(viewcounts):
+                execute_values(cursor, sql.SQL('''
+                    INSERT INTO {id_iu} (username, image, viewcount, first_checked, last_checked,
+                        last_time_required, total_time_required, num_interactions, meta)
+                    VALUES %s
+                    ON CONFLICT (username, image) DO UPDATE SET viewcount = image_user.viewcount + EXCLUDED.viewcount,
+                        last_checked = EXCLUDED.last_checked,
+                        last_time_required = EXCLUDED.last_time_required,
+                        total_time_required = EXCLUDED.total_time_required + image_user.total_time_required,
+                        num_interactions = EXCLUDED.num_interactions + image_user.num_interactions,
+                        meta = EXCLUDED.meta;
+                ''').format(id_iu=sql.Identifier(project, 'image_user')).as_string(cursor),
+                [key + tuple(values) for key, values in sorted(viewcounts.items())])
+
+
+    def flush(self):
+        '''
+            Writes all pending entries to the database. Entries of projects
+            that fail to be written are put back into the buffer, unless the
+            buffer has grown beyond ten times its size threshold.
+        '''
+        with self._flushLock:
+            with self._lock:
+                lastRequested, self.lastRequested = self.lastRequested, {}
+                viewcounts, self.viewcounts = self.viewcounts, {}
+                numEntries, self.numPending = self.numPending, 0
+            if not numEntries:
+                return
+
+            start = time.perf_counter()
+            numFailed = 0
+            for project in set(lastRequested.keys()).union(set(viewcounts.keys())):
+                projRequested = lastRequested.get(project, {})
+                projViewcounts = viewcounts.get(project, {})
+                try:
+                    self._write(project, projRequested, projViewcounts)
+                except Exception as e:
+                    print(f'[{project}] Error writing buffered image requests and view counts (message: "{str(e)}").')
+                    numFailed += len(projRequested) + len(projViewcounts)
+                    with self._lock:
+                        if self.numPending + numFailed > self.maxPending:
+                            self.stats['entries_dropped'] += len(projRequested) + len(projViewcounts)
+                            continue
+                        # put back; entries that arrived in the meantime are newer
+                        for imageID, timestamp in projRequested.items():
+                            if imageID not in self.lastRequested.get(project, {}):
+                                self._add_requested(project, [(imageID, timestamp)])
+                        self._add_viewcounts(project, projViewcounts.items(), older=True)
+            duration = time.perf_counter() - start
+
+            with self._lock:
+                self.stats['flushes'] += 1
+                if numFailed:
+                    self.stats['flush_errors'] += 1
+                self.stats['entries_flushed'] += numEntries - numFailed
+                self.stats['last_flush_time'] = duration
+                self.stats['max_flush_time'] = max(self.stats['max_flush_time'], duration)
+                self.stats['total_flush_time'] += duration
+
+
+    def close(self):
+        '''
+            Stops the background thread and flushes all pending entries.
+        '''
+        self._stopped = True
+        self._wakeup.set()
+        self.flush()
+
+
+    def get_statistics(self):
+        '''
+            Returns the number of pending entries (queue depth) and counters
+            of the flushes performed so far (times in seconds).
+        '''
+        with self._lock:
+            stats = self.stats.copy()
+            stats['pending'] = self.numPending
+            stats['mean_flush_time'] = stats['total_flush_time'] / max(1, stats['flushes'])
+            return stats
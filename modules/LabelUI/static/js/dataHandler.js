@@ -262,6 +262,12 @@ class DataHandler {
             })
         }
 
+        // continue after the previous page if the time range has not been changed in the meantime
+        var continuationToken = null;
+        if(this.reviewContinuationToken != null && this.reviewContinuationTimestamp === minTimestamp) {
+            continuationToken = this.reviewContinuationToken;
+        }
+
         var url = 'getImages_timestamp';
         return $.ajax({
             url: url,
@@ -269,11 +275,12 @@ class DataHandler {
             contentType: "application/json; charset=utf-8",
             dataType: 'json',
             data: JSON.stringify({
-                minTimestamp: minTimestamp,
+                minTimestamp: (continuationToken == null ? minTimestamp : null),  // token already implies the start
                 users: userNames,
                 skipEmpty: skipEmptyImgs,
                 goldenQuestionsOnly: goldenQuestionsOnly,
-                limit: this.numImagesPerBatch
+                limit: this.numImagesPerBatch,
+                continuation_token: continuationToken
             }),
             success: function(data) {
                 // clear current entries
@@ -315,6 +322,10 @@ class DataHandler {
                 $('#review-timerange').val(Math.min($('#review-timerange').prop('max'), minTimestamp));
                 $('#review-time-text').html(new Date(minTimestamp * 1000).toLocaleString());
 
+                // remember where to continue
+                self.reviewContinuationToken = data['continuation_token'];
+                self.reviewContinuationTimestamp = parseFloat($('#review-timerange').val());
+
                 // adjust width of entries
                 window.windowResized();
             },
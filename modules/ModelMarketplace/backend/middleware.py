@@ -10,6 +10,7 @@ import json
 from psycopg2 import sql
 from ai import PREDICTION_MODELS
 from modules.Database.app import Database
+from util import projectCache
 from modules.LabelUI.backend.middleware import DBMiddleware     # required to obtain label class definitions (TODO: make more elegant)
 
 
@@ -184,6 +185,7 @@ class ModelMarketplaceMiddleware:
             SET ai_model_library = %s
             WHERE shortname = %s;
         ''', (meta['model_library'], project))
+        projectCache.invalidate(self.dbConnector, project)
 
         # finally, increase selection counter and import model state
         #TODO: - retain existing alCriterion library
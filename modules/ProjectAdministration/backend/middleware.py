@@ -16,6 +16,7 @@ from modules.Database.app import Database
 from modules.DataAdministration.backend import celery_interface as fileServer_interface
 from .db_fields import Fields_annotation, Fields_prediction
 from util.helpers import parse_parameters, check_args
+from util import projectCache, authCache, projectCounters, activityRollup
 
 
 class ProjectConfigMiddleware:
@@ -203,7 +204,9 @@ class ProjectConfigMiddleware:
             'minnumannoperimage',
             'maxnumimages_train',
             'watch_folder_enabled',
-            'watch_folder_remove_missing_enabled'
+            'watch_folder_remove_missing_enabled',
+            'batch_reservation',
+            'batch_reservation_window'
         ])
         if parameters is not None and parameters != '*':
             if isinstance(parameters, str):
@@ -301,6 +304,9 @@ class ProjectConfigMiddleware:
         if not self.getProjectShortNameAvailable(shortname):
             raise Exception('Project shortname "{}" unavailable.'.format(shortname))
 
+        # counters and activity rollup (see below) cannot be installed on older servers
+        projectCounters.check_server_version(self.dbConnector)
+
         # load base SQL
         with open('modules/ProjectAdministration/static/sql/create_schema.sql', 'r') as f:
             queryStr = sql.SQL(f.read())
@@ -323,6 +329,7 @@ class ProjectConfigMiddleware:
                 id_cnnstate=sql.Identifier(shortname, 'cnnstate'),
                 id_prediction=sql.Identifier(shortname, 'prediction'),
                 id_workflow=sql.Identifier(shortname, 'workflow'),
+                id_imageStats=sql.Identifier(shortname, 'image_stats'),
                 id_workflowHistory=sql.Identifier(shortname, 'workflowhistory'),
                 annotation_fields=sql.SQL(', ').join([sql.SQL(field) for field in annotationFields]),
                 prediction_fields=sql.SQL(', ').join([sql.SQL(field) for field in predictionFields])
@@ -371,6 +378,14 @@ class ProjectConfigMiddleware:
             ''',
             (username, shortname,),
             None)
+        authCache.invalidate(shortname)
+        projectCache.invalidate(self.dbConnector, shortname)
+
+        # counters for project statistics
+        projectCounters.install(self.dbConnector, shortname,
+                                properties['annotationType'],
+                                properties['predictionType'])
+        activityRollup.install(self.dbConnector, shortname)
 
         # notify FileServer instance(s) to set up project folders
         process = fileServer_interface.aide_internal_notify.si({
@@ -445,7 +460,9 @@ class ProjectConfigMiddleware:
             ('ui_settings', str),
             ('interface_enabled', bool),
             ('watch_folder_enabled', bool),
-            ('watch_folder_remove_missing_enabled', bool)
+            ('watch_folder_remove_missing_enabled', bool),
+            ('batch_reservation', bool),
+            ('batch_reservation_window', int)
         ]
 
         vals, params = parse_parameters(projectSettings, fieldNames, absent_ok=True, escape=False)
@@ -462,6 +479,8 @@ class ProjectConfigMiddleware:
         )
 
         self.dbConnector.execute(queryStr, tuple(vals), None)
+        projectCache.invalidate(self.dbConnector, project)
+        authCache.invalidate(project)
 
         return True
 
@@ -623,6 +642,7 @@ class ProjectConfigMiddleware:
             id_lc=sql.Identifier(project, 'labelclass')
         )
         self.dbConnector.insert(queryStr, lcdata)
+        projectCache.invalidate(self.dbConnector, project)
 
         return True
 
@@ -793,6 +813,7 @@ class ProjectConfigMiddleware:
             SET ARCHIVED = %s
             WHERE shortname = %s;
         ''', (archived, project), None)
+        projectCache.invalidate(self.dbConnector, project)
 
         return {
             'status': 0
@@ -851,6 +872,8 @@ class ProjectConfigMiddleware:
             DELETE FROM aide_admin.project
             WHERE shortname = %s;
         ''', (project, project,), None)
+        authCache.invalidate(project)
+        projectCache.invalidate(self.dbConnector, project)
         
         # dispatch Celery task to remove DB schema and files (if requested)
         process = fileServer_interface.deleteProject.si(project, deleteFiles)
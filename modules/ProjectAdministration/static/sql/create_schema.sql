@@ -126,4 +126,27 @@ CREATE TABLE IF NOT EXISTS {id_workflowHistory} (
     PRIMARY KEY (id),
     FOREIGN KEY (launchedBy) REFERENCES aide_admin.user (name),
     FOREIGN KEY (abortedBy) REFERENCES aide_admin.user (name)
-);
\ No newline at end of file
+);
+
+CREATE TABLE IF NOT EXISTS {id_imageStats} (
+    image uuid NOT NULL,
+    cnnstate uuid,
+    score real,
+    num_pred INTEGER NOT NULL DEFAULT 0,
+    pred_time TIMESTAMPTZ,
+    num_anno INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (image),
+    FOREIGN KEY (image) REFERENCES {id_image}(id) ON DELETE CASCADE
+);
+
+
+/* secondary indexes */
+CREATE INDEX IF NOT EXISTS annotation_image_idx ON {id_annotation} (image);
+CREATE INDEX IF NOT EXISTS annotation_username_image_idx ON {id_annotation} (username, image);
+CREATE INDEX IF NOT EXISTS prediction_cnnstate_image_idx ON {id_prediction} (cnnstate, image);
+CREATE INDEX IF NOT EXISTS image_user_image_idx ON {id_iu} (image);
+CREATE INDEX IF NOT EXISTS image_user_last_checked_idx ON {id_iu} (last_checked);
+CREATE INDEX IF NOT EXISTS cnnstate_timecreated_idx ON {id_cnnstate} (timeCreated);
+CREATE INDEX IF NOT EXISTS image_last_requested_idx ON {id_image} (last_requested);
+CREATE INDEX IF NOT EXISTS image_stats_cnnstate_score_idx ON {id_imageStats} (cnnstate, score DESC NULLS LAST);
+CREATE INDEX IF NOT EXISTS image_user_last_checked_image_username_idx ON {id_iu} (last_checked, image, username);
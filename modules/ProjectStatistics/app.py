@@ -73,8 +73,10 @@ class ProjectStatistics:
                 goldenQuestionsOnly = params['goldenQuestionsOnly']
             else:
                 goldenQuestionsOnly = False
+            engine = params.get('engine', None)
+            matching = params.get('matching', None)
 
-            stats = self.middleware.getPerformanceStatistics(project, entities_eval, entity_target, entityType, threshold, goldenQuestionsOnly)
+            stats = self.middleware.getPerformanceStatistics(project, entities_eval, entity_target, entityType, threshold, goldenQuestionsOnly, engine, matching)
 
             return { 'result': stats }
 
@@ -110,7 +112,11 @@ class ProjectStatistics:
                     perUser = parse_boolean(request.query['per_user'])
                 except:
                     perUser = False
-                stats = self.middleware.getTimeActivity(project, type, numDaysMax, perUser)
+                try:
+                    resolution = request.query['resolution']
+                except:
+                    resolution = 'day'
+                stats = self.middleware.getTimeActivity(project, type, numDaysMax, perUser, resolution)
                 return {'result': stats}
             except Exception as e:
                 abort(401, str(e))
\ No newline at end of file
@@ -0,0 +1,299 @@
+'''
+    Evaluation of points and bounding boxes in NumPy, as an alternative to
+    the SQL formulas in "statisticalFormulas.py". The annotations of the
+    target user and of all evaluated entities (users or model states) are
+    fetched once; distance, resp. IoU matrices are then computed per image
+    and entity and matched one-to-one (greedily or with the Hungarian
+    algorithm).
+
+    Yields per-image rows with the same columns as the SQL formulas (image,
+    username resp. cnnstate, num_pred, num_target, min/avg/max IoU resp.
+    distance, tp, fp, fn), so that both can be aggregated the same way:
+    - num_pred, num_target: number of annotations of the evaluated entity,
+      resp. target user in the image
+    - min/avg/max: statistics of the best IoU (> 0), resp. smallest distance
+      (<= threshold) of every target annotation to any evaluated annotation
+    - tp: number of matched pairs (IoU >= threshold, resp. distance <=
+      threshold) with the same label
+    - fp, fn: num_pred - tp, resp. num_target - tp
+
+    The values are identical to the ones of the SQL formulas, except for:
+    - tp: the SQL formulas match every target annotation with its best
+      evaluated annotation, even if the latter has already been matched to
+      another target; here, every annotation is matched at most once.
+    - images in which no target and evaluated annotations overlap (IoU of
+      zero for all pairs): the SQL formulas yield no row, whereas here they
+      count towards num_pred, num_target, fp and fn.
+    - images viewed by the evaluated user without any annotations: the SQL
+      formulas count one false positive, whereas here fp is zero.
+    See "tests/test_geometricEvaluation.py" for examples.
+
+    2020 Benjamin Kellenberger
+'''
+
+from psycopg2 import sql
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+
+MATCHING_METHODS = ('greedy', 'hungarian')
+
+
+def iou_matrix(boxesA, boxesB):
+    '''
+        Returns the intersection-over-union of all pairs of bounding boxes in
+        "boxesA" (N x 4) and "boxesB" (M x 4) as an N x M matrix. Boxes are
+        given as (x, y, width, height), with (x, y) being the center.
+    '''
+    boxesA = np.asarray(boxesA, dtype=np.float64).reshape(-1, 4)
+    boxesB = np.asarray(boxesB, dtype=np.float64).reshape(-1, 4)
+    a = boxesA[:, None, :]
+    b = boxesB[None, :, :]
+    iw = np.minimum(a[..., 0] + a[..., 2]/2, b[..., 0] + b[..., 2]/2) - \
+        np.maximum(a[..., 0] - a[..., 2]/2, b[..., 0] - b[..., 2]/2)
+    ih = np.minimum(a[..., 1] + a[..., 3]/2, b[..., 1] + b[..., 3]/2) - \
+        np.maximum(a[..., 1] - a[..., 3]/2, b[..., 1] - b[..., 3]/2)
+    intersection = np.clip(iw, 0, None) * np.clip(ih, 0, None)
+    union = a[..., 2] * a[..., 3] + b[..., 2] * b[..., 3] - intersection
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = np.where(union > 0, intersection / union, 0.0)
+    return iou
+
+
+def distance_matrix(pointsA, pointsB):
+    '''
+        Returns the euclidean distances of all pairs of points in "pointsA"
+        (N x 2) and "pointsB" (M x 2) as an N x M matrix.
+    '''
+    pointsA = np.asarray(pointsA, dtype=np.float64).reshape(-1, 2)
+    pointsB = np.asarray(pointsB, dtype=np.float64).reshape(-1, 2)
+    diff = pointsA[:, None, :] - pointsB[None, :, :]
+    return np.sqrt(np.sum(diff**2, axis=-1))
+
+
+def match(scores, valid, higherIsBetter=True, method='greedy'):
+    '''
+        Matches rows (targets) and columns (evaluated annotations) of a score
+        matrix one-to-one, only considering pairs flagged in "valid". Returns
+        the indices of the matched rows and columns.
+        - greedy: pairs are assigned in order of their score (best first)
+        - hungarian: the sum of scores of all matched pairs is optimized
+    '''
+    if not np.any(valid):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    if method == 'hungarian':
+        if linear_sum_assignment is None:
+            raise Exception('Hungarian matching requires SciPy to be installed.')
+        cost = (-scores if higherIsBetter else scores).astype(np.float64)
+        cost = np.where(valid, cost, np.abs(cost[valid]).sum() + 1.0)
+        rows, cols = linear_sum_assignment(cost)
+        keep = valid[rows, cols]
+        return rows[keep], cols[keep]
+
+    elif method == 'greedy':
+        candRows, candCols = np.nonzero(valid)
+        order = np.argsort(scores[candRows, candCols], kind='stable')
+        if higherIsBetter:
+            order = order[::-1]
+        usedRows = np.zeros(scores.shape[0], dtype=bool)
+        usedCols = np.zeros(scores.shape[1], dtype=bool)
+        rows, cols = [], []
+        maxMatches = min(scores.shape)
+        for idx in order:
+            r, c = candRows[idx], candCols[idx]
+            if usedRows[r] or usedCols[c]:
+                continue
+            usedRows[r] = True
+            usedCols[c] = True
+            rows.append(r)
+            cols.append(c)
+            if len(rows) == maxMatches:
+                break
+        return np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)
+
+    else:
+        raise Exception(f'Invalid matching method "{method}" (must be one of {", ".join(MATCHING_METHODS)}).')
+
+
+def evaluate_image(annoType, target, evaluated, threshold, method='greedy'):
+    '''
+        Compares the annotations of one image. "target" and "evaluated" are
+        tuples of (geometry, labels), with geometry being an N x 2 (points)
+        or N x 4 (bounding boxes) array and labels a list of N label class
+        IDs. Returns a dict of num_pred, num_target, min/avg/max (IoU or
+        distance), tp, fp and fn.
+    '''
+    geomTarget, labelsTarget = target
+    geomEval, labelsEval = evaluated
+    numTarget, numPred = len(labelsTarget), len(labelsEval)
+    if annoType == 'points':
+        statsKey = 'dist'
+    else:
+        statsKey = 'iou'
+
+    result = {
+        'num_pred': numPred,
+        'num_target': numTarget,
+        'min_' + statsKey: None,
+        'avg_' + statsKey: None,
+        'max_' + statsKey: None,
+        'tp': 0,
+        'fp': numPred,
+        'fn': numTarget
+    }
+    if numTarget == 0 or numPred == 0:
+        return result
+
+    if annoType == 'points':
+        scores = distance_matrix(geomTarget, geomEval)
+        best = scores.min(axis=1)
+        best = best[best <= threshold]
+        valid = (scores <= threshold)
+        higherIsBetter = False
+    else:
+        scores = iou_matrix(geomTarget, geomEval)
+        best = scores.max(axis=1)
+        best = best[best > 0]
+        valid = (scores >= threshold) & (scores > 0)
+        higherIsBetter = True
+
+    if len(best):
+        result['min_' + statsKey] = float(best.min())
+        result['avg_' + statsKey] = float(best.mean())
+        result['max_' + statsKey] = float(best.max())
+
+    rows, cols = match(scores, valid, higherIsBetter, method)
+    tp = sum([1 for r, c in zip(rows, cols) if labelsTarget[r] == labelsEval[c]])
+    result['tp'] = tp
+    result['fp'] = numPred - tp
+    result['fn'] = numTarget - tp
+    return result
+
+
+def _fetch_annotations(dbConnector, queryStr, queryArgs, annoType, entityKey=None):
+    '''
+        Runs a query for annotations (one row per annotation, resp. per image
+        without annotations, with NULL id) and groups them per image (and
+        entity, if "entityKey" is given). Returns a dict of (geometry array,
+        list of labels).
+    '''
+    if annoType == 'points':
+        fields = ('x', 'y')
+    else:
+        fields = ('x', 'y', 'width', 'height')
+
+    geometry, labels = {}, {}
+    for r in dbConnector.execute_cursor(queryStr, queryArgs, stream=True):
+        key = (r['image'] if entityKey is None else (r['image'], r[entityKey]))
+        if key not in geometry:
+            geometry[key] = []
+            labels[key] = []
+        if r['id'] is not None:
+            geometry[key].append([r[f] for f in fields])
+            labels[key].append(r['label'])
+
+    return dict([(key, (np.array(geometry[key], dtype=np.float64).reshape(-1, len(fields)), labels[key])) for key in geometry.keys()])
+
+
+def evaluate(dbConnector, project, annoType, entityType, entity_target, entities_eval, threshold, goldenQuestionsOnly=False, method='greedy'):
+    '''
+        Evaluates the points or bounding boxes of users or model states
+        ("entityType" = 'user', resp. 'model') against the annotations of
+        the target user on all images the target user has viewed (and that
+        are golden questions, if "goldenQuestionsOnly" is True). Images are
+        considered for every user that has viewed them, resp. for every
+        model state that has predictions in them.
+        Yields one dict per image and entity, like the SQL formulas do.
+    '''
+    if annoType not in ('points', 'boundingBoxes'):
+        raise Exception(f'Annotation type "{annoType}" is not supported by the NumPy evaluation engine.')
+    if method not in MATCHING_METHODS:
+        raise Exception(f'Invalid matching method "{method}" (must be one of {", ".join(MATCHING_METHODS)}).')
+
+    if annoType == 'points':
+        fields = sql.SQL('x, y, label')
+    else:
+        fields = sql.SQL('x, y, width, height, label')
+
+    if goldenQuestionsOnly:
+        sql_goldenQuestion = sql.SQL('''JOIN (
+                SELECT id
+                FROM {id_img}
+                WHERE isGoldenQuestion = true
+            ) AS qi
+            ON qi.id = tgt.image''').format(
+            id_img=sql.Identifier(project, 'image')
+        )
+    else:
+        sql_goldenQuestion = sql.SQL('')
+
+    # images viewed by the target user
+    sql_target = sql.SQL('''
+        SELECT iu.image FROM {id_iu} AS iu
+        WHERE iu.username = %s
+    ''').format(
+        id_iu=sql.Identifier(project, 'image_user')
+    )
+
+    queryStr = sql.SQL('''
+        SELECT tgt.image, anno.id, {fields}
+        FROM ({sql_target}) AS tgt
+        {sql_goldenQuestion}
+        LEFT OUTER JOIN {id_anno} AS anno
+        ON tgt.image = anno.image AND anno.username = %s
+    ''').format(
+        fields=fields,
+        sql_target=sql_target,
+        sql_goldenQuestion=sql_goldenQuestion,
+        id_anno=sql.Identifier(project, 'annotation')
+    )
+    targetAnno = _fetch_annotations(dbConnector, queryStr, (entity_target, entity_target), annoType)
+
+    if entityType == 'user':
+        entityKey = 'username'
+        queryStr = sql.SQL('''
+            SELECT tgt.image, iu.username, anno.id, {fields}
+            FROM ({sql_target}) AS tgt
+            {sql_goldenQuestion}
+            JOIN {id_iu} AS iu
+            ON tgt.image = iu.image
+            LEFT OUTER JOIN {id_anno} AS anno
+            ON iu.image = anno.image AND iu.username = anno.username
+            WHERE iu.username IN %s
+        ''').format(
+            fields=fields,
+            sql_target=sql_target,
+            sql_goldenQuestion=sql_goldenQuestion,
+            id_iu=sql.Identifier(project, 'image_user'),
+            id_anno=sql.Identifier(project, 'annotation')
+        )
+    else:
+        entityKey = 'cnnstate'
+        queryStr = sql.SQL('''
+            SELECT tgt.image, pred.cnnstate, pred.id, {fields}
+            FROM ({sql_target}) AS tgt
+            {sql_goldenQuestion}
+            JOIN {id_pred} AS pred
+            ON tgt.image = pred.image
+            WHERE pred.cnnstate IN %s
+        ''').format(
+            fields=fields,
+            sql_target=sql_target,
+            sql_goldenQuestion=sql_goldenQuestion,
+            id_pred=sql.Identifier(project, 'prediction')
+        )
+    evalAnno = _fetch_annotations(dbConnector, queryStr, (entity_target, tuple(entities_eval)), annoType, entityKey)
+
+    for (image, entity), evaluated in evalAnno.items():
+        target = targetAnno.get(image, None)
+        if target is None:
+            continue
+        result = evaluate_image(annoType, target, evaluated, threshold, method)
+        result['image'] = image
+        result[entityKey] = entity
+        yield result
@@ -4,11 +4,16 @@
     2019-20 Benjamin Kellenberger
 '''
 
+import copy
+from threading import Lock
+from datetime import datetime, timedelta
+import pytz
 from psycopg2 import sql
-import numpy as np
 from .statisticalFormulas import StatisticalFormulas_user, StatisticalFormulas_model
+from . import geometricEvaluation, segmentationEvaluation
+from .resultCache import ResultCache
 from modules.Database.app import Database
-from util.helpers import base64ToImage
+from util import projectCounters, activityRollup
 
 
 class ProjectStatisticsMiddleware:
@@ -16,6 +21,40 @@ class ProjectStatisticsMiddleware:
     def __init__(self, config):
         self.config = config
         self.dbConnector = Database(config)
+        self.evaluationEngine = self.config.getProperty('ProjectStatistics', 'evaluation_engine', type=str, fallback='sql').lower()
+        self.evaluationMatching = self.config.getProperty('ProjectStatistics', 'evaluation_matching', type=str, fallback='greedy').lower()
+        self.segmentationNumWorkers = self.config.getProperty('ProjectStatistics', 'segmentation_num_workers', type=int, fallback=0)
+        self.segmentationPool = None
+        self.segmentationPoolLock = Lock()
+        self.resultCache = ResultCache(self.config.getProperty('ProjectStatistics', 'result_cache_size', type=int, fallback=256))
+
+
+    def _get_data_version(self, project):
+        '''
+            Returns the current data version of a project for the result
+            cache, or None if results are not to be cached.
+        '''
+        if self.resultCache.maxEntries <= 0:
+            return None
+        return projectCounters.get_version(self.dbConnector, project)
+
+
+    def _get_segmentation_pool(self):
+        '''
+            Returns the process pool for the evaluation of segmentation masks,
+            which is created upon first use and shared by all requests. Returns
+            None if the masks are to be evaluated in the current process.
+        '''
+        with self.segmentationPoolLock:
+            if self.segmentationPool is None and self.segmentationNumWorkers != 1:
+                try:
+                    self.segmentationPool = segmentationEvaluation.create_pool(self.segmentationNumWorkers)
+                except Exception as e:
+                    print(f'Could not create process pool for segmentation mask statistics ("{str(e)}"); evaluating in main process.')
+                if self.segmentationPool is None:
+                    # do not try again
+                    self.segmentationNumWorkers = 1
+            return self.segmentationPool
     
 
     def getProjectStatistics(self, project):
@@ -23,107 +62,64 @@ class ProjectStatisticsMiddleware:
             Returns statistics, such as number of images (seen),
             number of annotations, etc., on a global and per-user,
             but class-agnostic basis.
+            Values are read from the project counters (see
+            "util/projectCounters.py").
         '''
-        queryStr = sql.SQL('''
-            SELECT NULL AS username, COUNT(*) AS num_img, NULL::bigint AS num_anno FROM {id_img}
-            UNION ALL
-            SELECT NULL AS username, COUNT(DISTINCT(image)) AS num_img, NULL AS num_anno FROM {id_iu}
-            UNION ALL
-            SELECT NULL AS username, COUNT(DISTINCT(gq.id)) AS num_img, NULL AS num_anno FROM (
-                SELECT id FROM {id_img} WHERE isGoldenQuestion = TRUE
-            ) AS gq
-            UNION ALL
-            SELECT NULL AS username, NULL AS num_img, COUNT(DISTINCT(image)) AS num_anno FROM {id_anno}
-            UNION ALL
-            SELECT NULL AS username, NULL AS num_img, COUNT(*) AS num_anno FROM {id_anno}
-            UNION ALL
-            SELECT username, iu_cnt AS num_img, anno_cnt AS num_anno FROM (
-            SELECT u.username, iu_cnt, anno_cnt
-            FROM (
-                SELECT DISTINCT(username) FROM (
-                    SELECT username FROM {id_auth}
-                    WHERE project = %s
-                    UNION ALL
-                    SELECT username FROM {id_iu}
-                    UNION ALL
-                    SELECT username FROM {id_anno}
-                ) AS uQuery
-            ) AS u
-            LEFT OUTER JOIN (
-                SELECT username, COUNT(*) AS iu_cnt
-                FROM {id_iu}
-                GROUP BY username
-            ) AS iu
-            ON u.username = iu.username
-            LEFT OUTER JOIN (
-                SELECT username, COUNT(*) AS anno_cnt
-                FROM {id_anno}
-                GROUP BY username
-            ) AS anno
-            ON u.username = anno.username
-            ORDER BY u.username
-        ) AS q;
-        ''').format(
-            id_img=sql.Identifier(project, 'image'),
-            id_iu=sql.Identifier(project, 'image_user'),
-            id_anno=sql.Identifier(project, 'annotation'),
-            id_auth=sql.Identifier('aide_admin', 'authentication')
-        )
-        result = self.dbConnector.execute(queryStr, (project,), 'all')
+        counters = projectCounters.get_counters(self.dbConnector, project)
 
         response = {
-            'num_images': result[0]['num_img'],
-            'num_viewed': result[1]['num_img'],
-            'num_goldenQuestions': result[2]['num_img'],
-            'num_annotated': result[3]['num_anno'],
-            'num_annotations': result[4]['num_anno']
+            'num_images': projectCounters.get_total(counters, 'num_images'),
+            'num_viewed': projectCounters.get_total(counters, 'num_viewed'),
+            'num_goldenQuestions': projectCounters.get_total(counters, 'num_golden'),
+            'num_annotated': projectCounters.get_total(counters, 'num_annotated'),
+            'num_annotations': projectCounters.get_total(counters, 'num_annotations')
         }
-        if len(result) > 5:
+
+        # per-user statistics: project members and users with views or annotations
+        viewedUser = counters.get('num_viewed_user', {})
+        annoUser = counters.get('num_anno_user', {})
+        members = self.dbConnector.execute(sql.SQL('''
+            SELECT username FROM {id_auth}
+            WHERE project = %s;
+        ''').format(
+            id_auth=sql.Identifier('aide_admin', 'authentication')
+        ), (project,), 'all')
+        usernames = set([m['username'] for m in members] if members is not None else [])
+        usernames.update([u for u in viewedUser.keys() if viewedUser[u] > 0])
+        usernames.update([u for u in annoUser.keys() if annoUser[u] > 0])
+        if len(usernames):
             response['user_stats'] = {}
-            for i in range(5, len(result)):
-                uStats = {
-                    'num_viewed': result[i]['num_img'],
-                    'num_annotations': result[i]['num_anno']
+            for username in sorted(usernames):
+                response['user_stats'][username] = {
+                    'num_viewed': (viewedUser[username] if viewedUser.get(username, 0) > 0 else None),
+                    'num_annotations': (annoUser[username] if annoUser.get(username, 0) > 0 else None)
                 }
-                response['user_stats'][result[i]['username']] = uStats
         return response
 
 
     def getLabelclassStatistics(self, project):
         '''
             Returns annotation statistics on a per-label class
-            basis.
+            basis, read from the project counters.
             TODO: does not work for segmentationMasks (no label fields)
         '''
-        queryStr = sql.SQL('''
-            SELECT lc.name, COALESCE(num_anno, 0) AS num_anno, COALESCE(num_pred, 0) AS num_pred
-            FROM {id_lc} AS lc
-            FULL OUTER JOIN (
-                SELECT label, COUNT(*) AS num_anno
-                FROM {id_anno} AS anno
-                GROUP BY label
-            ) AS annoCnt
-            ON lc.id = annoCnt.label
-            FULL OUTER JOIN (
-                SELECT label, COUNT(*) AS num_pred
-                FROM {id_pred} AS pred
-                GROUP BY label
-            ) AS predCnt
-            ON lc.id = predCnt.label
+        counters = projectCounters.get_counters(self.dbConnector, project)
+        annoClass = counters.get('num_anno_class', {})
+        predClass = counters.get('num_pred_class', {})
+
+        labelclasses = self.dbConnector.execute(sql.SQL('''
+            SELECT id, name FROM {id_lc};
         ''').format(
-            id_lc=sql.Identifier(project, 'labelclass'),
-            id_anno=sql.Identifier(project, 'annotation'),
-            id_pred=sql.Identifier(project, 'prediction')
-        )
-        result = self.dbConnector.execute(queryStr, None, 'all')
+            id_lc=sql.Identifier(project, 'labelclass')
+        ), None, 'all')
 
         response = {}
-        if result is not None and len(result):
-            for i in range(len(result)):
-                nextResult = result[i]
-                response[nextResult['name']] = {
-                    'num_anno': nextResult['num_anno'],
-                    'num_pred': nextResult['num_pred']
+        if labelclasses is not None:
+            for lc in labelclasses:
+                lcID = str(lc['id'])
+                response[lc['name']] = {
+                    'num_anno': annoClass.get(lcID, 0),
+                    'num_pred': predClass.get(lcID, 0)
                 }
         return response
 
@@ -146,7 +142,7 @@ class ProjectStatisticsMiddleware:
         return precision, recall, f1
 
 
-    def getPerformanceStatistics(self, project, entities_eval, entity_target, entityType='user', threshold=0.5, goldenQuestionsOnly=True):
+    def getPerformanceStatistics(self, project, entities_eval, entity_target, entityType='user', threshold=0.5, goldenQuestionsOnly=True, engine=None, matching=None):
         '''
             Compares the accuracy of a list of users or model states with a target
             user.
@@ -160,7 +156,8 @@ class ProjectStatisticsMiddleware:
                     IoU (max. with any target bounding box, regardless of label)
                     overall accuracy (labels)
             - segmentation masks:
-                    TODO
+                    overall accuracy (pixels labeled in both masks)
+                    precision, recall and F1 per label class
 
             Value 'threshold' determines the geometric requirement for an annotation to be
             counted as correct (or incorrect) as follows:
@@ -169,9 +166,34 @@ class ProjectStatisticsMiddleware:
 
             If 'goldenQuestionsOnly' is True, only images with flag 'isGoldenQuestion' = True
             will be considered for evaluation.
+
+            Value 'engine' selects how points and bounding boxes are evaluated:
+                - 'sql': in the database (see "statisticalFormulas.py")
+                - 'numpy': annotations are fetched once and matched in Python
+                           (see "geometricEvaluation.py"); 'matching' then
+                           determines the matching method ('greedy' or
+                           'hungarian')
+            Both default to the values in the configuration file.
+
+            Results are cached until the project data changes.
         '''
         entityType = entityType.lower()
-
+        if engine is None:
+            engine = self.evaluationEngine
+        engine = engine.lower()
+        if engine not in ('sql', 'numpy'):
+            raise Exception(f'Invalid evaluation engine "{engine}" (must be one of "sql", "numpy").')
+        if matching is None:
+            matching = self.evaluationMatching
+
+        key = ('performance', project, tuple(sorted(entities_eval)), entity_target, entityType,
+                threshold, bool(goldenQuestionsOnly), engine, matching)
+        return self.resultCache.get(key, self._get_data_version(project),
+                    lambda: self._get_performance_statistics(project, entities_eval, entity_target, entityType,
+                                threshold, goldenQuestionsOnly, engine, matching))
+
+
+    def _get_performance_statistics(self, project, entities_eval, entity_target, entityType, threshold, goldenQuestionsOnly, engine, matching):
         # get annotation type for project
         annoType = self.dbConnector.execute('''SELECT annotationType
             FROM aide_admin.project WHERE shortname = %s;''',
@@ -260,7 +282,12 @@ class ProjectStatisticsMiddleware:
                 }
             tokens_normalize = []
         
-        if entityType == 'user':
+        useNumPy = (engine == 'numpy' and annoType in ('points', 'boundingBoxes'))
+        if useNumPy:
+            rows = geometricEvaluation.evaluate(self.dbConnector, project, annoType, entityType,
+                        entity_target, entities_eval, threshold, goldenQuestionsOnly, matching)
+
+        elif entityType == 'user':
             queryStr = getattr(StatisticalFormulas_user, annoType).value
             queryStr = sql.SQL(queryStr).format(
                 id_anno=sql.Identifier(project, 'annotation'),
@@ -277,73 +304,64 @@ class ProjectStatisticsMiddleware:
                 sql_goldenQuestion=sql_goldenQuestion
             )
 
+        if not useNumPy:
+            rows = self.dbConnector.execute_cursor(queryStr, tuple(queryArgs), stream=True)
+
+        if annoType == 'segmentationMasks':
+            # decode masks and calculate confusion matrices in parallel
+            segClassIDs = [clID for clID in labelClasses.keys() if labelClasses[clID][0] is not None]
+            rows = segmentationEvaluation.evaluate(rows, ('username' if entityType == 'user' else 'cnnstate'),
+                        [labelClasses[clID][0] for clID in segClassIDs], self._get_segmentation_pool())
+
         #TODO: update points query (according to bboxes); re-write stats parsing below
 
         # get stats
         response = {}
-        with self.dbConnector.execute_cursor(queryStr, tuple(queryArgs)) as cursor:
-            while True:
-                b = cursor.fetchone()
-                if b is None:
-                    break
-
-                if entityType == 'user':
-                    entity = b['username']
-                else:
-                    entity = str(b['cnnstate'])
-
-                if not entity in response:
-                    response[entity] = tokens.copy()
-                if annoType in ('points', 'boundingBoxes'):
-                    response[entity]['num_matches'] = 1
-                    if b['num_target'] > 0:
-                        response[entity]['num_matches'] += 1
-                
-                if annoType == 'segmentationMasks':
-                    # decode segmentation masks
-                    try:
-                        mask_target = np.array(base64ToImage(b['q1segmask'], b['q1width'], b['q1height']))
-                        mask_source = np.array(base64ToImage(b['q2segmask'], b['q2width'], b['q2height']))
-                        
-                        if mask_target.shape == mask_source.shape and np.any(mask_target) and np.any(mask_source):
-
-                            # calculate OA
-                            intersection = (mask_target>0) * (mask_source>0)
-                            if np.any(intersection):
-                                oa = np.mean(mask_target[intersection] == mask_source[intersection])
-                                response[entity]['overall_accuracy'] += oa
-                                response[entity]['num_matches'] += 1
-
-                            # calculate per-class precision and recall values
-                            for clID in labelClasses.keys():
-                                idx = labelClasses[clID][0]
-                                tp = np.sum((mask_target==idx) * (mask_source==idx))
-                                fp = np.sum((mask_target!=idx) * (mask_source==idx))
-                                fn = np.sum((mask_target==idx) * (mask_source!=idx))
-                                if (tp+fp+fn) > 0:
-                                    prec, rec, f1 = self._calc_geometric_stats(tp, fp, fn)
-                                    response[entity]['per_class'][clID]['num_matches'] += 1
-                                    response[entity]['per_class'][clID]['prec'] += prec
-                                    response[entity]['per_class'][clID]['rec'] += rec
-                                    response[entity]['per_class'][clID]['f1'] += f1
-
-                    except Exception as e:
-                        print(f'TODO: error in segmentation mask statistics calculation ("{str(e)}").')
-
-                else:
-                    for key in tokens.keys():
-                        if key == 'correct' or key == 'incorrect':
-                            # classification
-                            correct = b['label_correct']
-                            # ignore None
-                            if correct is True:
-                                response[entity]['correct'] += 1
-                                response[entity]['num_matches'] += 1
-                            elif correct is False:
-                                response[entity]['incorrect'] += 1
-                                response[entity]['num_matches'] += 1
-                        elif key in b and b[key] is not None:
-                            response[entity][key] += b[key]
+        for b in rows:
+            if entityType == 'user':
+                entity = b['username']
+            else:
+                entity = str(b['cnnstate'])
+
+            if not entity in response:
+                response[entity] = copy.deepcopy(tokens)
+            if annoType in ('points', 'boundingBoxes'):
+                # number of images the average IoU, resp. distance is taken over
+                if not 'num_matches' in response[entity]:
+                    response[entity]['num_matches'] = 0
+                if b[tokens_normalize[0]] is not None:
+                    response[entity]['num_matches'] += 1
+            
+            if annoType == 'segmentationMasks':
+                if b['overall_accuracy'] is not None:
+                    response[entity]['overall_accuracy'] += b['overall_accuracy']
+                    response[entity]['num_matches'] += 1
+
+                # per-class precision and recall values
+                if b['counts'] is not None:
+                    for c, clID in enumerate(segClassIDs):
+                        tp, fp, fn = b['counts'][c]
+                        if (tp+fp+fn) > 0:
+                            prec, rec, f1 = self._calc_geometric_stats(tp, fp, fn)
+                            response[entity]['per_class'][clID]['num_matches'] += 1
+                            response[entity]['per_class'][clID]['prec'] += prec
+                            response[entity]['per_class'][clID]['rec'] += rec
+                            response[entity]['per_class'][clID]['f1'] += f1
+
+            else:
+                for key in tokens.keys():
+                    if key == 'correct' or key == 'incorrect':
+                        # classification
+                        correct = b['label_correct']
+                        # ignore None
+                        if correct is True:
+                            response[entity]['correct'] += 1
+                            response[entity]['num_matches'] += 1
+                        elif correct is False:
+                            response[entity]['incorrect'] += 1
+                            response[entity]['num_matches'] += 1
+                    elif key in b and b[key] is not None:
+                        response[entity][key] += b[key]
 
         for entity in response.keys():
             for t in tokens_normalize:
@@ -351,7 +369,7 @@ class ProjectStatisticsMiddleware:
                     if t == 'overall_accuracy':
                         response[entity][t] = float(response[entity]['correct']) / \
                             float(response[entity]['correct'] + response[entity]['incorrect'])
-                    elif annoType in ('points', 'boundingBoxes'):
+                    elif annoType in ('points', 'boundingBoxes') and response[entity]['num_matches'] > 0:
                         response[entity][t] /= response[entity]['num_matches']
 
             if annoType == 'points' or annoType == 'boundingBoxes':
@@ -366,7 +384,8 @@ class ProjectStatisticsMiddleware:
 
             elif annoType == 'segmentationMasks':
                 # normalize OA
-                response[entity]['overall_accuracy'] /= response[entity]['num_matches']
+                if response[entity]['num_matches'] > 0:
+                    response[entity]['overall_accuracy'] /= response[entity]['num_matches']
 
                 # normalize all label class values as well
                 for lcID in labelClasses.keys():
@@ -389,7 +408,13 @@ class ProjectStatisticsMiddleware:
             We deliberately do not reveal more information to the general
             user, in order to e.g. sustain the golden question limitation
             system.
+            Results are cached until the project data changes.
         '''
+        return self.resultCache.get(('user_finished', project, username), self._get_data_version(project),
+                    lambda: self._get_user_finished(project, username))
+
+
+    def _get_user_finished(self, project, username):
         queryStr = sql.SQL('''
             SELECT COUNT(*) AS cnt FROM {id_iu}
             WHERE viewcount > 0 AND username = %s
@@ -403,44 +428,36 @@ class ProjectStatisticsMiddleware:
         return result[0]['cnt'] >= result[1]['cnt']
 
 
-    def getTimeActivity(self, project, type='images', numDaysMax=31, perUser=False):
+    def getTimeActivity(self, project, type='images', numDaysMax=31, perUser=False, resolution='day'):
         '''
             Returns a histogram of the number of images viewed (if type = 'images')
-            or annotations made (if type = 'annotations') over the last numDaysMax.
+            or annotations made (if type = 'annotations') over the last numDaysMax,
+            per day or hour (resolution), along with the time required for them.
+            Days (resp. hours) without activity are included with zero counts.
             If perUser is True, statistics are returned on a user basis.
         '''
-        if type == 'images':
-            id_table = sql.Identifier(project, 'image_user')
-            time_field = sql.SQL('last_checked')
+        if type in ('image', 'images'):
+            table = 'image_user'
         else:
-            id_table = sql.Identifier(project, 'annotation')
-            time_field = sql.SQL('timeCreated')
-        
-        if perUser:
-            userSpec = sql.SQL(', username')
+            table = 'annotation'
+        numDaysMax = max(1, int(numDaysMax))
+        now = datetime.now(tz=pytz.utc)
+        if resolution == 'hour':
+            start = now - timedelta(days=numDaysMax)
+            labelFormat = '%Y-%b-%d %H:00'
         else:
-            userSpec = sql.SQL('')
-        queryStr = sql.SQL('''
-            SELECT to_char({time_field}, 'YYYY-Mon-dd') AS month_day, MIN({time_field}) AS date_of_day, COUNT(*) AS cnt {user_spec}
-            FROM {id_table}
-            WHERE {time_field} IS NOT NULL
-            GROUP BY month_day {user_spec}
-            ORDER BY date_of_day ASC
-            LIMIT %s
-        ''').format(
-            time_field=time_field,
-            id_table=id_table,
-            user_spec=userSpec
-        )
-        result = self.dbConnector.execute(queryStr, (numDaysMax,), 'all')
+            start = now - timedelta(days=numDaysMax-1)
+            labelFormat = '%Y-%b-%d'
 
-        #TODO: homogenize series and add missing days
+        result = activityRollup.get_activity(self.dbConnector, project, table,
+                        start, now + timedelta(microseconds=1), resolution, perUser)
 
         if perUser:
             response = {}
         else:
             response = {
                 'counts': [],
+                'time_required': [],
                 'timestamps': [],
                 'labels': []
             }
@@ -450,14 +467,15 @@ class ProjectStatisticsMiddleware:
                 if row['username'] not in response:
                     response[row['username']] = {
                         'counts': [],
+                        'time_required': [],
                         'timestamps': [],
                         'labels': []
                     }
-                response[row['username']]['counts'].append(row['cnt'])
-                response[row['username']]['timestamps'].append(row['date_of_day'].timestamp())
-                response[row['username']]['labels'].append(row['month_day'])
+                series = response[row['username']]
             else:
-                response['counts'].append(row['cnt'])
-                response['timestamps'].append(row['date_of_day'].timestamp())
-                response['labels'].append(row['month_day'])
+                series = response
+            series['counts'].append(row['cnt'])
+            series['time_required'].append(row['time_required'])
+            series['timestamps'].append(row['bucket'].timestamp())
+            series['labels'].append(row['bucket'].strftime(labelFormat))
         return response
\ No newline at end of file
@@ -0,0 +1,72 @@
+'''
+    In-memory cache of project statistics (e.g. performance evaluations),
+    which are expensive to compute but only change along with the project
+    data. Every entry is stored together with the data version of the
+    project at the time it was computed (see "util/projectCounters.py");
+    it is served as long as the project's data version stays the same and
+    recomputed as soon as anything has been modified (by any process).
+
+    2020 Benjamin Kellenberger
+'''
+
+import copy
+import threading
+from collections import OrderedDict
+
+
+class ResultCache:
+
+    def __init__(self, maxEntries=256):
+        '''
+            Inputs:
+            - maxEntries: maximum number of results kept in memory; zero
+                          disables the cache
+        '''
+        self.maxEntries = maxEntries
+        self._lock = threading.Lock()
+
+        # key -> (data version, result)
+        self.entries = OrderedDict()
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0
+        }
+
+
+    def get(self, key, version, loadFun):
+        '''
+            Returns the result for the given key (a hashable tuple) if it has
+            been computed for the given data version. Otherwise, the result
+            is obtained by calling "loadFun" (without arguments) and cached,
+            unless it or the version is None. The data version is to be
+            determined before calling this function, so that changes made
+            while the result is computed invalidate it.
+            Returns a copy, so that callers may modify the result.
+        '''
+        if self.maxEntries <= 0 or version is None:
+            return loadFun()
+
+        with self._lock:
+            entry = self.entries.get(key, None)
+            if entry is not None and entry[0] == version:
+                self.stats['hits'] += 1
+                self.entries.move_to_end(key)
+                return copy.deepcopy(entry[1])
+            self.stats['misses'] += 1
+
+        result = loadFun()
+        if result is not None:
+            with self._lock:
+                self.entries[key] = (version, copy.deepcopy(result))
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.maxEntries:
+                    self.entries.popitem(last=False)
+        return result
+
+
+    def get_statistics(self):
+        with self._lock:
+            stats = self.stats.copy()
+            stats['cached'] = len(self.entries)
+            return stats
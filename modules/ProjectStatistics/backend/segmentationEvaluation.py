@@ -0,0 +1,131 @@
+'''
+    Evaluation of segmentation masks through confusion matrices. Every pair
+    of target and evaluated mask is decoded and reduced to a single
+    confusion matrix (one "np.bincount" call), from which the overall
+    accuracy and the per-class true positives, false positives and false
+    negatives are derived. Pairs are distributed over a pool of processes,
+    which is created once (see "create_pool") and reused across requests.
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import itertools
+import multiprocessing
+import numpy as np
+from util.helpers import base64ToImage
+
+
+# upper limit of the number of processes if not specified explicitly
+DEFAULT_MAX_WORKERS = 4
+
+
+def confusion_matrix(target, source, numClasses):
+    '''
+        Returns the confusion matrix (rows: target, columns: source) of two
+        label index rasters of equal shape, with at least "numClasses" rows
+        and columns.
+    '''
+    target = np.asarray(target).ravel()
+    source = np.asarray(source).ravel()
+    numClasses = max(numClasses, int(target.max()) + 1, int(source.max()) + 1)
+    index = target.astype(np.intp)
+    index *= numClasses
+    index += source
+    return np.bincount(index, minlength=numClasses**2).reshape(numClasses, numClasses)
+
+
+def evaluate_pair(target, source, classIndices):
+    '''
+        Compares a target and source mask. Returns the overall accuracy
+        (fraction of pixels labeled in both masks that agree; None if no
+        pixel is labeled in both) and an array of (tp, fp, fn) per entry in
+        "classIndices". Returns None if the masks differ in shape or either
+        of them is empty.
+    '''
+    if target.shape != source.shape or not np.any(target) or not np.any(source):
+        return None
+
+    numClasses = (max(classIndices) + 1 if len(classIndices) else 1)
+    cm = confusion_matrix(target, source, numClasses)
+
+    # overall accuracy over pixels labeled in both masks
+    numLabeled = cm[1:, 1:].sum()
+    if numLabeled > 0:
+        oa = float(np.trace(cm[1:, 1:])) / float(numLabeled)
+    else:
+        oa = None
+
+    idx = np.array(classIndices, dtype=np.int64)
+    tp = cm[idx, idx]
+    fp = cm[:, idx].sum(axis=0) - tp
+    fn = cm[idx, :].sum(axis=1) - tp
+    return oa, np.stack((tp, fp, fn), axis=1)
+
+
+def _evaluate_row(args):
+    entity, targetMask, targetSize, sourceMask, sourceSize, classIndices = args
+    try:
+        target = base64ToImage(targetMask, targetSize[0], targetSize[1], toPIL=False)
+        source = base64ToImage(sourceMask, sourceSize[0], sourceSize[1], toPIL=False)
+        return entity, evaluate_pair(target, source, classIndices), None
+    except Exception as e:
+        return entity, None, str(e)
+
+
+def create_pool(numWorkers=0):
+    '''
+        Returns a pool of "numWorkers" processes (0: number of CPU cores, but
+        at most DEFAULT_MAX_WORKERS) for "evaluate". The processes are
+        spawned rather than forked, so that they do not inherit the threads,
+        sockets and database connections of the serving process. Returns
+        None if one worker is requested or the current process cannot have
+        child processes (e.g. Celery workers).
+    '''
+    if numWorkers <= 0:
+        numWorkers = min(os.cpu_count() or 1, DEFAULT_MAX_WORKERS)
+    if numWorkers == 1 or multiprocessing.current_process().daemon:
+        return None
+    return multiprocessing.get_context('spawn').Pool(numWorkers)
+
+
+def evaluate(rows, entityKey, classIndices, pool=None, chunkSize=16, batchSize=256):
+    '''
+        Evaluates the rows of the segmentation mask formulas (see
+        "statisticalFormulas.py"). Yields a dict per row with the entity
+        (under "entityKey"), the overall accuracy ("overall_accuracy") and
+        the (tp, fp, fn) per class index ("counts"), as returned by
+        "evaluate_pair" (both None if the pair could not be evaluated).
+
+        The rows are consumed lazily (e.g. from a streaming cursor) and
+        decoded and evaluated by the processes of "pool" (see
+        "create_pool"), in batches of "batchSize" rows so that only a
+        bounded number of masks is held in memory. Without a pool,
+        everything is evaluated in the current process.
+    '''
+    classIndices = list(classIndices)
+    tasks = ((r[entityKey], r['q1segmask'], (r['q1width'], r['q1height']),
+                r['q2segmask'], (r['q2width'], r['q2height']), classIndices) for r in rows)
+
+    def _handle(result):
+        entity, pairResult, error = result
+        if error is not None:
+            print(f'Error in segmentation mask statistics calculation ("{error}").')
+        if pairResult is None:
+            pairResult = (None, None)
+        return {
+            entityKey: entity,
+            'overall_accuracy': pairResult[0],
+            'counts': pairResult[1]
+        }
+
+    if pool is None:
+        for task in tasks:
+            yield _handle(_evaluate_row(task))
+    else:
+        while True:
+            batch = list(itertools.islice(tasks, batchSize))
+            if not len(batch):
+                break
+            for result in pool.imap_unordered(_evaluate_row, batch, chunksize=chunkSize):
+                yield _handle(result)
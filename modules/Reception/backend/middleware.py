@@ -7,6 +7,8 @@
 from psycopg2 import sql
 from modules.Database.app import Database
 from util.helpers import current_time
+from util.tableSample import TableSampler
+from util import authCache
 
 
 class ReceptionMiddleware:
@@ -14,6 +16,7 @@ class ReceptionMiddleware:
     def __init__(self, config):
         self.config = config
         self.dbConnector = Database(config)
+        self.tableSampler = TableSampler(self.dbConnector)
 
 
     def get_project_info(self, username=None, isSuperUser=False):
@@ -111,6 +114,7 @@ class ReceptionMiddleware:
             ON CONFLICT (username, project) DO NOTHING;
             '''
             self.dbConnector.execute(queryStr, (username,project,), None)
+            authCache.invalidate(project, username)
             return True
         except Exception as e:
             print(e)
@@ -128,7 +132,30 @@ class ReceptionMiddleware:
             3. number of annotations
             4. number of predictions
             5. random
+            For large projects, images are drawn from a random sample of the
+            image table, with annotation and prediction counts taken from the
+            per-image aggregates.
         '''
+        samplePercentage = self.tableSampler.get_percentage(project, limit)
+        if samplePercentage is not None:
+            queryStr = sql.SQL('''
+                SELECT filename FROM {id_img} AS img
+                TABLESAMPLE SYSTEM (%s)
+                LEFT OUTER JOIN {id_stats} AS stats
+                ON img.id = stats.image
+                ORDER BY last_requested DESC NULLS LAST, date_added DESC NULLS LAST,
+                    num_anno DESC NULLS LAST, num_pred DESC NULLS LAST, random()
+                LIMIT %s;
+            ''').format(
+                id_img=sql.Identifier(project, 'image'),
+                id_stats=sql.Identifier(project, 'image_stats')
+            )
+            result = self.dbConnector.execute(queryStr, (samplePercentage, limit,), 'all')
+            if result is not None:
+                self.tableSampler.report(project, limit, len(result))
+                if len(result) == limit:
+                    return [r['filename'] for r in result]
+
         queryStr = sql.SQL('''
             SELECT filename FROM {id_img} AS img
             LEFT OUTER JOIN (
@@ -5,16 +5,17 @@
     2019-20 Benjamin Kellenberger
 '''
 
-from threading import Thread
 from modules.Database.app import Database
 import psycopg2
 from psycopg2 import sql
 from datetime import timedelta
 from util.helpers import current_time, checkDemoMode
+from util import authCache
 import secrets
 import hashlib
 import bcrypt
 from .exceptions import *
+from .session_store import get_session_store, SessionWriter
 
 
 class UserMiddleware():
@@ -27,7 +28,13 @@ class UserMiddleware():
         self.config = config
         self.dbConnector = Database(config)
 
-        self.usersLoggedIn = {}    # username -> {timestamp, sessionToken}
+        # sessions of logged in users and bulk writer of session extensions
+        self.sessionStore = get_session_store(self.config)
+        self.sessionWriter = SessionWriter(self.dbConnector,
+            self.config.getProperty('UserHandler', 'session_write_interval', type=float, fallback=2.0))
+
+        self.authCache = authCache.get_authorization_cache(
+            self.config.getProperty('UserHandler', 'auth_cache_ttl', type=float, fallback=5.0))
     
 
     def _current_time(self):
@@ -65,24 +72,14 @@ class UserMiddleware():
     def _extend_session_database(self, username, sessionToken):
         '''
             Updates the last login timestamp of the user to the current
-            time and commits the changes to the database.
-            Runs in a thread to be non-blocking.
+            time. The database write is deferred to the session writer,
+            which commits all pending extensions in bulk.
         '''
-        def _extend_session():
-            now = self._current_time()
+        now = self._current_time()
+        self.sessionWriter.add(username, sessionToken, now)
 
-            self.dbConnector.execute('''UPDATE aide_admin.user SET last_login = %s,
-                    session_token = %s
-                    WHERE name = %s
-                ''',
-                (now, sessionToken, username,),
-                numReturn=None)
-            
-            # also update local cache
-            self.usersLoggedIn[username]['timestamp'] = now
-        
-        eT = Thread(target=_extend_session)
-        eT.start()
+        # also update session store
+        self.sessionStore.touch(username, now)
 
 
     def _init_or_extend_session(self, username, sessionToken=None):
@@ -102,24 +99,11 @@ class UserMiddleware():
             ''',
             (now, sessionToken, username,),
             numReturn=None)
-            
-            # store locally
-            self.usersLoggedIn[username] = {
-                'timestamp': now,
-                'sessionToken': sessionToken
-            }
+            self.sessionStore.set(username, sessionToken, now)
 
-        # update local cache as well
-        if not username in self.usersLoggedIn:
-            self.usersLoggedIn[username] = {
-                'timestamp': now,
-                'sessionToken': sessionToken
-            }
         else:
-            self.usersLoggedIn[username]['timestamp'] = now
-            self.usersLoggedIn[username]['sessionToken'] = sessionToken
-
-            # also tell DB about updated tokens
+            # update session store and tell DB about extended session
+            self.sessionStore.set(username, sessionToken, now)
             self._extend_session_database(username, sessionToken)
 
         expires = now + timedelta(0, self.config.getProperty('UserHandler', 'time_login', type=int))
@@ -128,8 +112,9 @@ class UserMiddleware():
 
 
     def _invalidate_session(self, username):
-        if username in self.usersLoggedIn:
-            del self.usersLoggedIn[username]
+        self.sessionStore.delete(username)
+        self.sessionWriter.discard(username)
+        self.authCache.invalidate(username=username)
         self.dbConnector.execute(
             'UPDATE aide_admin.user SET session_token = NULL WHERE name = %s',
             (username,),
@@ -157,7 +142,8 @@ class UserMiddleware():
     def _check_logged_in(self, username, sessionToken):
         now = self._current_time()
         time_login = self.config.getProperty('UserHandler', 'time_login', type=int)
-        if not username in self.usersLoggedIn:
+        session = self.sessionStore.get(username)
+        if session is None:
             # check database
             result = self._get_user_data(username)
             if result is None:
@@ -173,13 +159,7 @@ class UserMiddleware():
             time_diff = (now - result['last_login']).total_seconds()
             if time_diff <= time_login:
                 # user still logged in
-                if not username in self.usersLoggedIn:
-                    self.usersLoggedIn[username] = {
-                        'timestamp': now,
-                        'sessionToken': sessionToken
-                    }
-                else:
-                    self.usersLoggedIn[username]['timestamp'] = now
+                self.sessionStore.set(username, sessionToken, now)
 
                 # extend user session (commit to DB) if needed
                 if time_diff >= 0.75 * time_login:
@@ -190,47 +170,39 @@ class UserMiddleware():
             else:
                 # session time-out
                 return False
-            
-            # generic error
-            return False
         
         else:
-            # check locally
-            if not self._compare_tokens(self.usersLoggedIn[username]['sessionToken'],
-                    sessionToken):
+            # check session store
+            if not self._compare_tokens(session['sessionToken'], sessionToken):
                 # invalid session token provided; check database if token has updated
                 # (can happen if user logs in again from another machine)
                 result = self._get_user_data(username)
-                if not self._compare_tokens(result['session_token'],
+                if result is None or not self._compare_tokens(result['session_token'],
                             sessionToken):
                     return False
                 
                 else:
-                    # update local cache
-                    self.usersLoggedIn[username]['sessionToken'] = result['session_token']
-                    self.usersLoggedIn[username]['timestamp'] = now
+                    # update session store
+                    self.sessionStore.set(username, result['session_token'], now)
+                    session['timestamp'] = now
 
-            if (now - self.usersLoggedIn[username]['timestamp']).total_seconds() <= time_login:
+            if (now - session['timestamp']).total_seconds() <= time_login:
                 # user still logged in
                 return True
 
             else:
-                # local cache session time-out; check if database holds more recent timestamp
+                # session store time-out; check if database holds more recent timestamp
                 result = self._get_user_data(username)
-                if (now - result['last_login']).total_seconds() <= time_login:
+                if result is not None and self._compare_tokens(result['session_token'], sessionToken) \
+                        and (now - result['last_login']).total_seconds() <= time_login:
                     # user still logged in; update
                     self._init_or_extend_session(username, sessionToken)
+                    return True
 
                 else:
                     # session time-out
                     return False
 
-            # generic error
-            return False
-        
-        # generic error
-        return False
-
 
     def _check_authorized(self, project, username, admin, return_all=False):
         '''
@@ -263,27 +235,35 @@ class UserMiddleware():
             'isPublic': False
         }
 
-        queryStr = sql.SQL('''
-            SELECT * FROM aide_admin.authentication AS auth
-            JOIN (SELECT shortname, demoMode, isPublic FROM aide_admin.project) AS proj
-            ON auth.project = proj.shortname
-            WHERE project = %s AND username = %s;
-        ''')
-        try:
-            result = self.dbConnector.execute(queryStr, (project, username,), 1)
-            if len(result):
-                response['isAdmin'] = result[0]['isadmin']
-                response['isPublic'] = result[0]['ispublic']
-                admitted_until = True
-                blocked_until = False
-                if result[0]['admitted_until'] is not None:
-                    admitted_until = (result[0]['admitted_until'] >= now)
-                if result[0]['blocked_until'] is not None:
-                    blocked_until = (result[0]['blocked_until'] >= now)
-                response['enrolled'] = (admitted_until and not blocked_until)
-        except:
-            # no results to fetch: user is not authenticated
-            pass
+        def _load_authorization():
+            queryStr = sql.SQL('''
+                SELECT isAdmin, isPublic, admitted_until, blocked_until
+                FROM aide_admin.authentication AS auth
+                JOIN (SELECT shortname, demoMode, isPublic FROM aide_admin.project) AS proj
+                ON auth.project = proj.shortname
+                WHERE project = %s AND username = %s;
+            ''')
+            try:
+                result = self.dbConnector.execute(queryStr, (project, username,), 1)
+                if len(result):
+                    return result[0]
+            except:
+                # no results to fetch: user is not authenticated
+                pass
+            return None
+
+        result = (self.authCache.get(('authorization', project, username), _load_authorization)
+                    if username is not None else None)
+        if result is not None:
+            response['isAdmin'] = result['isadmin']
+            response['isPublic'] = result['ispublic']
+            admitted_until = True
+            blocked_until = False
+            if result['admitted_until'] is not None:
+                admitted_until = (result['admitted_until'] >= now)
+            if result['blocked_until'] is not None:
+                blocked_until = (result['blocked_until'] >= now)
+            response['enrolled'] = (admitted_until and not blocked_until)
     
         # check if super user
         superUser = self._check_user_privileges(username, superuser=True)
@@ -317,13 +297,22 @@ class UserMiddleware():
 
 
     def checkDemoMode(self, project):
-        return checkDemoMode(project, self.dbConnector)
+        if project is None:
+            return None
+        return self.authCache.get(('demoMode', project, None),
+                    lambda: checkDemoMode(project, self.dbConnector))
+
+
+    def _get_secret_token(self, username):
+        def _load_secret_token():
+            userdata = self._get_user_data(username)
+            return (userdata['secret_token'] if userdata is not None else None)
+        return self.authCache.get(('secretToken', None, username), _load_secret_token)
 
 
     def decryptSessionToken(self, username, request):
         try:
-            userdata = self._get_user_data(username)
-            return request.get_cookie('session_token', secret=userdata['secret_token'])
+            return request.get_cookie('session_token', secret=self._get_secret_token(username))
         except:
             return None
 
@@ -339,23 +328,29 @@ class UserMiddleware():
             'superuser': False,
             'can_create_projects': False
         }
-        result = self.dbConnector.execute('''SELECT isSuperUser, canCreateProjects
-            FROM aide_admin.user WHERE name = %s;''',
-            (username,),
-            1)
-        
-        if len(result):
-            response['superuser'] = result[0]['issuperuser']
-            response['can_create_projects'] = result[0]['cancreateprojects']
+        def _load_privileges():
+            result = self.dbConnector.execute('''SELECT isSuperUser, canCreateProjects
+                FROM aide_admin.user WHERE name = %s;''',
+                (username,),
+                1)
+            if len(result):
+                return result[0]
+            return None
+
+        result = (self.authCache.get(('privileges', None, username), _load_privileges)
+                    if username is not None else None)
+        if result is not None:
+            response['superuser'] = result['issuperuser']
+            response['can_create_projects'] = result['cancreateprojects']
 
         if return_all:
             return response
         
         else:
-            if superuser and not result[0]['issuperuser']:
+            if superuser and not response['superuser']:
                 return False
             if canCreateProjects and not (
-                result[0]['cancreateprojects'] or result[0]['issuperuser']):
+                response['can_create_projects'] or response['superuser']):
                 return False
             return True
 
@@ -376,7 +371,7 @@ class UserMiddleware():
             If 'return_all' is True, all individual flags (instead of just a single bool) is returned.
         '''
 
-        demoMode = checkDemoMode(project, self.dbConnector)
+        demoMode = self.checkDemoMode(project)
 
         if return_all:
             returnVals = {}
@@ -477,7 +472,7 @@ class UserMiddleware():
 
         try:
             # demo mode
-            response['demoMode'] = checkDemoMode(project, self.dbConnector)
+            response['demoMode'] = self.checkDemoMode(project)
 
             # rest
             queryStr = sql.SQL('SELECT * FROM {id_auth} WHERE project = %s AND username = %s').format(
@@ -0,0 +1,317 @@
+'''
+    Storage of user sessions (session token and time of last activity) for
+    the login checks of "UserMiddleware". The database (columns
+    "session_token" and "last_login" of "aide_admin.user") remains the
+    source of truth; the stores below only avoid querying it upon every
+    request:
+    - LocalSessionStore: bounded in-memory dict of the current process
+    - SQLiteSessionStore: SQLite file shared by all processes on the same
+                          machine (e.g. all Gunicorn workers), so that a
+                          session seen by one worker is known to all others
+
+    Extensions of sessions are not written to the database upon every
+    request, but collected by a SessionWriter and written in bulk by a
+    single background thread.
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import stat
+import atexit
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+from collections import OrderedDict
+import pytz
+from psycopg2.extras import execute_values
+
+
+class SessionStore(ABC):
+    '''
+        Interface of session stores. Sessions are dicts with keys
+        "sessionToken" and "timestamp" (time of last activity).
+    '''
+
+    @abstractmethod
+    def get(self, username):
+        '''
+            Returns the session of the user, or None if unknown.
+        '''
+        pass
+
+
+    @abstractmethod
+    def set(self, username, sessionToken, timestamp):
+        '''
+            Stores (or replaces) the session of the user.
+        '''
+        pass
+
+
+    @abstractmethod
+    def touch(self, username, timestamp):
+        '''
+            Updates the time of last activity of an existing session.
+        '''
+        pass
+
+
+    @abstractmethod
+    def delete(self, username):
+        '''
+            Removes the session of the user.
+        '''
+        pass
+
+
+
+class LocalSessionStore(SessionStore):
+
+    def __init__(self, maxEntries=10000):
+        self.maxEntries = maxEntries
+        self._lock = threading.Lock()
+        self.sessions = OrderedDict()      # username -> {timestamp, sessionToken}
+
+
+    def get(self, username):
+        with self._lock:
+            session = self.sessions.get(username, None)
+            if session is None:
+                return None
+            self.sessions.move_to_end(username)
+            return session.copy()
+
+
+    def set(self, username, sessionToken, timestamp):
+        with self._lock:
+            self.sessions[username] = {
+                'timestamp': timestamp,
+                'sessionToken': sessionToken
+            }
+            self.sessions.move_to_end(username)
+            while len(self.sessions) > self.maxEntries:
+                self.sessions.popitem(last=False)
+
+
+    def touch(self, username, timestamp):
+        with self._lock:
+            session = self.sessions.get(username, None)
+            if session is not None and session['timestamp'] < timestamp:
+                session['timestamp'] = timestamp
+
+
+    def delete(self, username):
+        with self._lock:
+            self.sessions.pop(username, None)
+
+
+
+class SQLiteSessionStore(SessionStore):
+    '''
+        Sessions are kept in an SQLite database file in WAL mode, which
+        allows concurrent readers and a single writer across processes.
+        Errors (e.g. a locked or unwritable file) are treated as unknown
+        sessions, so that the login checks fall back to the database.
+
+        Since the file contains the session tokens of all users, it is
+        only accessible to the owner (mode 0600) and must not be owned by
+        another user.
+    '''
+
+    def __init__(self, filePath, timeout=1.0):
+        self.filePath = filePath
+        self.timeout = timeout
+        self._local = threading.local()
+
+        parent = os.path.dirname(self.filePath)
+        if len(parent):
+            os.makedirs(parent, mode=0o700, exist_ok=True)
+        self._create_private_file()
+        conn = self._get_connection()
+        conn.execute('PRAGMA journal_mode=WAL;')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS session (
+                username TEXT PRIMARY KEY,
+                session_token TEXT NOT NULL,
+                timestamp REAL NOT NULL
+            );
+        ''')
+
+
+    def _create_private_file(self):
+        fd = os.open(self.filePath, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fileStat = os.fstat(fd)
+            if fileStat.st_uid != os.getuid():
+                raise Exception(f'Session store "{self.filePath}" is owned by another user.')
+            if stat.S_IMODE(fileStat.st_mode) & (stat.S_IRWXG | stat.S_IRWXO):
+                os.fchmod(fd, 0o600)
+        finally:
+            os.close(fd)
+
+
+    def _get_connection(self):
+        # one connection per thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filePath, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL;')
+            self._local.conn = conn
+        return conn
+
+
+    def _execute(self, query, arguments):
+        try:
+            return self._get_connection().execute(query, arguments).fetchall()
+        except Exception as e:
+            print(f'Error accessing session store "{self.filePath}" (message: "{str(e)}").')
+            return None
+
+
+    def get(self, username):
+        result = self._execute('SELECT session_token, timestamp FROM session WHERE username = ?;', (username,))
+        if result is None or not len(result):
+            return None
+        return {
+            'timestamp': datetime.fromtimestamp(result[0][1], tz=pytz.utc),
+            'sessionToken': result[0][0]
+        }
+
+
+    def set(self, username, sessionToken, timestamp):
+        self._execute('''
+            INSERT INTO session (username, session_token, timestamp)
+            VALUES (?, ?, ?)
+            ON CONFLICT (username) DO UPDATE SET
+                session_token = excluded.session_token,
+                timestamp = excluded.timestamp;
+        ''', (username, sessionToken, timestamp.timestamp()))
+
+
+    def touch(self, username, timestamp):
+        self._execute('''
+            UPDATE session SET timestamp = MAX(timestamp, ?)
+            WHERE username = ?;
+        ''', (timestamp.timestamp(), username))
+
+
+    def delete(self, username):
+        self._execute('DELETE FROM session WHERE username = ?;', (username,))
+
+
+
+def get_session_store(config):
+    '''
+        Returns the session store as specified in the configuration file
+        (option "session_store" under "[UserHandler]").
+    '''
+    storeType = config.getProperty('UserHandler', 'session_store', type=str, fallback='local').lower()
+    if storeType == 'sqlite':
+        filePath = config.getProperty('UserHandler', 'session_store_path', type=str, fallback=None)
+        if filePath is None or not len(filePath):
+            # private directory next to the configuration file
+            if 'AIDE_CONFIG_PATH' in os.environ:
+                baseDir = os.path.dirname(os.path.abspath(os.environ['AIDE_CONFIG_PATH']))
+            else:
+                baseDir = os.path.join(os.path.expanduser('~'), '.aide')
+            filePath = os.path.join(baseDir, 'sessions', 'aide_sessions.sqlite')
+        return SQLiteSessionStore(filePath)
+    elif storeType == 'local':
+        return LocalSessionStore(config.getProperty('UserHandler', 'session_store_max_size', type=int, fallback=10000))
+    else:
+        raise Exception(f'Invalid session store "{storeType}" (must be one of "local", "sqlite").')
+
+
+
+class SessionWriter:
+    '''
+        Collects extensions of user sessions (one entry per user, the latest
+        one winning) and writes them to the database in a single statement
+        every "interval" seconds. Extensions only apply if the session token
+        in the database is still the one that was extended, so that a later
+        login or logout is never overwritten.
+    '''
+
+    def __init__(self, dbConnector, interval=2.0):
+        self.dbConnector = dbConnector
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+        # username -> (session token, timestamp)
+        self.pending = {}
+
+        self.stats = {
+            'extensions': 0,
+            'flushes': 0,
+            'flush_errors': 0,
+            'entries_flushed': 0
+        }
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+
+    def add(self, username, sessionToken, timestamp):
+        with self._lock:
+            self.pending[username] = (sessionToken, timestamp)
+            self.stats['extensions'] += 1
+
+
+    def discard(self, username):
+        with self._lock:
+            self.pending.pop(username, None)
+
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+    def flush(self):
+        with self._flushLock:
+            with self._lock:
+                pending, self.pending = self.pending, {}
+            if not len(pending):
+                return
+            try:
+                with self.dbConnector.transaction() as cursor:
+                    execute_values(cursor, '''
+                        UPDATE aide_admin.user AS u
+                        SET last_login = GREATEST(u.last_login, v.last_login)
+                        FROM (VALUES %s) AS v(name, session_token, last_login)
+                        WHERE u.name = v.name
+                        AND u.session_token = v.session_token;
+                    ''', sorted([(username, token, timestamp) for username, (token, timestamp) in pending.items()]))
+                with self._lock:
+                    self.stats['flushes'] += 1
+                    self.stats['entries_flushed'] += len(pending)
+            except Exception as e:
+                print(f'Error writing session extensions (message: "{str(e)}").')
+                with self._lock:
+                    self.stats['flush_errors'] += 1
+                    # put back; entries that arrived in the meantime are newer
+                    for username, entry in pending.items():
+                        if username not in self.pending:
+                            self.pending[username] = entry
+
+
+    def close(self):
+        self._stopped = True
+        self._wakeup.set()
+        self.flush()
+
+
+    def get_statistics(self):
+        with self._lock:
+            stats = self.stats.copy()
+            stats['pending'] = len(self.pending)
+            return stats
@@ -82,6 +82,7 @@ if __name__ == '__main__':
     import datetime
     from PIL import Image
     from util.configDef import Config
+    from util import imageStats
     from modules import Database
 
     if args.label_folder == '':
@@ -162,39 +163,11 @@ if __name__ == '__main__':
             
             print(f'Inserting annotations under username "{username}".')
 
-            queryStr = sql.SQL('''
-            INSERT INTO {id_anno} (username, image, timeCreated, timeRequired, label, x, y, width, height)
-            VALUES(
-                %s,
-                (SELECT id FROM {id_img} WHERE filename = %s),
-                (TIMESTAMP %s),
-                -1,
-                %s,
-                %s,
-                %s,
-                %s,
-                %s
-            );''').format(
-                id_anno=sql.Identifier(args.project, 'annotation'),
-                id_img=sql.Identifier(args.project, 'image')
-            )
+            tableID = sql.Identifier(args.project, 'annotation')
+            tableCols = ('username', 'image', 'timeCreated', 'timeRequired', 'label', 'x', 'y', 'width', 'height')
         elif args.annotation_type == 'prediction':
-            queryStr = sql.Identifier('''
-            INSERT INTO {id_pred} (image, timeCreated, label, confidence, x, y, width, height, priority)
-            VALUES(
-                (SELECT id FROM {id_img} WHERE filename = %s),
-                (TIMESTAMP %s),
-                %s,
-                %s,
-                %s,
-                %s,
-                %s,
-                %s,
-                %s
-            );''').format(
-                id_pred=sql.Identifier(args.project, 'prediction'),
-                id_img=sql.Identifier(args.project, 'image')
-            )
+            tableID = sql.Identifier(args.project, 'prediction')
+            tableCols = ('image', 'timeCreated', 'label', 'confidence', 'x', 'y', 'width', 'height', 'priority')
 
     # locate all images and their base names
     print('\nAdding image paths...')
@@ -226,16 +199,20 @@ if __name__ == '__main__':
 
     # push image to database
     print('Adding to database...')
-    dbConn.insert(sql.SQL('''
-        INSERT INTO {id_img} (filename)
-        VALUES %s;
-    ''').format(id_img=sql.Identifier(args.project, 'image')),
-    imgs_filenames)
+    dbConn.copy_rows(sql.Identifier(args.project, 'image'), ('filename',), imgs_filenames)
 
     
     # locate all label files
     if args.label_folder is not None:
         print('\nAdding labels...')
+
+        # image IDs by file name (to avoid a lookup per bounding box)
+        imgIDs = dbConn.execute(sql.SQL('''
+            SELECT id, filename FROM {id_img};
+        ''').format(id_img=sql.Identifier(args.project, 'image')), None, 'all')
+        imgIDs = dict([(i['filename'], i['id']) for i in imgIDs])
+
+        values = []
         labelFiles = glob.glob(os.path.join(args.label_folder, '**'), recursive=True)
         for l in tqdm(labelFiles):
 
@@ -267,10 +244,9 @@ if __name__ == '__main__':
                     bbox = [float(t) for t in tokens[1:5]]
                     bboxes.append(bbox)
                 
-                    # push to database
+                    # collect for bulk insertion
                     if args.annotation_type == 'annotation':
-                        dbConn.execute(queryStr,
-                            (username, imgs[baseName], currentDT, classdef[label], bbox[0], bbox[1], bbox[2], bbox[3]))
+                        values.append((username, imgIDs[imgs[baseName]], currentDT, -1, classdef[label], bbox[0], bbox[1], bbox[2], bbox[3]))
                             
                     elif args.annotation_type == 'prediction':
                         # calculate additional properties
@@ -289,7 +265,20 @@ if __name__ == '__main__':
                             elif args.al_criterion == 'TryAll':
                                 breakingTies = 1 - (confidences[-1] - confidences[-2])
                                 priority = max(maxConf, breakingTies)
-                        finally:
-                            # no values provided
-                            dbConn.execute(queryStr,
-                                (imgs[baseName], currentDT, classdef[label], maxConf, bbox[0], bbox[1], bbox[2], bbox[3], priority))
\ No newline at end of file
+                        except:
+                            # no (or not enough) confidence values provided
+                            pass
+                        values.append((imgIDs[imgs[baseName]], currentDT, classdef[label], maxConf, bbox[0], bbox[1], bbox[2], bbox[3], priority))
+
+        # push to database
+        print('Adding to database...')
+        dbConn.copy_rows(tableID, tableCols, values)
+
+        # update the per-image annotation counts for batch ranking (predictions
+        # are imported without model state and thus not part of the aggregates)
+        if args.annotation_type == 'annotation':
+            imageIDs = list(set([v[1] for v in values]))
+            for idx in range(0, len(imageIDs), 10000):
+                dbConn.execute(imageStats.annotation_stats_statement(args.project, imageIDs[idx:idx+10000]), None)
+
+    print('Done.')
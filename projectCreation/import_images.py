@@ -17,6 +17,7 @@
 
 import os
 import argparse
+from psycopg2 import sql
 from util.helpers import valid_image_extensions, listDirectory
 
 
@@ -87,10 +88,6 @@ if __name__ == '__main__':
 
     # push image to database
     print('Adding to database...')
-    dbConn.insert('''
-        INSERT INTO {}.image (filename)
-        VALUES %s;
-    '''.format(dbSchema),
-    imgs)
+    dbConn.copy_rows(sql.Identifier(dbSchema, 'image'), ('filename',), imgs)
 
     print('Done.')
\ No newline at end of file
@@ -37,6 +37,7 @@ if __name__ == '__main__':
     import base64
     from io import BytesIO
     from util.configDef import Config
+    from util import imageStats
     from modules import Database
 
     if args.label_folder == '':
@@ -175,6 +176,7 @@ if __name__ == '__main__':
     # locate all segmentation masks
     if args.label_folder is not None:
         print('\nAdding segmentation masks...')
+        imported = set()
         labelFiles = glob.glob(os.path.join(args.label_folder, '**'), recursive=True)
         for l in tqdm(labelFiles):
 
@@ -202,4 +204,15 @@ if __name__ == '__main__':
             else:
                 queryArgs = (imgs[baseName], currentDT, b64str, sz[0], sz[1])
             dbConn.execute(queryStr,
-                queryArgs)
\ No newline at end of file
+                queryArgs)
+            imported.add(imgs[baseName])
+
+        # update the per-image annotation counts for batch ranking (predictions
+        # are imported without model state and thus not part of the aggregates)
+        if args.annotation_type == 'annotation' and len(imported):
+            imageIDs = dbConn.execute(sql.SQL('''
+                SELECT id FROM {id_img} WHERE filename = ANY(%s);
+            ''').format(id_img=sql.Identifier(args.project, 'image')), (list(imported),), 'all')
+            imageIDs = [i['id'] for i in imageIDs]
+            for idx in range(0, len(imageIDs), 10000):
+                dbConn.execute(imageStats.annotation_stats_statement(args.project, imageIDs[idx:idx+10000]), None)
\ No newline at end of file
@@ -20,6 +20,8 @@ BEGIN
 END
 $$;
 
+CREATE SEQUENCE IF NOT EXISTS aide_admin.project_config_version_seq;
+
 CREATE TABLE IF NOT EXISTS aide_admin.project (
     shortname VARCHAR UNIQUE NOT NULL,
     name VARCHAR UNIQUE NOT NULL,
@@ -34,6 +36,9 @@ CREATE TABLE IF NOT EXISTS aide_admin.project (
     predictionType labelType,
     ui_settings VARCHAR,
     segmentation_ignore_unlabeled BOOLEAN NOT NULL DEFAULT TRUE,
+    batch_reservation BOOLEAN NOT NULL DEFAULT FALSE,
+    batch_reservation_window INTEGER NOT NULL DEFAULT 900,
+    config_version BIGINT NOT NULL DEFAULT nextval('aide_admin.project_config_version_seq'),
     numImages_autoTrain BIGINT,
     minNumAnnoPerImage INTEGER,
     maxNumImages_train BIGINT,
@@ -209,14 +209,107 @@ MODIFICATIONS_sql = [
     'ALTER TABLE "{schema}".cnnstate DROP CONSTRAINT IF EXISTS marketplace_origin_id_fkey;'
     'ALTER TABLE "{schema}".cnnstate ADD CONSTRAINT marketplace_origin_id_fkey FOREIGN KEY (marketplace_origin_id) REFERENCES aide_admin.modelMarketplace(id);',
     'ALTER TABLE aide_admin.modelMarketplace ADD COLUMN IF NOT EXISTS tags VARCHAR;',
-    'ALTER TABLE aide_admin.project ADD COLUMN IF NOT EXISTS archived BOOLEAN DEFAULT FALSE;'
+    'ALTER TABLE aide_admin.project ADD COLUMN IF NOT EXISTS archived BOOLEAN DEFAULT FALSE;',
+
+    # batch reservation
+    'ALTER TABLE aide_admin.project ADD COLUMN IF NOT EXISTS batch_reservation BOOLEAN NOT NULL DEFAULT FALSE;',
+    'ALTER TABLE aide_admin.project ADD COLUMN IF NOT EXISTS batch_reservation_window INTEGER NOT NULL DEFAULT 900;',
+
+    # version stamp of project settings and label classes for caching
+    'ALTER TABLE aide_admin.project ADD COLUMN IF NOT EXISTS config_version BIGINT NOT NULL DEFAULT 0;',
+    'CREATE SEQUENCE IF NOT EXISTS aide_admin.project_config_version_seq;',
+    '''SELECT setval('aide_admin.project_config_version_seq', GREATEST(
+        (SELECT COALESCE(MAX(config_version), 0) + 1 FROM aide_admin.project),
+        (SELECT last_value FROM aide_admin.project_config_version_seq)));''',
+    'ALTER TABLE aide_admin.project ALTER COLUMN config_version SET DEFAULT nextval(\'aide_admin.project_config_version_seq\');',
+
+    # per-image aggregates for batch ranking; populated from existing data upon creation
+    '''CREATE TABLE IF NOT EXISTS "{schema}".image_stats (
+        image uuid NOT NULL,
+        cnnstate uuid,
+        score real,
+        num_pred INTEGER NOT NULL DEFAULT 0,
+        pred_time TIMESTAMPTZ,
+        num_anno INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (image),
+        FOREIGN KEY (image) REFERENCES "{schema}".image(id) ON DELETE CASCADE
+    );''',
+    '''INSERT INTO "{schema}".image_stats (image, cnnstate, score, num_pred, pred_time, num_anno)
+        SELECT img.id, pred.cnnstate, pred.score, COALESCE(pred.num_pred, 0), pred.pred_time, COALESCE(anno.num_anno, 0)
+        FROM "{schema}".image AS img
+        LEFT OUTER JOIN (
+            SELECT image, cnnstate, SUM(confidence)/COUNT(confidence) AS score,
+                COUNT(*) AS num_pred, MAX(timeCreated) AS pred_time
+            FROM "{schema}".prediction
+            WHERE cnnstate = (
+                SELECT id FROM "{schema}".cnnstate
+                ORDER BY timeCreated DESC
+                LIMIT 1
+            )
+            GROUP BY image, cnnstate
+        ) AS pred
+        ON img.id = pred.image
+        LEFT OUTER JOIN (
+            SELECT image, COUNT(*) AS num_anno
+            FROM "{schema}".annotation
+            GROUP BY image
+        ) AS anno
+        ON img.id = anno.image
+        WHERE NOT EXISTS (
+            SELECT 1 FROM "{schema}".image_stats
+        )
+        ON CONFLICT (image) DO NOTHING;'''
 ]
 
 
+# Secondary indexes for existing projects, as (index name, table, columns).
+# These are built with "CREATE INDEX CONCURRENTLY" to not lock the tables of
+# projects that are in use, which means that each statement has to be run on
+# its own (i.e., outside of a transaction block).
+# Keep in sync with modules/ProjectAdministration/static/sql/create_schema.sql.
+INDICES_sql = [
+    ('annotation_image_idx', 'annotation', '(image)'),
+    ('annotation_username_image_idx', 'annotation', '(username, image)'),
+    ('prediction_cnnstate_image_idx', 'prediction', '(cnnstate, image)'),
+    ('image_user_image_idx', 'image_user', '(image)'),
+    ('image_user_last_checked_idx', 'image_user', '(last_checked)'),
+    ('cnnstate_timecreated_idx', 'cnnstate', '(timeCreated)'),
+    ('image_last_requested_idx', 'image', '(last_requested)'),
+    ('image_stats_cnnstate_score_idx', 'image_stats', '(cnnstate, score DESC NULLS LAST)'),
+    ('image_user_last_checked_image_username_idx', 'image_user', '(last_checked, image, username)')
+]
+
+
+
+def _create_indices(dbConn, schema):
+    '''
+        Creates the secondary indexes listed in "INDICES_sql" for the given
+        project schema, if they do not exist yet. Leftovers of concurrent
+        index builds that failed earlier (marked as invalid by Postgres) are
+        dropped and rebuilt.
+    '''
+    for indexName, table, columns in INDICES_sql:
+        invalid = dbConn.execute('''
+            SELECT COUNT(*) AS cnt
+            FROM pg_index AS pi
+            JOIN pg_class AS pc
+            ON pi.indexrelid = pc.oid
+            JOIN pg_namespace AS pn
+            ON pc.relnamespace = pn.oid
+            WHERE pn.nspname = %s
+            AND pc.relname = %s
+            AND pi.indisvalid IS FALSE;
+        ''', (schema, indexName,), 1)
+        if invalid is not None and len(invalid) and invalid[0]['cnt'] > 0:
+            dbConn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{schema}"."{indexName}";', None, None)
+        dbConn.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{indexName}" ON "{schema}".{table} {columns};', None, None)
+
+
 
 def migrate_aide():
     from modules import Database, UserHandling
     from util.configDef import Config
+    from util import projectCounters, activityRollup
     
     config = Config()
     dbConn = Database(config)
@@ -226,6 +319,14 @@ def migrate_aide():
     warnings = []
     errors = []
 
+    # counters and activity rollup require PostgreSQL 10
+    try:
+        projectCounters.check_server_version(dbConn)
+        installTriggers = True
+    except Exception as e:
+        errors.append(str(e))
+        installTriggers = False
+
     # bring all projects up-to-date (if registered within AIDE)
     projects = dbConn.execute('SELECT shortname FROM aide_admin.project;', None, 'all')
     if projects is not None and len(projects):
@@ -247,6 +348,14 @@ def migrate_aide():
                     # make modifications one at a time
                     for mod in MODIFICATIONS_sql:
                         dbConn.execute(mod.format(schema=pName), None, None)
+
+                    # add secondary indexes without blocking the project
+                    _create_indices(dbConn, pName)
+
+                    # (re-) create counters and activity triggers; contents are computed if new
+                    if installTriggers:
+                        projectCounters.install(dbConn, pName)
+                        activityRollup.install(dbConn, pName)
                 except Exception as e:
                     errors.append(str(e))
         else:
@@ -0,0 +1,56 @@
+'''
+    Recomputes the counters of one or all projects (number of images,
+    annotations, predictions, views, etc.; see "util/projectCounters.py")
+    and their activity rollups (see "util/activityRollup.py") from the
+    project tables, and re-creates the triggers that maintain them. Run
+    this if the project statistics appear to be off.
+
+    Usage:
+        python setup/rebuild_counters.py [--project <shortname>]
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import argparse
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Recompute the counters of AIDE projects.')
+    parser.add_argument('--settings_filepath', type=str, default='config/settings.ini', const=1, nargs='?',
+                    help='Manual specification of the directory of the settings.ini file; only considered if environment variable unset (default: "config/settings.ini").')
+    parser.add_argument('--project', type=str, default=None, const=1, nargs='?',
+                    help='Shortname of the project to rebuild the counters of (default: all projects).')
+    args = parser.parse_args()
+
+    if not 'AIDE_CONFIG_PATH' in os.environ:
+        os.environ['AIDE_CONFIG_PATH'] = str(args.settings_filepath)
+    if not 'AIDE_MODULES' in os.environ:
+        os.environ['AIDE_MODULES'] = ''     # for compatibility with Celery worker import
+
+    from util.configDef import Config
+    from modules import Database
+    from util import projectCounters, activityRollup
+
+    config = Config()
+    dbConn = Database(config)
+    if dbConn.connectionPool is None:
+        raise Exception('Error connecting to database.')
+
+    if args.project is not None:
+        projects = [args.project]
+    else:
+        projects = dbConn.execute('SELECT shortname FROM aide_admin.project;', None, 'all')
+        projects = [p['shortname'] for p in projects]
+
+    for project in projects:
+        print(f'Rebuilding counters of project "{project}"...')
+        try:
+            if not projectCounters.install(dbConn, project):
+                projectCounters.rebuild(dbConn, project)
+            if not activityRollup.install(dbConn, project):
+                activityRollup.rebuild(dbConn, project)
+        except Exception as e:
+            print(f'\tError: {str(e)}')
+    print('Done.')
@@ -0,0 +1,17 @@
+'''
+    Test configuration: importing the AIDE modules requires the settings
+    file and module environment variables (as for the scripts in "setup"
+    and "benchmarks").
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+if not 'AIDE_CONFIG_PATH' in os.environ:
+    os.environ['AIDE_CONFIG_PATH'] = os.path.join(os.path.dirname(__file__), '..', 'config', 'settings.ini')
+if not 'AIDE_MODULES' in os.environ:
+    os.environ['AIDE_MODULES'] = ''     # for compatibility with Celery worker import
@@ -0,0 +1,195 @@
+'''
+    Tests of the NumPy evaluation engine for points and bounding boxes
+    ("modules/ProjectStatistics/backend/geometricEvaluation.py"), including
+    its equivalence with the SQL formulas ("statisticalFormulas.py").
+
+    2020 Benjamin Kellenberger
+'''
+
+import numpy as np
+import pytest
+
+from modules.ProjectStatistics.backend import geometricEvaluation
+
+
+# bounding boxes (x, y, width, height, label) of the target user and the
+# evaluated user per image
+FIXTURE = {
+    'overlap': (
+        [(0.2, 0.2, 0.2, 0.2, 'a'), (0.7, 0.7, 0.2, 0.2, 'b')],
+        [(0.22, 0.2, 0.2, 0.2, 'a'), (0.7, 0.75, 0.2, 0.2, 'a'), (0.5, 0.9, 0.05, 0.05, 'a')]
+    ),
+    'low_iou': (
+        [(0.5, 0.5, 0.2, 0.2, 'a')],
+        [(0.6, 0.5, 0.2, 0.2, 'a')]
+    ),
+    'shared_match': (
+        [(0.45, 0.5, 0.2, 0.2, 'a'), (0.55, 0.5, 0.2, 0.2, 'a')],
+        [(0.5, 0.5, 0.2, 0.2, 'a')]
+    ),
+    'no_target': (
+        [],
+        [(0.5, 0.5, 0.2, 0.2, 'a')]
+    ),
+    'double_match': (
+        [(0.45, 0.5, 0.2, 0.2, 'a'), (0.55, 0.5, 0.2, 0.2, 'a')],
+        [(0.5, 0.5, 0.2, 0.2, 'a'), (0.9, 0.9, 0.1, 0.1, 'a')]
+    ),
+    'disjoint': (
+        [(0.2, 0.2, 0.1, 0.1, 'a')],
+        [(0.8, 0.8, 0.1, 0.1, 'a')]
+    ),
+    'no_eval': (
+        [(0.5, 0.5, 0.2, 0.2, 'a')],
+        []
+    )
+}
+
+# rows returned by StatisticalFormulas_user.boundingBoxes for the fixture
+# (threshold 0.5); the formula yields no row for image "disjoint"
+SQL_ROWS = {
+    'overlap':      {'num_pred': 3, 'num_target': 2, 'min_iou': 0.6, 'avg_iou': 0.709091, 'max_iou': 0.818182, 'tp': 1, 'fp': 2, 'fn': 1},
+    'low_iou':      {'num_pred': 1, 'num_target': 1, 'min_iou': 0.333333, 'avg_iou': 0.333333, 'max_iou': 0.333333, 'tp': 0, 'fp': 1, 'fn': 1},
+    'shared_match': {'num_pred': 1, 'num_target': 2, 'min_iou': 0.6, 'avg_iou': 0.6, 'max_iou': 0.6, 'tp': 1, 'fp': 0, 'fn': 1},
+    'no_target':    {'num_pred': 1, 'num_target': 0, 'min_iou': None, 'avg_iou': None, 'max_iou': None, 'tp': 0, 'fp': 1, 'fn': 0},
+    'double_match': {'num_pred': 2, 'num_target': 2, 'min_iou': 0.6, 'avg_iou': 0.6, 'max_iou': 0.6, 'tp': 2, 'fp': 0, 'fn': 0},
+    'no_eval':      {'num_pred': 0, 'num_target': 1, 'min_iou': None, 'avg_iou': None, 'max_iou': None, 'tp': 0, 'fp': 1, 'fn': 1}
+}
+
+# images in which the engines agree; see "test_evaluate_image_differences" for the others
+EQUIVALENT = ('overlap', 'low_iou', 'shared_match', 'no_target')
+
+
+def _annotations(boxes):
+    return np.array([b[:4] for b in boxes], dtype=np.float64).reshape(-1, 4), [b[4] for b in boxes]
+
+
+def _evaluate(name, method='greedy'):
+    target, evaluated = FIXTURE[name]
+    return geometricEvaluation.evaluate_image('boundingBoxes', _annotations(target), _annotations(evaluated), 0.5, method)
+
+
+def _assert_row(result, expected):
+    for key, value in expected.items():
+        if value is None:
+            assert result[key] is None, key
+        else:
+            assert result[key] == pytest.approx(value, abs=1e-6), key
+
+
+def test_iou_matrix():
+    boxesA = [(0.2, 0.2, 0.2, 0.2), (0.7, 0.7, 0.2, 0.2)]
+    boxesB = [(0.22, 0.2, 0.2, 0.2), (0.7, 0.75, 0.2, 0.2), (0.5, 0.9, 0.05, 0.05), (0.2, 0.2, 0.2, 0.2)]
+    iou = geometricEvaluation.iou_matrix(boxesA, boxesB)
+    expected = np.array([
+        [0.036 / 0.044, 0.0, 0.0, 1.0],
+        [0.0, 0.03 / 0.05, 0.0, 0.0]
+    ])
+    assert iou.shape == (2, 4)
+    np.testing.assert_allclose(iou, expected, atol=1e-9)
+
+    # empty inputs and degenerate boxes
+    assert geometricEvaluation.iou_matrix(np.zeros((0, 4)), boxesB).shape == (0, 4)
+    assert geometricEvaluation.iou_matrix([(0.5, 0.5, 0, 0)], [(0.5, 0.5, 0, 0)])[0, 0] == 0.0
+
+
+def test_distance_matrix():
+    dist = geometricEvaluation.distance_matrix([(0, 0), (3, 4)], [(0, 0), (6, 8), (3, 0)])
+    expected = np.array([
+        [0.0, 10.0, 3.0],
+        [5.0, 5.0, 4.0]
+    ])
+    np.testing.assert_allclose(dist, expected)
+    assert geometricEvaluation.distance_matrix(np.zeros((0, 2)), [(1, 1)]).shape == (0, 1)
+
+
+def _pairs(rows, cols):
+    return sorted(zip(rows.tolist(), cols.tolist()))
+
+
+def test_match_greedy():
+    scores = np.array([
+        [0.9, 0.8],
+        [0.8, 0.1]
+    ])
+    # best pair first; the remaining pair is not valid
+    rows, cols = geometricEvaluation.match(scores, scores >= 0.5, True, 'greedy')
+    assert _pairs(rows, cols) == [(0, 0)]
+
+    # lower is better (distances)
+    dist = np.array([
+        [1.0, 2.0, 9.0],
+        [1.5, 9.0, 9.0]
+    ])
+    rows, cols = geometricEvaluation.match(dist, dist <= 2.0, False, 'greedy')
+    assert _pairs(rows, cols) == [(0, 0)]
+
+    rows, cols = geometricEvaluation.match(scores, np.zeros_like(scores, dtype=bool), True, 'greedy')
+    assert len(rows) == 0 and len(cols) == 0
+
+
+def test_match_hungarian():
+    pytest.importorskip('scipy')
+    scores = np.array([
+        [0.9, 0.8],
+        [0.8, 0.1]
+    ])
+    # maximizes the total score: both rows are matched, unlike with greedy matching
+    rows, cols = geometricEvaluation.match(scores, scores >= 0.5, True, 'hungarian')
+    assert _pairs(rows, cols) == [(0, 1), (1, 0)]
+
+    dist = np.array([
+        [1.0, 2.0, 9.0],
+        [1.5, 9.0, 9.0]
+    ])
+    rows, cols = geometricEvaluation.match(dist, dist <= 2.0, False, 'hungarian')
+    assert _pairs(rows, cols) == [(0, 1), (1, 0)]
+
+
+def test_match_invalid_method():
+    with pytest.raises(Exception):
+        geometricEvaluation.match(np.ones((1, 1)), np.ones((1, 1), dtype=bool), True, 'invalid')
+
+
+@pytest.mark.parametrize('name', EQUIVALENT)
+def test_evaluate_image_equals_sql(name):
+    _assert_row(_evaluate(name), SQL_ROWS[name])
+
+
+def test_evaluate_image_differences():
+    '''
+        Cases in which the NumPy engine deliberately deviates from the SQL
+        formulas.
+    '''
+    # SQL matches every target with its best evaluated box, even if that
+    # box has been matched already; NumPy matches one-to-one
+    _assert_row(_evaluate('double_match'), {'tp': 1, 'fp': 1, 'fn': 1, 'avg_iou': 0.6})
+    assert SQL_ROWS['double_match']['tp'] == 2
+
+    # SQL yields no row for images in which no boxes overlap; NumPy counts them
+    assert 'disjoint' not in SQL_ROWS
+    _assert_row(_evaluate('disjoint'), {'num_pred': 1, 'num_target': 1, 'tp': 0, 'fp': 1, 'fn': 1, 'avg_iou': None})
+
+    # SQL counts a false positive if the evaluated user viewed the image
+    # without annotating anything; NumPy does not
+    _assert_row(_evaluate('no_eval'), {'num_pred': 0, 'num_target': 1, 'tp': 0, 'fp': 0, 'fn': 1})
+    assert SQL_ROWS['no_eval']['fp'] == 1
+
+
+def test_evaluate_image_hungarian():
+    pytest.importorskip('scipy')
+    for name in EQUIVALENT:
+        _assert_row(_evaluate(name, 'hungarian'), SQL_ROWS[name])
+
+
+def test_evaluate_image_points():
+    target = (np.array([(0.1, 0.1), (0.5, 0.5)]), ['a', 'b'])
+    evaluated = (np.array([(0.1, 0.13), (0.5, 0.54), (0.9, 0.9)]), ['a', 'a'] + ['b'])
+    result = geometricEvaluation.evaluate_image('points', target, evaluated, 0.05)
+    assert result['num_pred'] == 3
+    assert result['num_target'] == 2
+    assert result['min_dist'] == pytest.approx(0.03)
+    assert result['avg_dist'] == pytest.approx(0.035)
+    assert result['max_dist'] == pytest.approx(0.04)
+    # second point is within the threshold, but has a different label
+    assert (result['tp'], result['fp'], result['fn']) == (1, 2, 1)
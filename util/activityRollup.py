@@ -0,0 +1,271 @@
+'''
+    Hourly rollup of the activity in a project: number of images viewed and
+    annotations made per user and hour, along with the time required for
+    them. Activity charts (e.g. "getTimeActivity" of the project statistics)
+    query ranges of the rollup instead of grouping the entire history of
+    the "image_user" and "annotation" tables.
+
+    The rollup lives in relation "activity" of each project schema and is
+    kept up to date by statement-level triggers on "image_user" and
+    "annotation". Views are attributed to the hour of their "last_checked"
+    timestamp and annotations to the hour of their "timeCreated" timestamp
+    (both in UTC); if these change (e.g. an image is viewed again), the row
+    is moved to the new hour. The rollup hence always equals a grouping of
+    the current table contents and can be recomputed with "rebuild" (see
+    also "setup/rebuild_counters.py").
+
+    Requires PostgreSQL 10 or newer.
+
+    2020 Benjamin Kellenberger
+'''
+
+from datetime import datetime, timedelta
+import pytz
+from psycopg2 import sql
+from util.projectCounters import check_server_version
+
+
+# source table: (time field, time required field, count column, time column)
+SOURCES = {
+    'image_user': ('last_checked', 'total_time_required', 'num_views', 'time_views'),
+    'annotation': ('timeCreated', 'timeRequired', 'num_annotations', 'time_annotations')
+}
+
+RESOLUTIONS = ('hour', 'day')
+
+
+def _bucket(timeField):
+    # hours in UTC, independent of the time zone of the database session
+    return sql.SQL("(date_trunc('hour', {} AT TIME ZONE 'UTC') AT TIME ZONE 'UTC')").format(sql.SQL(timeField))
+
+
+def _upsert(project, table, deltas):
+    '''
+        Returns a statement that adds the "deltas" (query with columns
+        bucket, username, count and time required) to the rollup.
+    '''
+    _, _, countCol, timeCol = SOURCES[table]
+    return sql.SQL('''
+        INSERT INTO {id_activity} AS a (bucket, username, {countCol}, {timeCol})
+        SELECT d.bucket, d.username, SUM(d.cnt), SUM(d.time_required)
+        FROM (
+            {deltas}
+        ) AS d(bucket, username, cnt, time_required)
+        WHERE d.bucket IS NOT NULL
+        GROUP BY d.bucket, d.username
+        HAVING SUM(d.cnt) <> 0 OR SUM(d.time_required) <> 0
+        ORDER BY d.bucket, d.username
+        ON CONFLICT (bucket, username) DO UPDATE SET
+            {countCol} = a.{countCol} + EXCLUDED.{countCol},
+            {timeCol} = a.{timeCol} + EXCLUDED.{timeCol}
+    ''').format(
+        id_activity=sql.Identifier(project, 'activity'),
+        countCol=sql.Identifier(countCol),
+        timeCol=sql.Identifier(timeCol),
+        deltas=deltas
+    )
+
+
+def _deltas(table, rows, sign):
+    timeField, timeRequiredField, _, _ = SOURCES[table]
+    return sql.SQL('''
+        SELECT {bucket}, username, {sign}::BIGINT, {sign} * COALESCE({timeRequired}, 0)::BIGINT
+        FROM {rows}
+    ''').format(
+        bucket=_bucket(timeField),
+        sign=sql.Literal(sign),
+        timeRequired=sql.SQL(timeRequiredField),
+        rows=sql.SQL(rows)
+    )
+
+
+def install(dbConnector, project):
+    '''
+        Creates the activity rollup of a project and the triggers that
+        maintain it (replacing existing triggers). If the rollup did not
+        exist before, it is populated from the current project data.
+    '''
+    check_server_version(dbConnector)
+    exists = dbConnector.execute('''
+        SELECT to_regclass(quote_ident(%s) || '.activity') AS rel;
+    ''', (project,), 1)
+    created = (exists is None or not len(exists) or exists[0]['rel'] is None)
+
+    statements = [sql.SQL('''
+        CREATE TABLE IF NOT EXISTS {id_activity} (
+            bucket TIMESTAMPTZ NOT NULL,
+            username VARCHAR NOT NULL,
+            num_views BIGINT NOT NULL DEFAULT 0,
+            time_views BIGINT NOT NULL DEFAULT 0,
+            num_annotations BIGINT NOT NULL DEFAULT 0,
+            time_annotations BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, username)
+        )
+    ''').format(id_activity=sql.Identifier(project, 'activity'))]
+
+    for table in SOURCES.keys():
+        id_table = sql.Identifier(project, table)
+        id_fun = sql.Identifier(project, 'activity_' + table)
+        statements.append(sql.SQL('''
+            CREATE OR REPLACE FUNCTION {id_fun}() RETURNS TRIGGER AS $activity$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    {upsertInsert};
+                ELSIF TG_OP = 'DELETE' THEN
+                    {upsertDelete};
+                ELSIF TG_OP = 'UPDATE' THEN
+                    {upsertUpdate};
+                END IF;
+                RETURN NULL;
+            END;
+            $activity$ LANGUAGE plpgsql
+        ''').format(
+            id_fun=id_fun,
+            upsertInsert=_upsert(project, table, _deltas(table, 'new_rows', 1)),
+            upsertDelete=_upsert(project, table, _deltas(table, 'old_rows', -1)),
+            upsertUpdate=_upsert(project, table, sql.SQL('{} UNION ALL {}').format(
+                _deltas(table, 'new_rows', 1), _deltas(table, 'old_rows', -1)))
+        ))
+
+        # transition tables require one trigger per event
+        triggers = (
+            ('activity_insert', sql.SQL('AFTER INSERT ON {} REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT').format(id_table)),
+            ('activity_delete', sql.SQL('AFTER DELETE ON {} REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT').format(id_table)),
+            ('activity_update', sql.SQL('AFTER UPDATE ON {} REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT').format(id_table))
+        )
+        for name, definition in triggers:
+            statements.append(sql.SQL('DROP TRIGGER IF EXISTS {name} ON {id_table}').format(
+                name=sql.Identifier(name), id_table=id_table))
+            statements.append(sql.SQL('CREATE TRIGGER {name} {definition} EXECUTE PROCEDURE {id_fun}()').format(
+                name=sql.Identifier(name), definition=definition, id_fun=id_fun))
+
+    with dbConnector.transaction() as cursor:
+        cursor.execute(sql.SQL(';').join(statements))
+
+    if created:
+        rebuild(dbConnector, project)
+    return created
+
+
+def rebuild(dbConnector, project):
+    '''
+        Recomputes the activity rollup of a project from the project tables.
+        Blocks concurrent writes to the project tables (through their
+        triggers) until done.
+    '''
+    with dbConnector.transaction() as cursor:
+        cursor.execute(sql.SQL('''
+            LOCK TABLE {id_activity} IN EXCLUSIVE MODE;
+            DELETE FROM {id_activity};
+            INSERT INTO {id_activity} (bucket, username, num_views, time_views, num_annotations, time_annotations)
+            SELECT bucket, username, SUM(num_views), SUM(time_views), SUM(num_annotations), SUM(time_annotations)
+            FROM (
+                SELECT {bucket_iu} AS bucket, username,
+                    COUNT(*) AS num_views, SUM(COALESCE(total_time_required, 0)) AS time_views,
+                    0 AS num_annotations, 0 AS time_annotations
+                FROM {id_iu}
+                GROUP BY 1, 2
+                UNION ALL
+                SELECT {bucket_anno} AS bucket, username,
+                    0, 0, COUNT(*), SUM(COALESCE(timeRequired, 0))
+                FROM {id_anno}
+                GROUP BY 1, 2
+            ) AS q
+            WHERE bucket IS NOT NULL
+            GROUP BY bucket, username;
+        ''').format(
+            id_activity=sql.Identifier(project, 'activity'),
+            id_iu=sql.Identifier(project, 'image_user'),
+            id_anno=sql.Identifier(project, 'annotation'),
+            bucket_iu=_bucket('last_checked'),
+            bucket_anno=_bucket('timeCreated')
+        ))
+
+
+def get_activity(dbConnector, project, table='image_user', start=None, end=None, resolution='day', perUser=False):
+    '''
+        Returns the activity of a project between "start" and "end" (date-
+        times; default: everything) as a list of dicts with the start of the
+        hour or day ("bucket"; days in the time zone of the database), the
+        user name (if "perUser" is True), the number of images viewed (table
+        "image_user"), resp. annotations made (table "annotation") and the
+        time required for them. Hours and days without activity are filled
+        in with zeros (between the first and last bucket with activity if
+        "start", resp. "end" are not given).
+        Falls back to grouping the project tables if the project does not
+        have an activity rollup yet.
+    '''
+    if table not in SOURCES:
+        raise Exception(f'Invalid activity table "{table}" (must be one of {", ".join(SOURCES.keys())}).')
+    if resolution not in RESOLUTIONS:
+        raise Exception(f'Invalid resolution "{resolution}" (must be one of {", ".join(RESOLUTIONS)}).')
+    timeField, timeRequiredField, countCol, timeCol = SOURCES[table]
+
+    exists = dbConnector.execute('''
+        SELECT to_regclass(quote_ident(%s) || '.activity') AS rel;
+    ''', (project,), 1)
+    if exists is not None and len(exists) and exists[0]['rel'] is not None:
+        source = sql.SQL('''
+            SELECT bucket, username, {countCol} AS cnt, {timeCol} AS time_required
+            FROM {id_activity}
+            WHERE bucket >= date_trunc({resolution}, %s::TIMESTAMPTZ) AND bucket < %s
+                AND ({countCol} <> 0 OR {timeCol} <> 0)
+        ''').format(
+            resolution=sql.Literal(resolution),
+            countCol=sql.Identifier(countCol),
+            timeCol=sql.Identifier(timeCol),
+            id_activity=sql.Identifier(project, 'activity')
+        )
+    else:
+        source = sql.SQL('''
+            SELECT {bucket} AS bucket, username, 1 AS cnt, COALESCE({timeRequired}, 0) AS time_required
+            FROM {id_table}
+            WHERE {timeField} >= date_trunc({resolution}, %s::TIMESTAMPTZ) AND {timeField} < %s
+        ''').format(
+            resolution=sql.Literal(resolution),
+            bucket=_bucket(timeField),
+            timeRequired=sql.SQL(timeRequiredField),
+            id_table=sql.Identifier(project, table),
+            timeField=sql.SQL(timeField)
+        )
+
+    # filter range of the source; the series of buckets spans the given
+    # range, resp. the activity within it if not given
+    filterStart = (start if start is not None else datetime(1970, 1, 1, tzinfo=pytz.utc))
+    filterEnd = (end if end is not None else datetime.now(tz=pytz.utc) + timedelta(days=1))
+
+    userSpec = (sql.SQL(', username') if perUser else sql.SQL(''))
+    queryStr = sql.SQL('''
+        WITH activity AS (
+            SELECT date_trunc({resolution}, bucket) AS bucket {userSpec},
+                SUM(cnt) AS cnt, SUM(time_required) AS time_required
+            FROM ({source}) AS src
+            GROUP BY 1 {userSpec}
+        ),
+        buckets AS (
+            SELECT generate_series(
+                COALESCE(date_trunc({resolution}, %s::TIMESTAMPTZ), (SELECT MIN(bucket) FROM activity)),
+                COALESCE(date_trunc({resolution}, %s::TIMESTAMPTZ - interval '1 microsecond'), (SELECT MAX(bucket) FROM activity)),
+                {step}::INTERVAL
+            ) AS bucket
+        )
+        SELECT b.bucket {userSpec_u}, COALESCE(a.cnt, 0)::BIGINT AS cnt, COALESCE(a.time_required, 0)::BIGINT AS time_required
+        FROM buckets AS b
+        {userJoin}
+        LEFT OUTER JOIN activity AS a
+        ON a.bucket = b.bucket {userCondition}
+        ORDER BY {order}
+    ''').format(
+        resolution=sql.Literal(resolution),
+        userSpec=userSpec,
+        source=source,
+        step=sql.Literal('1 ' + resolution),
+        userSpec_u=(sql.SQL(', u.username') if perUser else sql.SQL('')),
+        userJoin=(sql.SQL('CROSS JOIN (SELECT DISTINCT username FROM activity) AS u') if perUser else sql.SQL('')),
+        userCondition=(sql.SQL('AND a.username = u.username') if perUser else sql.SQL('')),
+        order=(sql.SQL('u.username, b.bucket') if perUser else sql.SQL('b.bucket'))
+    )
+    result = dbConnector.execute(queryStr, (filterStart, filterEnd, start, end), 'all')
+    if result is None:
+        return None
+    return [dict(r) for r in result]
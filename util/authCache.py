@@ -0,0 +1,131 @@
+'''
+    Short-lived in-memory cache of the data that decides whether a request
+    is authorized: the demo mode flag of a project, the membership of a
+    user in a project (admin flag, admission and block dates) and the
+    privileges of a user (super user, project creation). Without it, every
+    call of "checkAuthenticated" queries the database several times.
+
+    Entries expire after "ttl" seconds, so that permission changes made
+    through other processes (e.g. other Gunicorn workers) become effective
+    after at most that time. Changes made within the same process take
+    effect immediately through "invalidate", which is to be called whenever
+    permissions are modified. Only positive lookups are cached: a user that
+    has just been enrolled in a project is never denied access because of a
+    cached miss. Admission and block dates are cached as they are and
+    compared with the current time upon every check.
+
+    2020 Benjamin Kellenberger
+'''
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class AuthorizationCache:
+
+    def __init__(self, ttl=5.0, maxEntries=10000):
+        '''
+            Inputs:
+            - ttl: time (in seconds) entries are cached; zero disables the
+                   cache
+            - maxEntries: maximum number of entries kept in memory
+        '''
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self._lock = threading.Lock()
+
+        # (kind, project, username) -> (value, expiry time)
+        self.entries = OrderedDict()
+
+        # increased upon every invalidation, so that values loaded before
+        # are not stored
+        self.generation = 0
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0
+        }
+
+
+    def get(self, key, loadFun):
+        '''
+            Returns the value for the given key, which is a tuple (kind,
+            project, username) with None for fields that do not apply. If
+            not cached (or expired), the value is obtained by calling
+            "loadFun" (without arguments) and cached, unless it is None.
+        '''
+        if self.ttl <= 0:
+            return loadFun()
+
+        now = time.time()
+        with self._lock:
+            entry = self.entries.get(key, None)
+            if entry is not None and now < entry[1]:
+                self.stats['hits'] += 1
+                return entry[0]
+            self.stats['misses'] += 1
+            generation = self.generation
+
+        value = loadFun()
+        if value is not None:
+            with self._lock:
+                if self.generation == generation:
+                    self.entries[key] = (value, now + self.ttl)
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.maxEntries:
+                        self.entries.popitem(last=False)
+        return value
+
+
+    def invalidate(self, project=None, username=None):
+        '''
+            Drops all entries of the given project and/or user (only those
+            matching both if both are provided), or the entire cache if
+            neither is provided.
+        '''
+        with self._lock:
+            self.generation += 1
+            if project is None and username is None:
+                self.entries.clear()
+                return
+            keys = [k for k in self.entries.keys() if
+                    (project is None or k[1] == project) and
+                    (username is None or k[2] == username)]
+            for k in keys:
+                del self.entries[k]
+
+
+    def get_statistics(self):
+        with self._lock:
+            stats = self.stats.copy()
+            stats['cached'] = len(self.entries)
+            return stats
+
+
+
+_cache = None
+_cacheLock = threading.Lock()
+
+
+def get_authorization_cache(ttl=5.0):
+    '''
+        Returns the process-wide authorization cache.
+    '''
+    global _cache
+    with _cacheLock:
+        if _cache is None:
+            _cache = AuthorizationCache(ttl)
+        return _cache
+
+
+def invalidate(project=None, username=None):
+    '''
+        To be called after modifying project memberships, user privileges
+        or the demo mode and visibility of a project: drops the affected
+        entries of this process' cache (see "AuthorizationCache.invalidate").
+    '''
+    with _cacheLock:
+        cache = _cache
+    if cache is not None:
+        cache.invalidate(project, username)
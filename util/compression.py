@@ -0,0 +1,106 @@
+'''
+    Bottle plugin that transparently compresses responses (gzip or deflate)
+    if the client accepts it ("Accept-Encoding" request header) and the
+    response is large enough to profit from it.
+
+    Dicts returned by routes are serialized to JSON by the plugin itself (as
+    Bottle's built-in JSON plugin would do), so that they can be compressed.
+    Files, streams and other non-text responses are passed through as-is.
+
+    2020 Benjamin Kellenberger
+'''
+
+import gzip
+import zlib
+import bottle
+from bottle import request, response
+
+
+# content types worth compressing; everything else (e.g. images) is already compressed
+COMPRESSIBLE_TYPES = ('text/', 'json', 'javascript', 'xml', 'msgpack')
+
+
+def parse_accept_header(header):
+    '''
+        Parses an "Accept" or "Accept-Encoding" header and returns a dict of
+        token (lowercase) to quality value. Tokens with q=0 are omitted.
+    '''
+    tokens = {}
+    if not header:
+        return tokens
+    for part in header.split(','):
+        part = part.strip()
+        if not len(part):
+            continue
+        name, _, params = part.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except:
+                    quality = 0.0
+        if quality > 0:
+            tokens[name.strip().lower()] = quality
+    return tokens
+
+
+
+class CompressionPlugin:
+
+    name = 'compression'
+    api = 2
+
+    def __init__(self, minSize=1024, level=6):
+        '''
+            Inputs:
+            - minSize: minimum response size (in bytes) to compress
+            - level: compression level (1 = fastest, 9 = smallest)
+        '''
+        self.minSize = minSize
+        self.level = level
+
+
+    def _select_encoding(self):
+        accepted = parse_accept_header(request.get_header('Accept-Encoding', ''))
+        for encoding in ('gzip', 'deflate'):
+            if encoding in accepted or ('*' in accepted and len(accepted) == 1):
+                return encoding
+        return None
+
+
+    def _compress(self, body):
+        if not isinstance(body, (str, bytes)):
+            return body
+        if response.get_header('Content-Encoding') is not None or response.status_code >= 300:
+            return body
+        contentType = (response.content_type or '').lower()
+        if not any(t in contentType for t in COMPRESSIBLE_TYPES):
+            return body
+        if isinstance(body, str):
+            body = body.encode(response.charset or 'utf-8')
+        if len(body) < self.minSize:
+            return body
+
+        encoding = self._select_encoding()
+        response.add_header('Vary', 'Accept-Encoding')
+        if encoding == 'gzip':
+            body = gzip.compress(body, compresslevel=self.level)
+        elif encoding == 'deflate':
+            body = zlib.compress(body, self.level)
+        else:
+            return body
+        response.set_header('Content-Encoding', encoding)
+        response.set_header('Content-Length', str(len(body)))
+        return body
+
+
+    def apply(self, callback, route):
+        def _wrapper(*args, **kwargs):
+            body = callback(*args, **kwargs)
+            if isinstance(body, dict):
+                body = bottle.json_dumps(body)
+                response.content_type = 'application/json'
+            return self._compress(body)
+        return _wrapper
@@ -0,0 +1,70 @@
+'''
+    Maintenance of the "image_stats" table of a project, which holds per-
+    image aggregates (score and number of predictions of the latest model
+    state, number of annotations) so that they do not have to be computed
+    over the entire prediction and annotation tables upon every request
+    for a new batch of images.
+
+    2020 Benjamin Kellenberger
+'''
+
+from psycopg2 import sql
+
+
+def prediction_stats_statement(project, cnnstate, imageIDs):
+    '''
+        Returns a statement that updates the prediction aggregates of the
+        given images with the predictions made by model state "cnnstate".
+        Aggregates of a newer model state are not overwritten.
+    '''
+    return sql.SQL('''
+        INSERT INTO {id_stats} (image, cnnstate, score, num_pred, pred_time)
+        SELECT image, cnnstate, SUM(confidence)/COUNT(confidence), COUNT(*), MAX(timeCreated)
+        FROM {id_pred}
+        WHERE cnnstate = {cnnstate}
+        AND image = ANY({imageIDs}::uuid[])
+        GROUP BY image, cnnstate
+        ON CONFLICT (image) DO UPDATE SET
+            cnnstate = EXCLUDED.cnnstate,
+            score = EXCLUDED.score,
+            num_pred = EXCLUDED.num_pred,
+            pred_time = EXCLUDED.pred_time
+        WHERE image_stats.cnnstate IS NULL
+        OR image_stats.cnnstate = EXCLUDED.cnnstate
+        OR COALESCE((
+            SELECT timeCreated FROM {id_cnnstate}
+            WHERE id = image_stats.cnnstate
+        ), '-infinity') <= (
+            SELECT timeCreated FROM {id_cnnstate}
+            WHERE id = EXCLUDED.cnnstate
+        )
+    ''').format(
+        id_stats=sql.Identifier(project, 'image_stats'),
+        id_pred=sql.Identifier(project, 'prediction'),
+        id_cnnstate=sql.Identifier(project, 'cnnstate'),
+        cnnstate=sql.Literal(cnnstate),
+        imageIDs=sql.Literal(list(imageIDs))
+    )
+
+
+def annotation_stats_statement(project, imageIDs):
+    '''
+        Returns a statement that recounts the annotations of the given
+        images.
+    '''
+    return sql.SQL('''
+        INSERT INTO {id_stats} (image, num_anno)
+        SELECT img.id, COUNT(anno.id)
+        FROM (
+            SELECT UNNEST({imageIDs}::uuid[]) AS id
+        ) AS img
+        LEFT OUTER JOIN {id_anno} AS anno
+        ON img.id = anno.image
+        GROUP BY img.id
+        ON CONFLICT (image) DO UPDATE SET
+            num_anno = EXCLUDED.num_anno
+    ''').format(
+        id_stats=sql.Identifier(project, 'image_stats'),
+        id_anno=sql.Identifier(project, 'annotation'),
+        imageIDs=sql.Literal(list(imageIDs))
+    )
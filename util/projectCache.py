@@ -0,0 +1,150 @@
+'''
+    Versioned in-memory cache for per-project data that is requested on
+    every page load, but rarely changes (project settings, label class
+    definitions, etc.).
+
+    Each project carries a version stamp in the database (column
+    "config_version" of "aide_admin.project"), which is renewed by every
+    write to its settings or label classes (see "invalidate"). Stamps are
+    drawn from a global sequence, so that they are unique across projects
+    and never repeat, even if a project is deleted and re-created under
+    the same shortname. Cached entries
+    are dropped as soon as the version differs from the one they were loaded
+    at. The version is looked up at most once every "validationInterval"
+    seconds per project, so that changes made through other processes (e.g.
+    other Gunicorn workers) become visible after at most that time; changes
+    made within the same process become visible immediately.
+
+    Every entry also carries an ETag (hash of its JSON representation), which
+    can be used to answer conditional HTTP requests.
+
+    2020 Benjamin Kellenberger
+'''
+
+import time
+import json
+import hashlib
+import threading
+
+
+class ProjectCache:
+
+    def __init__(self, dbConnector, validationInterval=5.0):
+        self.dbConnector = dbConnector
+        self.validationInterval = validationInterval
+        self._lock = threading.Lock()
+
+        # project -> {'version', 'validated', 'generation', 'entries': {key: (value, etag, load time)}}
+        self.projects = {}
+
+
+    @staticmethod
+    def make_etag(value):
+        return '"{}"'.format(hashlib.md5(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest())
+
+
+    def _get_version(self, project):
+        result = self.dbConnector.execute('''
+            SELECT config_version FROM aide_admin.project
+            WHERE shortname = %s;
+        ''', (project,), 1)
+        if result is None or not len(result):
+            return None
+        return result[0]['config_version']
+
+
+    def _validate(self, project):
+        '''
+            Returns the cache record of the project, emptied if the version
+            stamp in the database has changed since it was last checked.
+        '''
+        now = time.time()
+        with self._lock:
+            record = self.projects.get(project, None)
+            if record is not None and now - record['validated'] < self.validationInterval:
+                return record
+
+        version = self._get_version(project)
+        with self._lock:
+            record = self.projects.get(project, None)
+            if record is None:
+                record = {'version': version, 'validated': now, 'generation': 0, 'entries': {}}
+                self.projects[project] = record
+            elif record['version'] != version:
+                record['version'] = version
+                record['generation'] += 1
+                record['entries'] = {}
+            record['validated'] = now
+            return record
+
+
+    def get(self, project, key, loadFun, maxAge=None):
+        '''
+            Returns a tuple (value, ETag) for the given project and key. If
+            not cached (or outdated), the value is obtained by calling
+            "loadFun" (without arguments) and cached, unless it is None.
+            "maxAge" (in seconds) additionally limits the time the value is
+            cached, for data that may change without a version increase.
+            Cached values are shared and must not be modified by the caller.
+        '''
+        record = self._validate(project)
+        now = time.time()
+        with self._lock:
+            entry = record['entries'].get(key, None)
+            generation = record['generation']
+        if entry is not None and (maxAge is None or now - entry[2] < maxAge):
+            return entry[0], entry[1]
+
+        value = loadFun()
+        if value is None:
+            return None, None
+        etag = self.make_etag(value)
+        with self._lock:
+            # do not cache values loaded before an invalidation
+            if record['generation'] == generation and self.projects.get(project, None) is record:
+                record['entries'][key] = (value, etag, now)
+        return value, etag
+
+
+    def invalidate(self, project):
+        '''
+            Drops all cached entries of the project in this process.
+        '''
+        with self._lock:
+            record = self.projects.pop(project, None)
+            if record is not None:
+                record['generation'] += 1
+
+
+
+_cache = None
+_cacheLock = threading.Lock()
+
+
+def get_project_cache(dbConnector, validationInterval=5.0):
+    '''
+        Returns the process-wide project cache.
+    '''
+    global _cache
+    with _cacheLock:
+        if _cache is None:
+            _cache = ProjectCache(dbConnector, validationInterval)
+        return _cache
+
+
+def invalidate(dbConnector, project):
+    '''
+        To be called after modifying the settings or label classes of a
+        project, or after creating or deleting it: renews its version stamp
+        in the database (invalidating the caches of all processes) and drops
+        the cached entries of this process immediately.
+    '''
+    dbConnector.execute('''
+        UPDATE aide_admin.project
+        SET config_version = nextval('aide_admin.project_config_version_seq')
+        WHERE shortname = %s;
+    ''', (project,), None)
+    with _cacheLock:
+        cache = _cache
+    if cache is not None:
+        cache.invalidate(project)
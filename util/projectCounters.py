@@ -0,0 +1,491 @@
+'''
+    Incrementally maintained counters of a project (number of images,
+    golden questions, viewed images, annotations and predictions per user
+    and label class, total view count, etc.), so that statistics and admin
+    dashboards do not have to scan the project tables upon every request.
+
+    The counters live in relation "counters" of each project schema and are
+    updated by statement-level triggers on the project tables, which sum up
+    the changes of each statement (through transition tables) and add them
+    to the counters in one upsert. To avoid contention between concurrent
+    writers on the same counter row, each database connection adds to its
+    own "shard" of the counter, and readers sum up the shards.
+
+    Counter "version" is incremented by every statement that modifies the
+    project tables (including updates and label class changes), so that
+    results derived from the project data can be cached until it changes
+    (see "get_version").
+
+    Counts of distinct images (viewed, annotated) may drift if two
+    transactions add the first view (resp. annotation) of the same image
+    concurrently, and the first/last view timestamps do not shrink upon
+    deletions. Function "rebuild" (see also "setup/rebuild_counters.py")
+    recomputes all counters from scratch.
+
+    Requires PostgreSQL 10 or newer.
+
+    2020 Benjamin Kellenberger
+'''
+
+from psycopg2 import sql
+
+
+# number of counter shards per counter
+NUM_SHARDS = 16
+
+# counters with a minimum (resp. maximum) instead of a sum across shards
+MIN_COUNTERS = ('first_checked',)
+MAX_COUNTERS = ('last_checked',)
+
+# statement-level triggers with transition tables require PostgreSQL 10
+MIN_SERVER_VERSION = 100000
+
+
+def check_server_version(dbConnector):
+    '''
+        Raises an Exception if the database server does not support the
+        triggers of the counters (and the activity rollup).
+    '''
+    result = dbConnector.execute('SHOW server_version_num;', None, 1)
+    if result is None or not len(result):
+        raise Exception('Could not determine the version of the database server.')
+    version = int(result[0]['server_version_num'])
+    if version < MIN_SERVER_VERSION:
+        raise Exception('AIDE requires PostgreSQL 10 or newer (database server runs version {}.{}).'.format(
+            version // 10000, (version // 100) % 100))
+
+
+def _epoch(expression):
+    # timestamps are stored as microseconds since the epoch
+    return sql.SQL('(EXTRACT(EPOCH FROM {}) * 1000000)::BIGINT').format(sql.SQL(expression))
+
+
+def _upsert(project, deltas):
+    '''
+        Returns a statement that adds the "deltas" (query with columns kind,
+        key and value) to the counter shards of the current connection.
+    '''
+    return sql.SQL('''
+        INSERT INTO {id_counters} AS c (kind, key, shard, value)
+        SELECT d.kind, d.key, pg_backend_pid() % {numShards}, d.value
+        FROM (
+            {deltas}
+        ) AS d(kind, key, value)
+        WHERE d.value IS NOT NULL AND d.value <> 0
+        ORDER BY d.kind, d.key
+        ON CONFLICT (kind, key, shard) DO UPDATE SET value = CASE
+            WHEN c.kind IN {minCounters} THEN LEAST(c.value, EXCLUDED.value)
+            WHEN c.kind IN {maxCounters} THEN GREATEST(c.value, EXCLUDED.value)
+            ELSE c.value + EXCLUDED.value
+        END
+    ''').format(
+        id_counters=sql.Identifier(project, 'counters'),
+        numShards=sql.Literal(NUM_SHARDS),
+        deltas=deltas,
+        minCounters=sql.Literal(MIN_COUNTERS),
+        maxCounters=sql.Literal(MAX_COUNTERS)
+    )
+
+
+def _with_version(deltas=None):
+    '''
+        Appends an increment of the data version to a deltas query.
+    '''
+    version = sql.SQL('''SELECT 'version', '', 1::BIGINT''')
+    if deltas is None:
+        return version
+    return sql.SQL('{deltas} UNION ALL {version}').format(deltas=deltas, version=version)
+
+
+def _distinct_images(project, table, rows, inserted):
+    '''
+        Returns a query for the change of the number of distinct images in
+        "table" by the rows in transition table "rows": for insertions, the
+        images that have no other rows than the inserted ones; for dele-
+        tions, the images that have no rows left.
+    '''
+    return sql.SQL('''
+        SELECT {sign} * COUNT(*) FROM (
+            SELECT image, COUNT(*) AS cnt FROM {rows} GROUP BY image
+        ) AS i
+        WHERE (
+            SELECT COUNT(*) FROM {id_table} AS t
+            WHERE t.image = i.image
+        ) = {remaining}
+    ''').format(
+        sign=sql.Literal(1 if inserted else -1),
+        rows=sql.SQL(rows),
+        id_table=sql.Identifier(project, table),
+        remaining=sql.SQL('i.cnt' if inserted else '0')
+    )
+
+
+def _trigger_deltas(project, annotationType, predictionType):
+    '''
+        Returns a dict of table name: (insert/delete deltas function or None,
+        update deltas or None). The insert/delete function receives the
+        transition table name and the sign (1 or -1) and returns a query for
+        the changes of the counters as rows (kind, key, value). Tables without
+        deltas only increment the data version.
+    '''
+    hasAnnoLabel = (annotationType != 'segmentationMasks')
+    hasPredLabel = (predictionType != 'segmentationMasks')
+
+    def _image(rows, sign):
+        return sql.SQL('''
+            SELECT 'num_images', '', {sign} * COUNT(*) FROM {rows}
+            UNION ALL
+            SELECT 'num_golden', '', {sign} * COUNT(*) FILTER (WHERE isGoldenQuestion) FROM {rows}
+        ''').format(sign=sql.Literal(sign), rows=sql.SQL(rows))
+
+    # golden question flags are changed by a row-level trigger (see below)
+    imageUpdate = sql.SQL('''
+        SELECT 'num_golden', '', (CASE WHEN NEW.isGoldenQuestion THEN 1 ELSE -1 END)::BIGINT
+    ''')
+
+    def _image_user(rows, sign):
+        query = sql.SQL('''
+            SELECT 'num_viewed_user', username, {sign} * COUNT(*) FROM {rows} GROUP BY username
+            UNION ALL
+            SELECT 'viewcount', '', {sign} * SUM(viewcount) FROM {rows}
+            UNION ALL
+            SELECT 'num_viewed', '', ({distinct})
+        ''').format(
+            sign=sql.Literal(sign),
+            rows=sql.SQL(rows),
+            distinct=_distinct_images(project, 'image_user', rows, sign > 0)
+        )
+        if sign > 0:
+            query = sql.SQL('''
+                {query}
+                UNION ALL
+                SELECT 'first_checked', '', {first} FROM {rows}
+                UNION ALL
+                SELECT 'last_checked', '', {last} FROM {rows}
+            ''').format(
+                query=query,
+                rows=sql.SQL(rows),
+                first=_epoch('MIN(first_checked)'),
+                last=_epoch('MAX(last_checked)')
+            )
+        return query
+
+    imageUserUpdate = sql.SQL('''
+        SELECT 'viewcount', '', (SELECT SUM(viewcount) FROM new_rows) - (SELECT SUM(viewcount) FROM old_rows)
+        UNION ALL
+        SELECT 'last_checked', '', {last} FROM new_rows
+    ''').format(last=_epoch('MAX(last_checked)'))
+
+    def _class_update(kind):
+        return sql.SQL('''
+            SELECT {kind}, label::VARCHAR, SUM(s) FROM (
+                SELECT label, 1 AS s FROM new_rows
+                UNION ALL
+                SELECT label, -1 AS s FROM old_rows
+            ) AS l
+            WHERE label IS NOT NULL
+            GROUP BY label
+        ''').format(kind=sql.Literal(kind))
+
+    def _annotation(rows, sign):
+        query = sql.SQL('''
+            SELECT 'num_annotations', '', {sign} * COUNT(*) FROM {rows}
+            UNION ALL
+            SELECT 'num_anno_user', username, {sign} * COUNT(*) FROM {rows} GROUP BY username
+            UNION ALL
+            SELECT 'num_annotated', '', ({distinct})
+        ''').format(
+            sign=sql.Literal(sign),
+            rows=sql.SQL(rows),
+            distinct=_distinct_images(project, 'annotation', rows, sign > 0)
+        )
+        if hasAnnoLabel:
+            query = sql.SQL('''
+                {query}
+                UNION ALL
+                SELECT 'num_anno_class', label::VARCHAR, {sign} * COUNT(*) FROM {rows}
+                WHERE label IS NOT NULL GROUP BY label
+            ''').format(query=query, sign=sql.Literal(sign), rows=sql.SQL(rows))
+        return query
+
+    def _prediction(rows, sign):
+        query = sql.SQL('''
+            SELECT 'num_predictions', '', {sign} * COUNT(*) FROM {rows}
+        ''').format(sign=sql.Literal(sign), rows=sql.SQL(rows))
+        if hasPredLabel:
+            query = sql.SQL('''
+                {query}
+                UNION ALL
+                SELECT 'num_pred_class', label::VARCHAR, {sign} * COUNT(*) FROM {rows}
+                WHERE label IS NOT NULL GROUP BY label
+            ''').format(query=query, sign=sql.Literal(sign), rows=sql.SQL(rows))
+        return query
+
+    def _cnnstate(rows, sign):
+        return sql.SQL('''
+            SELECT 'num_cnnstates', '', {sign} * COUNT(*) FROM {rows}
+        ''').format(sign=sql.Literal(sign), rows=sql.SQL(rows))
+
+    return {
+        'image': (_image, imageUpdate),
+        'image_user': (_image_user, imageUserUpdate),
+        'annotation': (_annotation, (_class_update('num_anno_class') if hasAnnoLabel else None)),
+        'prediction': (_prediction, (_class_update('num_pred_class') if hasPredLabel else None)),
+        'cnnstate': (_cnnstate, None),
+        'labelclass': (None, None)
+    }
+
+
+def _get_types(dbConnector, project):
+    result = dbConnector.execute('''
+        SELECT annotationType, predictionType
+        FROM aide_admin.project
+        WHERE shortname = %s;
+    ''', (project,), 1)
+    if result is None or not len(result):
+        raise Exception(f'Project "{project}" not found.')
+    return result[0]['annotationtype'], result[0]['predictiontype']
+
+
+def install(dbConnector, project, annotationType=None, predictionType=None):
+    '''
+        Creates the counters relation of a project and the triggers that
+        maintain it (replacing existing triggers). If the relation did not
+        exist before, it is populated from the current project data.
+    '''
+    check_server_version(dbConnector)
+    if annotationType is None or predictionType is None:
+        annotationType, predictionType = _get_types(dbConnector, project)
+
+    exists = dbConnector.execute('''
+        SELECT to_regclass(quote_ident(%s) || '.counters') AS rel;
+    ''', (project,), 1)
+    created = (exists is None or not len(exists) or exists[0]['rel'] is None)
+
+    statements = [sql.SQL('''
+        CREATE TABLE IF NOT EXISTS {id_counters} (
+            kind VARCHAR NOT NULL,
+            key VARCHAR NOT NULL DEFAULT '',
+            shard SMALLINT NOT NULL DEFAULT 0,
+            value BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (kind, key, shard)
+        )
+    ''').format(id_counters=sql.Identifier(project, 'counters'))]
+
+    for table, (deltaFun, updateDeltas) in _trigger_deltas(project, annotationType, predictionType).items():
+        id_table = sql.Identifier(project, table)
+        id_fun = sql.Identifier(project, 'counters_' + table)
+        statements.append(sql.SQL('''
+            CREATE OR REPLACE FUNCTION {id_fun}() RETURNS TRIGGER AS $counters$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    {upsertInsert};
+                ELSIF TG_OP = 'DELETE' THEN
+                    {upsertDelete};
+                ELSIF TG_OP = 'UPDATE' THEN
+                    {upsertUpdate};
+                END IF;
+                RETURN NULL;
+            END;
+            $counters$ LANGUAGE plpgsql
+        ''').format(
+            id_fun=id_fun,
+            upsertInsert=_upsert(project, _with_version(deltaFun('new_rows', 1) if deltaFun is not None else None)),
+            upsertDelete=_upsert(project, _with_version(deltaFun('old_rows', -1) if deltaFun is not None else None)),
+            upsertUpdate=_upsert(project, _with_version(updateDeltas))
+        ))
+
+        # transition tables require one trigger per event
+        triggers = [
+            ('counters_insert', sql.SQL('AFTER INSERT ON {} REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT').format(id_table)),
+            ('counters_delete', sql.SQL('AFTER DELETE ON {} REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT').format(id_table)),
+            ('counters_update', sql.SQL('AFTER UPDATE ON {} FOR EACH STATEMENT').format(id_table))
+        ]
+        if table == 'image':
+            triggers[2] = ('counters_update', sql.SQL('''AFTER UPDATE OF isGoldenQuestion ON {} FOR EACH ROW
+                WHEN (OLD.isGoldenQuestion IS DISTINCT FROM NEW.isGoldenQuestion)''').format(id_table))
+        elif updateDeltas is not None:
+            triggers[2] = ('counters_update', sql.SQL('AFTER UPDATE ON {} REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT').format(id_table))
+
+        for name, definition in triggers:
+            statements.append(sql.SQL('DROP TRIGGER IF EXISTS {name} ON {id_table}').format(
+                name=sql.Identifier(name), id_table=id_table))
+            statements.append(sql.SQL('CREATE TRIGGER {name} {definition} EXECUTE PROCEDURE {id_fun}()').format(
+                name=sql.Identifier(name), definition=definition, id_fun=id_fun))
+
+    with dbConnector.transaction() as cursor:
+        cursor.execute(sql.SQL(';').join(statements))
+
+    if created:
+        rebuild(dbConnector, project, annotationType, predictionType)
+    return created
+
+
+def rebuild(dbConnector, project, annotationType=None, predictionType=None):
+    '''
+        Recomputes all counters of a project from the project tables. Blocks
+        concurrent writes to the project tables (through their triggers)
+        until done. The data version is carried over and incremented.
+    '''
+    if annotationType is None or predictionType is None:
+        annotationType, predictionType = _get_types(dbConnector, project)
+
+    queries = [
+        sql.SQL('''
+            SELECT 'num_images', '', COUNT(*) FROM {id_img}
+            UNION ALL
+            SELECT 'num_golden', '', COUNT(*) FILTER (WHERE isGoldenQuestion) FROM {id_img}
+            UNION ALL
+            SELECT 'num_viewed', '', COUNT(DISTINCT image) FROM {id_iu}
+            UNION ALL
+            SELECT 'viewcount', '', SUM(viewcount) FROM {id_iu}
+            UNION ALL
+            SELECT 'num_viewed_user', username, COUNT(*) FROM {id_iu} GROUP BY username
+            UNION ALL
+            SELECT 'first_checked', '', {first} FROM {id_iu}
+            UNION ALL
+            SELECT 'last_checked', '', {last} FROM {id_iu}
+            UNION ALL
+            SELECT 'num_annotations', '', COUNT(*) FROM {id_anno}
+            UNION ALL
+            SELECT 'num_annotated', '', COUNT(DISTINCT image) FROM {id_anno}
+            UNION ALL
+            SELECT 'num_anno_user', username, COUNT(*) FROM {id_anno} GROUP BY username
+            UNION ALL
+            SELECT 'num_predictions', '', COUNT(*) FROM {id_pred}
+            UNION ALL
+            SELECT 'num_cnnstates', '', COUNT(*) FROM {id_cnnstate}
+        ''').format(
+            id_img=sql.Identifier(project, 'image'),
+            id_iu=sql.Identifier(project, 'image_user'),
+            id_anno=sql.Identifier(project, 'annotation'),
+            id_pred=sql.Identifier(project, 'prediction'),
+            id_cnnstate=sql.Identifier(project, 'cnnstate'),
+            first=_epoch('MIN(first_checked)'),
+            last=_epoch('MAX(last_checked)')
+        )
+    ]
+    if annotationType != 'segmentationMasks':
+        queries.append(sql.SQL('''
+            SELECT 'num_anno_class', label::VARCHAR, COUNT(*) FROM {id_anno}
+            WHERE label IS NOT NULL GROUP BY label
+        ''').format(id_anno=sql.Identifier(project, 'annotation')))
+    if predictionType != 'segmentationMasks':
+        queries.append(sql.SQL('''
+            SELECT 'num_pred_class', label::VARCHAR, COUNT(*) FROM {id_pred}
+            WHERE label IS NOT NULL GROUP BY label
+        ''').format(id_pred=sql.Identifier(project, 'prediction')))
+
+    with dbConnector.transaction() as cursor:
+        cursor.execute(sql.SQL('''
+            LOCK TABLE {id_counters} IN EXCLUSIVE MODE;
+            CREATE TEMPORARY TABLE counters_version ON COMMIT DROP AS
+                SELECT COALESCE(SUM(value), 0) + 1 AS value
+                FROM {id_counters} WHERE kind = 'version';
+            DELETE FROM {id_counters};
+            INSERT INTO {id_counters} (kind, key, shard, value)
+            SELECT d.kind, d.key, 0, d.value
+            FROM (
+                {queries}
+                UNION ALL
+                SELECT 'version', '', value FROM counters_version
+            ) AS d(kind, key, value)
+            WHERE d.value IS NOT NULL AND d.value <> 0;
+        ''').format(
+            id_counters=sql.Identifier(project, 'counters'),
+            queries=sql.SQL(' UNION ALL ').join(queries)
+        ))
+
+
+def _counters_query(project):
+    return sql.SQL('''
+        SELECT {project} AS project, kind, key, CASE
+            WHEN kind IN {minCounters} THEN MIN(value)
+            WHEN kind IN {maxCounters} THEN MAX(value)
+            ELSE SUM(value)
+        END::BIGINT AS value
+        FROM {id_counters}
+        GROUP BY kind, key
+    ''').format(
+        project=sql.Literal(project),
+        id_counters=sql.Identifier(project, 'counters'),
+        minCounters=sql.Literal(MIN_COUNTERS),
+        maxCounters=sql.Literal(MAX_COUNTERS)
+    )
+
+
+def get_counters(dbConnector, projects):
+    '''
+        Returns the counters of one project (str) or multiple projects
+        (iterable) as a dict of kind: {key: value}, resp. a dict of project:
+        {kind: {key: value}}. Project-wide counters have key ''; others are
+        keyed by user name or label class ID. Timestamps (first_checked,
+        last_checked) are returned in seconds since the epoch. Counters that
+        are absent are zero (resp. no timestamp), as are all counters of
+        projects that have none (yet).
+    '''
+    single = isinstance(projects, str)
+    if single:
+        projects = [projects]
+    response = dict([(p, {}) for p in projects])
+    if not len(projects):
+        return response
+
+    installed = dbConnector.execute('''
+        SELECT p AS project FROM unnest(%s::VARCHAR[]) AS p
+        WHERE to_regclass(quote_ident(p) || '.counters') IS NOT NULL;
+    ''', (list(projects),), 'all')
+    if installed is None or not len(installed):
+        return (response[projects[0]] if single else response)
+
+    result = dbConnector.execute(
+        sql.SQL(' UNION ALL ').join([_counters_query(r['project']) for r in installed]),
+        None, 'all')
+    if result is None:
+        result = []
+    for r in result:
+        value = r['value']
+        if r['kind'] in MIN_COUNTERS or r['kind'] in MAX_COUNTERS:
+            value = value / 1e6
+        else:
+            value = int(value)
+        kinds = response[r['project']]
+        if r['kind'] not in kinds:
+            kinds[r['kind']] = {}
+        kinds[r['kind']][r['key']] = value
+
+    if single:
+        return response[projects[0]]
+    return response
+
+
+def get_version(dbConnector, project):
+    '''
+        Returns a stamp of the current data version of a project, which
+        changes whenever the project tables are modified (or the project is
+        re-created), or None if the project has no counters.
+    '''
+    exists = dbConnector.execute('''
+        SELECT to_regclass(quote_ident(%s) || '.counters')::oid AS relid;
+    ''', (project,), 1)
+    if exists is None or not len(exists) or exists[0]['relid'] is None:
+        return None
+
+    result = dbConnector.execute(sql.SQL('''
+        SELECT COALESCE(SUM(value), 0) AS version
+        FROM {id_counters}
+        WHERE kind = 'version';
+    ''').format(
+        id_counters=sql.Identifier(project, 'counters')
+    ), None, 1)
+    if result is None or not len(result):
+        return None
+    return (int(exists[0]['relid']), int(result[0]['version']))
+
+
+def get_total(counters, kind, default=0):
+    '''
+        Returns the project-wide value of a counter (as returned by
+        "get_counters").
+    '''
+    return counters.get(kind, {}).get('', default)
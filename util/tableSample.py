@@ -0,0 +1,103 @@
+'''
+    Helper for drawing random rows from large project tables (e.g. images)
+    in constant time. Instead of sorting the entire table by a random key
+    ("ORDER BY RANDOM()"), queries sample a small fraction of the table's
+    disk pages ("TABLESAMPLE SYSTEM (<percentage>)") and only shuffle the
+    sampled rows.
+
+    The sampling percentage is chosen such that the expected number of
+    sampled rows is a multiple ("oversampling factor") of the number of rows
+    requested, based on the row count estimate of the Postgres statistics.
+    Since filters (e.g. images currently reserved by other annotators) may
+    discard sampled rows, the factor is adapted per table: it is doubled
+    whenever a sampled query returned too few rows, and slowly decreased
+    again otherwise. Small tables (and tables without statistics) are not
+    sampled at all.
+
+    2020 Benjamin Kellenberger
+'''
+
+import time
+import threading
+
+
+class TableSampler:
+
+    def __init__(self, dbConnector, smallTableSize=10000, minSampleSize=1000,
+                    minFactor=4.0, maxFactor=1024.0, estimateTTL=60.0):
+        '''
+            Inputs:
+            - dbConnector: Database instance to obtain row count estimates from
+            - smallTableSize: tables with fewer (estimated) rows are not sampled
+            - minSampleSize: minimum expected number of sampled rows
+            - minFactor, maxFactor: range of the oversampling factor
+            - estimateTTL: time (in seconds) row count estimates are cached
+        '''
+        self.dbConnector = dbConnector
+        self.smallTableSize = smallTableSize
+        self.minSampleSize = minSampleSize
+        self.minFactor = minFactor
+        self.maxFactor = maxFactor
+        self.estimateTTL = estimateTTL
+
+        self._lock = threading.Lock()
+        self.estimates = {}     # (schema, table) -> (number of rows, time of lookup)
+        self.factors = {}       # (schema, table) -> oversampling factor
+
+
+    def estimate_rows(self, schema, table):
+        '''
+            Returns the number of rows of a table as estimated by Postgres'
+            statistics (or 0 if the table has not been analyzed yet).
+        '''
+        key = (schema, table)
+        now = time.time()
+        with self._lock:
+            estimate = self.estimates.get(key, None)
+            if estimate is not None and now - estimate[1] < self.estimateTTL:
+                return estimate[0]
+
+        result = self.dbConnector.execute('''
+            SELECT GREATEST(cl.reltuples, 0)::BIGINT AS num_rows
+            FROM pg_class AS cl
+            JOIN pg_namespace AS ns
+            ON cl.relnamespace = ns.oid
+            WHERE ns.nspname = %s AND cl.relname = %s;
+        ''', (schema, table), 1)
+        numRows = (result[0]['num_rows'] if result is not None and len(result) else 0)
+        with self._lock:
+            self.estimates[key] = (numRows, now)
+        return numRows
+
+
+    def get_percentage(self, schema, limit, table='image'):
+        '''
+            Returns the percentage of the table to sample in order to draw
+            "limit" random rows, or None if the entire table should be
+            shuffled instead.
+        '''
+        numRows = self.estimate_rows(schema, table)
+        if numRows < self.smallTableSize:
+            return None
+        with self._lock:
+            factor = self.factors.get((schema, table), self.minFactor)
+        sampleSize = max(limit * factor, self.minSampleSize)
+        percentage = 100.0 * sampleSize / numRows
+        if percentage >= 100.0:
+            return None
+        return percentage
+
+
+    def report(self, schema, limit, numReturned, table='image'):
+        '''
+            Adapts the oversampling factor of a table after a sampled query
+            returned "numReturned" out of "limit" requested rows.
+        '''
+        key = (schema, table)
+        with self._lock:
+            factor = self.factors.get(key, self.minFactor)
+            if numReturned < limit:
+                factor = min(2 * factor, self.maxFactor)
+            else:
+                factor = max(0.9 * factor, self.minFactor)
+            self.factors[key] = factor